@@ -1,25 +1,36 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, g, has_app_context
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from flask_mail import Mail, Message
+from flask_mail import Mail, Message, BadHeaderError
+import smtplib
 import random, string
 import logging
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import mysql.connector
 import re
 from flask_bcrypt import Bcrypt
 from dotenv import load_dotenv
 import os
 from flask_socketio import SocketIO, join_room, leave_room, send, emit
-from datetime import datetime, timezone, timedelta
+from datetime import date, datetime, timezone, timedelta
+from zoneinfo import ZoneInfo
 from dateutil.relativedelta import relativedelta
 from authlib.integrations.flask_client import OAuth
 import jwt
 from jwt import DecodeError, ExpiredSignatureError
-from urllib.request import urlopen
 import json
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, ReplaceOne, DeleteOne
+from bson import ObjectId
+from pymongo.errors import BulkWriteError, CollectionInvalid, OperationFailure
 import tiktoken
+import click
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import time
+import threading
+import queue
+from collections import OrderedDict, deque
+import atexit
 import urllib.parse
 
 
@@ -36,6 +47,14 @@ logging.getLogger('werkzeug').setLevel(logging.WARNING)
 
 
 app = Flask(__name__)
+
+# Password hashing configuration
+password_hashing_config = {
+    'rounds': int(os.getenv('BCRYPT_LOG_ROUNDS', 12)),                          # bcrypt work factor; each step doubles the cost
+    'max_concurrent': int(os.getenv('PASSWORD_HASH_MAX_CONCURRENT', 4)),        # bcrypt operations running at once
+    'queue_timeout': float(os.getenv('PASSWORD_HASH_QUEUE_TIMEOUT', 10))        # Seconds to wait for a free slot before answering 503
+}
+app.config['BCRYPT_LOG_ROUNDS'] = password_hashing_config['rounds']  # Read by Bcrypt(app)
 bcrypt = Bcrypt(app)
 
 
@@ -87,8 +106,475 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 
 
+# Outbound HTTP configuration; per-upstream overrides are keyed by host
+http_client_config = {
+    'pool_maxsize': int(os.getenv('HTTP_POOL_MAXSIZE', 10)),          # Keep-alive connections per upstream host
+    'connect_timeout': float(os.getenv('HTTP_CONNECT_TIMEOUT', 5)),   # Seconds to establish a connection
+    'read_timeout': float(os.getenv('HTTP_READ_TIMEOUT', 30)),        # Seconds to wait for response data
+    'max_retries': int(os.getenv('HTTP_MAX_RETRIES', 3)),             # Retries for idempotent requests
+    'backoff_factor': float(os.getenv('HTTP_BACKOFF_FACTOR', 0.3)),   # Exponential backoff base in seconds
+    'backoff_jitter': float(os.getenv('HTTP_BACKOFF_JITTER', 0.3))    # Random jitter added to each backoff
+}
+
+http_upstream_config = {
+    urllib.parse.urlparse(letta_url).netloc: {
+        # Agent turns can take tens of seconds, and all chat traffic goes through this host
+        'pool_maxsize': int(os.getenv('LETTA_POOL_MAXSIZE', 50)),
+        'read_timeout': float(os.getenv('LETTA_READ_TIMEOUT', 300))
+    },
+    'www.googleapis.com': {'pool_maxsize': 20},
+    'geocode.maps.co': {'read_timeout': 10},
+    'timeapi.io': {'read_timeout': 10}
+}
+
+
+class OutboundHTTPClient:
+    """Keep-alive requests.Session per upstream host with default timeouts and retries."""
+
+    # Only methods that are safe to repeat are retried after a response or read failure
+    IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+    def __init__(self, defaults, upstreams):
+        self.defaults = defaults
+        self.upstreams = upstreams
+        self._sessions = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _settings(self, host):
+        settings = dict(self.defaults)
+        settings.update(self.upstreams.get(host, {}))
+        return settings
+
+    def _build_session(self, host):
+        settings = self._settings(host)
+        retry_options = {
+            'total': settings['max_retries'],
+            'backoff_factor': settings['backoff_factor'],
+            'status_forcelist': (429, 500, 502, 503, 504),
+            'allowed_methods': self.IDEMPOTENT_METHODS,
+            'respect_retry_after_header': True,
+            'raise_on_status': False
+        }
+        try:
+            retry = Retry(backoff_jitter=settings['backoff_jitter'], **retry_options)
+        except TypeError:
+            # urllib3 < 2 has no jitter option
+            retry = Retry(**retry_options)
+
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=settings['pool_maxsize'],
+            pool_block=True,  # Wait for a free connection instead of opening unpooled ones
+            max_retries=retry
+        )
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _session(self, host):
+        with self._lock:
+            # Never share pooled sockets with a parent process after fork()
+            if self._pid != os.getpid():
+                self._sessions = {}
+                self._pid = os.getpid()
+
+            session = self._sessions.get(host)
+            if session is None:
+                session = self._build_session(host)
+                self._sessions[host] = session
+            return session
+
+    def request(self, method, url, **kwargs):
+        host = urllib.parse.urlparse(url).netloc
+        settings = self._settings(host)
+        kwargs.setdefault('timeout', (settings['connect_timeout'], settings['read_timeout']))
+
+        stats = self._stats.setdefault(host, {'requests': 0, 'errors': 0, 'time_total': 0.0})
+        stats['requests'] += 1
+        started = time.monotonic()
+        try:
+            return self._session(host).request(method, url, **kwargs)
+        except requests.RequestException:
+            stats['errors'] += 1
+            raise
+        finally:
+            stats['time_total'] += time.monotonic() - started
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+
+    def stats(self):
+        return {host: dict(stats) for host, stats in self._stats.items()}
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+
+http_client = OutboundHTTPClient(http_client_config, http_upstream_config)
+atexit.register(http_client.close)
+
+
+# Raised by a background job handler when retrying would not help
+class JobFailed(Exception):
+    pass
+
+
+# Background job pipeline with a worker pool, retries with backoff, job status and a dead-letter hook
+class BackgroundJobQueue:
+    def __init__(self, name, handler, workers=2, max_retries=3, retry_backoff=2.0, on_dead_letter=None, history_size=1000):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.on_dead_letter = on_dead_letter
+        self.history_size = history_size
+        self._queue = queue.Queue()
+        self._jobs = OrderedDict()  # job_id -> status dict, oldest first
+        self._lock = threading.Lock()
+        self._workers_pid = None
+        self._running = 0
+        self._waiting_retry = 0
+        self._stats = {'enqueued': 0, 'completed': 0, 'retried': 0, 'failed': 0, 'dead_lettered': 0, 'run_time_total': 0.0}
+
+    def _ensure_workers(self):
+        # Start the worker pool once per process, on first use
+        if self._workers_pid == os.getpid():
+            return
+        with self._lock:
+            if self._workers_pid != os.getpid():
+                self._workers_pid = os.getpid()
+                for _ in range(self.workers):
+                    socketio.start_background_task(self._worker)
+
+    def enqueue(self, payload, job_id=None):
+        job_id = job_id or f"{self.name}-{int(time.time() * 1000)}-{random.randint(1000, 9999)}"
+        job = {
+            'job_id': job_id,
+            'status': 'queued',
+            'attempts': 0,
+            'enqueued_at': time.time(),
+            'last_error': None,
+            'payload': payload
+        }
+
+        with self._lock:
+            self._jobs[job_id] = job
+            self._jobs.move_to_end(job_id)
+            while len(self._jobs) > self.history_size:
+                self._jobs.popitem(last=False)
+            self._stats['enqueued'] += 1
+
+        self._ensure_workers()
+        self._queue.put(job)
+        return job_id
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            job['status'] = 'running'
+            job['attempts'] += 1
+            with self._lock:
+                self._running += 1
+
+            started = time.monotonic()
+            try:
+                with app.app_context():
+                    self.handler(job['payload'])
+                job['status'] = 'done'
+                self._stats['completed'] += 1
+            except Exception as e:
+                job['last_error'] = str(e)
+                if isinstance(e, JobFailed) or job['attempts'] > self.max_retries:
+                    self._fail(job)
+                else:
+                    # Requeue after an exponential backoff without holding up this worker
+                    job['status'] = 'retrying'
+                    self._stats['retried'] += 1
+                    with self._lock:
+                        self._waiting_retry += 1
+                    socketio.start_background_task(self._retry_later, job, self.retry_backoff * (2 ** (job['attempts'] - 1)))
+            finally:
+                self._stats['run_time_total'] += time.monotonic() - started
+                with self._lock:
+                    self._running -= 1
+                self._queue.task_done()
+
+    def _retry_later(self, job, delay):
+        socketio.sleep(delay)
+        with self._lock:
+            self._waiting_retry -= 1
+        job['status'] = 'queued'
+        self._queue.put(job)
+
+    def _fail(self, job):
+        job['status'] = 'failed'
+        self._stats['failed'] += 1
+        print(f"Background job {job['job_id']} failed after {job['attempts']} attempt(s): {job['last_error']}")
+        if self.on_dead_letter:
+            try:
+                with app.app_context():
+                    self.on_dead_letter(job)
+                self._stats['dead_lettered'] += 1
+            except Exception as e:
+                print(f"Error dead-lettering job {job['job_id']}: {e}")
+
+    def status(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        return {key: value for key, value in job.items() if key != 'payload'}
+
+    def drain(self, timeout=None):
+        """Wait until the backlog is empty; returns False if the timeout expires first."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while self._queue.unfinished_tasks or self._waiting_retry:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            socketio.sleep(0.05)
+        return True
+
+    def stats(self):
+        with self._lock:
+            queued_times = [job['enqueued_at'] for job in self._jobs.values() if job['status'] == 'queued']
+            stats = dict(self._stats)
+            stats.update({
+                'backlog': self._queue.qsize(),
+                'waiting_retry': self._waiting_retry,
+                'running': self._running,
+                'oldest_queued_age': time.time() - min(queued_times) if queued_times else 0.0
+            })
+        return stats
+
+
+# Helper that collapses concurrent calls for the same key into a single execution
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {'event': threading.Event(), 'result': None, 'error': None}
+                self._calls[key] = call
+
+        # Followers wait for the leader and share its result
+        if not leader:
+            call['event'].wait()
+            if call['error'] is not None:
+                raise call['error']
+            return call['result']
+
+        try:
+            call['result'] = fn(*args, **kwargs)
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call['event'].set()
+
+
+# Agent turn worker pool configuration
+agent_turn_config = {
+    'workers': int(os.getenv('AGENT_TURN_WORKERS', 8)),                          # Agent turns processed in parallel (across users)
+    'max_queue_per_user': int(os.getenv('AGENT_TURN_MAX_QUEUE_PER_USER', 20))    # Pending turns a single user may queue
+}
+
+
+# Runs agent turns on a worker pool, one at a time and in order for each user, in parallel across users
+class AgentTurnDispatcher:
+    def __init__(self, workers, max_queue_per_user):
+        self.workers = workers
+        self.max_queue_per_user = max_queue_per_user
+        self._pending = {}           # user_id -> deque of (submitted_at, fn, args)
+        self._ready = queue.Queue()  # user_ids with a turn waiting and none running
+        self._lock = threading.Lock()
+        self._workers_pid = None
+        self._in_flight = 0
+        self._stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'rejected': 0, 'wait_time_total': 0.0, 'wait_time_max': 0.0}
+
+    def _ensure_workers(self):
+        # Start the worker pool once per process, on first use
+        if self._workers_pid == os.getpid():
+            return
+        with self._lock:
+            if self._workers_pid != os.getpid():
+                self._workers_pid = os.getpid()
+                for _ in range(self.workers):
+                    socketio.start_background_task(self._worker)
+
+    def submit(self, user_id, fn, *args):
+        """Queue a turn for the user; returns its position in the user's queue, or None if the queue is full."""
+        self._ensure_workers()
+
+        with self._lock:
+            turns = self._pending.get(user_id)
+            if turns is None:
+                turns = deque()
+                self._pending[user_id] = turns
+                # The user is only scheduled when nothing of theirs is queued or running
+                self._ready.put(user_id)
+            elif len(turns) >= self.max_queue_per_user:
+                self._stats['rejected'] += 1
+                return None
+
+            turns.append((time.monotonic(), fn, args))
+            self._stats['submitted'] += 1
+            return len(turns)
+
+    def _worker(self):
+        while True:
+            user_id = self._ready.get()
+            with self._lock:
+                submitted_at, fn, args = self._pending[user_id].popleft()
+                self._in_flight += 1
+                wait_time = time.monotonic() - submitted_at
+                self._stats['wait_time_total'] += wait_time
+                self._stats['wait_time_max'] = max(self._stats['wait_time_max'], wait_time)
+
+            try:
+                with app.app_context():
+                    fn(*args)
+                self._stats['completed'] += 1
+            except Exception as e:
+                self._stats['failed'] += 1
+                print(f"Error running agent turn for user {user_id}: {e}")
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+                    if self._pending[user_id]:
+                        # Back of the line, so other users' turns are not starved
+                        self._ready.put(user_id)
+                    else:
+                        del self._pending[user_id]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            started = stats['completed'] + stats['failed'] + self._in_flight
+            stats.update({
+                'queue_depth': sum(len(turns) for turns in self._pending.values()),
+                'users_waiting': sum(1 for turns in self._pending.values() if turns),
+                'in_flight': self._in_flight,
+                'wait_time_avg': stats['wait_time_total'] / started if started else 0.0
+            })
+        return stats
+
+
+agent_turns = AgentTurnDispatcher(**agent_turn_config)
+
+
+# Raised when too many password hashes are already waiting for a worker
+class PasswordHashingBusy(Exception):
+    pass
+
+
+# Runs bcrypt off the request thread (eventlet's native thread pool under eventlet, else a thread pool),
+# so hashing never blocks the hub that every socket and streaming reply shares
+class PasswordHasher:
+    def __init__(self, rounds, max_concurrent, queue_timeout):
+        self.rounds = rounds
+        self.max_concurrent = max_concurrent
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._stats = {'hashes': 0, 'checks': 0, 'rejected': 0, 'wait_time_total': 0.0, 'wait_time_max': 0.0,
+                       'bcrypt_time_total': 0.0, 'bcrypt_time_max': 0.0, 'hub_stall_total': 0.0}
+
+    def _execute(self, fn, *args):
+        if socketio.async_mode == 'eventlet':
+            from eventlet import tpool
+            return tpool.execute(fn, *args)
+
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_concurrent, thread_name_prefix='bcrypt')
+        return self._executor.submit(fn, *args).result()
+
+    def _run(self, fn, *args):
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            self._stats['rejected'] += 1
+            raise PasswordHashingBusy("Too many password operations in progress")
+
+        waited = time.monotonic() - started
+        self._stats['wait_time_total'] += waited
+        self._stats['wait_time_max'] = max(self._stats['wait_time_max'], waited)
+
+        caller_thread = threading.get_native_id()
+
+        def timed():
+            # Measured where bcrypt actually runs; any of it on the caller's OS thread is time the hub stood still
+            bcrypt_started = time.monotonic()
+            try:
+                return fn(*args)
+            finally:
+                elapsed = time.monotonic() - bcrypt_started
+                self._stats['bcrypt_time_total'] += elapsed
+                self._stats['bcrypt_time_max'] = max(self._stats['bcrypt_time_max'], elapsed)
+                if threading.get_native_id() == caller_thread:
+                    self._stats['hub_stall_total'] += elapsed
+
+        try:
+            return self._execute(timed)
+        finally:
+            self._slots.release()
+
+    def generate_password_hash(self, password):
+        self._stats['hashes'] += 1
+        return self._run(bcrypt.generate_password_hash, password, self.rounds).decode('utf-8')
+
+    def check_password_hash(self, pw_hash, password):
+        self._stats['checks'] += 1
+        return self._run(bcrypt.check_password_hash, pw_hash, password)
+
+    def stats(self):
+        stats = dict(self._stats, rounds=self.rounds, max_concurrent=self.max_concurrent, mode='tpool' if socketio.async_mode == 'eventlet' else 'threads')
+        operations = stats['hashes'] + stats['checks']
+        stats['bcrypt_time_avg'] = stats['bcrypt_time_total'] / operations if operations else 0.0
+        return stats
+
+
+password_hasher = PasswordHasher(**password_hashing_config)
+
+
+# Answer with 503 instead of a stack trace when password hashing is saturated
+@app.errorhandler(PasswordHashingBusy)
+def handle_password_hashing_busy(e):
+    if request.is_json:
+        return jsonify({'message': 'The server is busy. Please try again in a moment.'}), 503
+    flash('The server is busy. Please try again in a moment.', 'error')
+    return redirect(request.referrer or url_for('login'))
+
+
 class User(UserMixin):
-    def __init__(self, user_id, FirstName, LastName, Username, DateOfBirth, email, ZipCode, State, City, Country, Latitude, Longitude, TimeZone, HasDST, DSTStart, DSTEnd, Gender, Avatar, UIMode, CurrentPersona, Admin):
+    def __init__(self, user_id, FirstName, LastName, Username, DateOfBirth, email, ZipCode, State, City, Country, Latitude, Longitude, TimeZone, HasDST, DSTStart, DSTEnd, Gender, Avatar, UIMode, CurrentPersona, Admin, GoogleConnected=False):
         self.user_id = user_id  # This is the 'user_id' from the Users table
         self.FirstName = FirstName
         self.LastName = LastName
@@ -110,6 +596,7 @@ class User(UserMixin):
         self.UIMode = UIMode
         self.CurrentPersona = CurrentPersona
         self.Admin = Admin
+        self.GoogleConnected = GoogleConnected  # Server-side only, not part of to_dict()
 
     def get_id(self):
         """Flask-Login requires this method to return the user's ID."""
@@ -151,8 +638,200 @@ db_config = {
 }
 
 
+# Connection pool configuration (sizes are per worker process)
+db_pool_config = {
+    'pool_size': int(os.getenv('DB_POOL_SIZE', 10)),            # Connections kept open and reused
+    'max_overflow': int(os.getenv('DB_POOL_MAX_OVERFLOW', 10)), # Extra connections allowed under burst load
+    'timeout': float(os.getenv('DB_POOL_TIMEOUT', 30)),         # Seconds to wait for a free connection
+    'recycle': int(os.getenv('DB_POOL_RECYCLE', 3600)),         # Max age in seconds before a connection is replaced
+    'ping_after': int(os.getenv('DB_POOL_PING_AFTER', 30))      # Idle seconds after which a connection is health checked
+}
+
+
+class PooledConnection:
+    """Proxy around a pooled MySQL connection; close() returns it to the pool."""
+
+    def __init__(self, pool, raw_connection, created_at):
+        self._pool = pool
+        self._raw = raw_connection
+        self._created_at = created_at
+        self._pid = os.getpid()
+        self._returned = False
+
+    def __getattr__(self, name):
+        # Delegate cursor(), commit(), rollback(), etc. to the real connection
+        return getattr(self._raw, name)
+
+    def close(self):
+        if not self._returned:
+            self._returned = True
+            self._pool.release(self)
+
+
+class DatabaseConnectionPool:
+    def __init__(self, config, pool_size, max_overflow, timeout, recycle, ping_after):
+        self.config = config
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_after = ping_after
+        self._idle = []  # (raw_connection, created_at, last_used) tuples, most recently used last
+        self._open = 0
+        self._in_use = 0
+        self._condition = threading.Condition()
+        self._pid = os.getpid()
+        self._stats = {
+            'checkouts': 0,
+            'created': 0,
+            'recycled': 0,
+            'failed_health_checks': 0,
+            'waits': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+            'timeouts': 0
+        }
+
+    def _reset_after_fork(self):
+        # Sockets inherited from the parent process must never be shared with it
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = []
+            self._open = 0
+            self._in_use = 0
+
+    def _discard(self, raw_connection):
+        try:
+            raw_connection.close()
+        except Exception:
+            pass
+
+    def _is_healthy(self, raw_connection, created_at, last_used):
+        now = time.monotonic()
+        if now - created_at > self.recycle:
+            self._stats['recycled'] += 1
+            return False
+        if now - last_used > self.ping_after:
+            try:
+                raw_connection.ping(reconnect=False)
+            except Exception:
+                self._stats['failed_health_checks'] += 1
+                return False
+        return True
+
+    def acquire(self):
+        started = time.monotonic()
+        waited = False
+
+        with self._condition:
+            self._reset_after_fork()
+
+            while True:
+                # Reuse an idle connection if a healthy one is available
+                while self._idle:
+                    raw_connection, created_at, last_used = self._idle.pop()
+                    if self._is_healthy(raw_connection, created_at, last_used):
+                        self._in_use += 1
+                        self._stats['checkouts'] += 1
+                        self._record_wait(started, waited)
+                        return PooledConnection(self, raw_connection, created_at)
+                    self._open -= 1
+                    self._discard(raw_connection)
+
+                # Open a new connection if we are below pool_size + max_overflow
+                if self._open < self.pool_size + self.max_overflow:
+                    self._open += 1
+                    self._in_use += 1
+                    break
+
+                # Otherwise wait for another request to return a connection
+                remaining = self.timeout - (time.monotonic() - started)
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    raise TimeoutError(f"Timed out after {self.timeout}s waiting for a database connection")
+                waited = True
+                self._condition.wait(remaining)
+
+        # Connect outside the lock so slow handshakes don't block other checkouts
+        try:
+            raw_connection = mysql.connector.connect(**self.config)
+        except Exception:
+            with self._condition:
+                self._open -= 1
+                self._in_use -= 1
+                self._condition.notify()
+            raise
+
+        with self._condition:
+            self._stats['created'] += 1
+            self._stats['checkouts'] += 1
+            self._record_wait(started, waited)
+        return PooledConnection(self, raw_connection, time.monotonic())
+
+    def _record_wait(self, started, waited):
+        if waited:
+            wait_time = time.monotonic() - started
+            self._stats['waits'] += 1
+            self._stats['wait_time_total'] += wait_time
+            self._stats['wait_time_max'] = max(self._stats['wait_time_max'], wait_time)
+
+    def release(self, pooled_connection):
+        raw_connection = pooled_connection._raw
+        keep = True
+
+        # Never hand an open transaction to the next request
+        try:
+            if raw_connection.in_transaction:
+                raw_connection.rollback()
+        except Exception:
+            keep = False
+
+        with self._condition:
+            # Connections checked out before a fork belong to the parent process
+            if pooled_connection._pid != os.getpid():
+                return
+            self._in_use -= 1
+            if keep and len(self._idle) < self.pool_size:
+                self._idle.append((raw_connection, pooled_connection._created_at, time.monotonic()))
+            else:
+                # Overflow connections are closed instead of kept idle
+                self._open -= 1
+                self._discard(raw_connection)
+            self._condition.notify()
+
+    def stats(self):
+        with self._condition:
+            stats = dict(self._stats)
+            stats.update({
+                'pool_size': self.pool_size,
+                'max_overflow': self.max_overflow,
+                'open': self._open,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'wait_time_avg': stats['wait_time_total'] / stats['waits'] if stats['waits'] else 0.0
+            })
+            return stats
+
+
+db_pool = DatabaseConnectionPool(db_config, **db_pool_config)
+
+
+# Function to check out a pooled connection for the current request
 def get_db_connection():
-    return mysql.connector.connect(**db_config)
+    connection = db_pool.acquire()
+
+    # Track request-scoped checkouts so they are returned even if a route forgets to close them
+    if has_app_context():
+        g.setdefault('db_connections', []).append(connection)
+
+    return connection
+
+
+# Return any connections the request did not close itself
+@app.teardown_appcontext
+def release_db_connections(exception=None):
+    for connection in g.pop('db_connections', []):
+        connection.close()
 
 
 # MongoDB configuration
@@ -161,99 +840,620 @@ mongo_config = {
     'port': 27017,
     'username': os.getenv('MONGO_USER'),
     'password': os.getenv('MONGO_PASSWORD'),
-    'authSource': 'admin'
+    'authSource': 'admin',
+    'maxPoolSize': int(os.getenv('MONGO_MAX_POOL_SIZE', 50)),
+    'minPoolSize': int(os.getenv('MONGO_MIN_POOL_SIZE', 0)),
+    'maxIdleTimeMS': int(os.getenv('MONGO_MAX_IDLE_TIME_MS', 300000)),
+    'connectTimeoutMS': int(os.getenv('MONGO_CONNECT_TIMEOUT_MS', 5000)),
+    'serverSelectionTimeoutMS': int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000)),
+    'socketTimeoutMS': int(os.getenv('MONGO_SOCKET_TIMEOUT_MS', 30000))
 }
 
+# One MongoClient per worker process, created on first use
+_mongo_state = {
+    'client': None,
+    'pid': None,
+    'collections': None,
+    'named_collections': {}
+}
+_mongo_lock = threading.Lock()
+
 
 # Function to get MongoDB client
 def get_mongo_client():
-    client = MongoClient(
-        host=mongo_config['host'],
-        port=mongo_config['port'],
-        username=mongo_config['username'],
-        password=mongo_config['password'],
-        authSource=mongo_config['authSource']
-    )
-    return client
+    client = _mongo_state['client']
+    if client is not None and _mongo_state['pid'] == os.getpid():
+        return client
+
+    with _mongo_lock:
+        # A client inherited across fork() shares sockets and monitor threads with the parent,
+        # so each worker builds its own. Creating it lazily also ensures it is built after
+        # eventlet has monkey-patched the socket and threading modules.
+        if _mongo_state['client'] is None or _mongo_state['pid'] != os.getpid():
+            _mongo_state['client'] = MongoClient(connect=False, **mongo_config)
+            _mongo_state['pid'] = os.getpid()
+            _mongo_state['collections'] = None
+            _mongo_state['named_collections'] = {}
+        return _mongo_state['client']
 
 
 # Function to get MongoDB collections
 def get_mongo_collections():
     client = get_mongo_client()
-    db = client[os.getenv('MONGO_DATABASE')]
-    user_index_collection = db['user_index']
-    chat_history_collection = db['chat_history']
-    return user_index_collection, chat_history_collection
+    collections = _mongo_state['collections']
+
+    if collections is None:
+        db = client[os.getenv('MONGO_DATABASE')]
+        user_index_collection = db['user_index']
+        chat_history_collection = db['chat_history']
+        collections = (user_index_collection, chat_history_collection)
+        _mongo_state['collections'] = collections
+
+        # History pages are served from chat_messages now; drop the multikey index that only slowed down the legacy $push
+        try:
+            chat_history_collection.drop_index("user_history_timestamp")
+        except OperationFailure:
+            pass  # Already dropped, or never created
+
+    return collections
+
+
+# Function to get any other MongoDB collection by name
+def get_mongo_collection(name):
+    client = get_mongo_client()
+    collection = _mongo_state['named_collections'].get(name)
+
+    if collection is None:
+        collection = client[os.getenv('MONGO_DATABASE')][name]
+        _mongo_state['named_collections'][name] = collection
+
+    return collection
+
+
+# Function to close the worker's MongoDB client on shutdown
+def close_mongo_client():
+    with _mongo_lock:
+        client = _mongo_state['client']
+        if client is not None and _mongo_state['pid'] == os.getpid():
+            client.close()
+        _mongo_state['client'] = None
+        _mongo_state['pid'] = None
+        _mongo_state['collections'] = None
+        _mongo_state['named_collections'] = {}
+
+
+atexit.register(close_mongo_client)
+
+
+# Agent directory configuration
+agent_directory_config = {
+    'max_users': int(os.getenv('AGENT_DIRECTORY_MAX_USERS', 10000))   # Users whose agents are kept in memory
+}
+
+
+# In-memory LRU directory of each user's Letta agents, loaded from user_index with one projected query
+class AgentDirectory:
+    def __init__(self, max_users):
+        self.max_users = max_users
+        self._agents = OrderedDict()  # user_id -> {agent_name: agent_id}, least recently used first
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'loads': 0, 'evictions': 0}
+
+    def _store(self, user_id, agents):
+        with self._lock:
+            self._agents[user_id] = agents
+            self._agents.move_to_end(user_id)
+            while len(self._agents) > self.max_users:
+                self._agents.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def warm(self, user_id):
+        """Load all of the user's agents, replacing whatever is cached for them."""
+        user_index_collection, _ = get_mongo_collections()
+        user_index = user_index_collection.find_one({"user_id": user_id}, {"_id": 0, "UserAgents": 1})
+        agents = {agent["agent_name"]: agent["agent_id"] for agent in (user_index or {}).get("UserAgents", [])}
+        self._stats['loads'] += 1
+        self._store(user_id, agents)
+        return agents
+
+    def get(self, user_id, agent_name):
+        with self._lock:
+            agents = self._agents.get(user_id)
+            if agents is not None and agent_name in agents:
+                self._agents.move_to_end(user_id)
+                self._stats['hits'] += 1
+                return agents[agent_name]
+
+        # Misses are not cached: another worker may have just created the agent
+        self._stats['misses'] += 1
+        return self.warm(user_id).get(agent_name)
+
+    def add(self, user_id, agent_name, agent_id):
+        with self._lock:
+            agents = self._agents.get(user_id)
+            if agents is not None:
+                agents.setdefault(agent_name, agent_id)  # Mirrors save_user_agent, which keeps an existing entry
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._agents.pop(user_id, None)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, users=len(self._agents))
+
+
+agent_directory = AgentDirectory(**agent_directory_config)
 
 
 # Function to save user agent in MongoDB
 def save_user_agent(user_id, agent_name, agent_id):
     user_index_collection, _ = get_mongo_collections()
-    user_index = user_index_collection.find_one({"user_id": user_id})
+    agent_names = {"$ifNull": ["$UserAgents.agent_name", []]}
+    user_agents = {"$ifNull": ["$UserAgents", []]}
 
-    if not user_index:
-        # If no user index exists, create a new one
-        user_index = {
-            "user_id": user_id,
-            "UserAgents": [],
-            "ChatHistory": []
-        }
-        user_index_collection.insert_one(user_index)
-    
-    # Ensure the UserAgents field is created if it doesn't exist
+    # One upsert that creates the user index if needed and appends the agent unless it is already listed
     user_index_collection.update_one(
         {"user_id": user_id},
-        {"$setOnInsert": {"UserAgents": []}}
+        [{"$set": {
+            "UserAgents": {"$cond": [
+                {"$in": [agent_name, agent_names]},
+                user_agents,
+                {"$concatArrays": [user_agents, [{"agent_name": agent_name, "agent_id": agent_id}]]}
+            ]},
+            "ChatHistory": {"$ifNull": ["$ChatHistory", []]}
+        }}],
+        upsert=True
     )
 
-    # If agent_name is not already in UserAgents[], add it
-    if not any(agent["agent_name"] == agent_name for agent in user_index["UserAgents"]):
-        agent_metadata = {
-            "agent_name": agent_name,
-            "agent_id": agent_id
-        }
-        user_index_collection.update_one(
-            {"user_id": user_id},
-            {"$push": {"UserAgents": agent_metadata}},
-            upsert=True  # Create the document if it doesn't exist
-        )
+    agent_directory.add(user_id, agent_name, agent_id)
 
 
 # Function to get agent_id by user_id and agent_name
 def get_agent_id(user_id, agent_name):
-    user_index_collection, _ = get_mongo_collections()
-    user_index = user_index_collection.find_one({"user_id": user_id})
-    if user_index:
-        for agent in user_index["UserAgents"]:
-            if agent["agent_name"] == agent_name:
-                return agent["agent_id"]
-    return None
+    return agent_directory.get(user_id, agent_name)
 
 
-# Function to save chat message in MongoDB
-def save_chat_message(user_id, sender, sender_name, message, tokens_used=None):
-    user_index_collection, chat_history_collection = get_mongo_collections()
-    today = datetime.now(timezone.utc).strftime('%m-%d-%Y')
-    document_id = f"{user_id}Chat{today}"
+# Chat message storage configuration
+chat_storage_config = {
+    'collection': os.getenv('CHAT_MESSAGES_COLLECTION', 'chat_messages'),                     # One document per chat message
+    'timeseries': os.getenv('CHAT_MESSAGES_TIMESERIES', 'False').lower() in ['true', '1'],     # Create the collection as a MongoDB time-series collection
+    'dual_write': os.getenv('CHAT_HISTORY_DUAL_WRITE', 'True').lower() in ['true', '1'],       # Keep writing the legacy per-day documents while migrating
+    'backfill_batch_size': int(os.getenv('CHAT_BACKFILL_BATCH_SIZE', 1000))                     # Messages inserted per batch when backfilling
+}
 
-    # Retrieve existing user document
-    user_index = user_index_collection.find_one({"user_id": user_id})
+chat_migration_flight = SingleFlight()
+_migrated_chat_users = set()  # Users whose legacy history is known to be backfilled in this process
 
-    if user_index:
-        # Store UserAgents array in a variable to avoid overwriting
-        user_agents = user_index.get("UserAgents", [])
-    else:
-        # If no user document exists, create a new user index with default fields
-        user_agents = []
-        user_index = {
-            "user_id": user_id,
-            "UserAgents": user_agents,
-            "ChatHistory": []
+
+# Function to get the per-message chat collection, creating it and its index on first use in each process
+def get_chat_messages_collection():
+    name = chat_storage_config['collection']
+    if name in _mongo_state['named_collections'] and _mongo_state['pid'] == os.getpid():
+        return _mongo_state['named_collections'][name]
+
+    collection = get_mongo_collection(name)
+
+    try:
+        if chat_storage_config['timeseries'] and name not in collection.database.list_collection_names():
+            collection.database.create_collection(name, timeseries={
+                'timeField': 'timestamp',
+                'metaField': 'user_id',
+                'granularity': 'minutes'
+            })
+        # _id breaks ties between messages saved in the same millisecond, in the order they were buffered
+        collection.create_index([("user_id", 1), ("timestamp", 1), ("_id", 1)], name="user_timestamp")
+    except CollectionInvalid:
+        pass  # Another worker created it first
+    except Exception as e:
+        print(f"Error preparing {name} collection: {e}")
+
+    return collection
+
+
+# Token usage counter and quota configuration (a quota of 0 means unlimited)
+token_usage_config = {
+    'daily_quota': int(os.getenv('TOKEN_QUOTA_DAILY', 0)),                      # Tokens a user may use per UTC day
+    'monthly_quota': int(os.getenv('TOKEN_QUOTA_MONTHLY', 0)),                  # Tokens a user may use per UTC month
+    'flush_interval': float(os.getenv('TOKEN_USAGE_FLUSH_INTERVAL', 1.0)),      # Seconds between counter flushes
+    'quota_cache_ttl': int(os.getenv('TOKEN_QUOTA_CACHE_TTL', 60))              # Seconds a user's quota override is cached
+}
+
+
+# Keeps per-user token usage as daily and monthly counters, incremented in memory and flushed with $inc
+class TokenUsageCounters:
+    def __init__(self, daily_quota, monthly_quota, flush_interval, quota_cache_ttl):
+        self.daily_quota = daily_quota
+        self.monthly_quota = monthly_quota
+        self.flush_interval = flush_interval
+        self.quota_cache_ttl = quota_cache_ttl
+        self._deltas = {}         # (user_id, period, key) -> tokens not yet written
+        self._quota_cache = {}    # user_id -> (expires_at, override)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flusher_pid = None
+        self._indexed = False
+        self._stats = {'recorded_tokens': 0, 'flushes': 0, 'flush_failures': 0, 'quota_rejections': 0}
+
+    def _collection(self):
+        collection = get_mongo_collection('token_usage')
+        if not self._indexed:
+            try:
+                collection.create_index([("user_id", 1), ("period", 1), ("key", 1)], name="user_period_key")
+            except Exception as e:
+                print(f"Error creating token usage index: {e}")
+            self._indexed = True
+        return collection
+
+    def _ensure_flusher(self):
+        # Start the flusher once per process, on first use
+        if self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid != os.getpid():
+                self._flusher_pid = os.getpid()
+                socketio.start_background_task(self._flush_loop)
+
+    def record(self, user_id, tokens, when):
+        """Add tokens to the user's counters for the UTC day and month of `when`."""
+        if not tokens:
+            return
+        self._ensure_flusher()
+
+        with self._lock:
+            for period, key in (('day', when.strftime('%Y-%m-%d')), ('month', when.strftime('%Y-%m'))):
+                self._deltas[(user_id, period, key)] = self._deltas.get((user_id, period, key), 0) + tokens
+            self._stats['recorded_tokens'] += tokens
+
+    def _flush_loop(self):
+        while True:
+            socketio.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error flushing token usage counters: {e}")
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                deltas, self._deltas = self._deltas, {}
+            if not deltas:
+                return
+
+            items = list(deltas.items())
+            try:
+                self._collection().bulk_write([
+                    UpdateOne(
+                        {"_id": f"{user_id}:{key}"},
+                        {
+                            "$inc": {"tokens": tokens},
+                            "$setOnInsert": {"user_id": user_id, "period": period, "key": key}
+                        },
+                        upsert=True
+                    )
+                    for (user_id, period, key), tokens in items
+                ], ordered=True)
+            except Exception as e:
+                # Increments are additive, so whatever did not land is merged back for the next flush
+                failed_from = 0
+                if isinstance(e, BulkWriteError) and e.details.get("writeErrors"):
+                    failed_from = e.details["writeErrors"][0]["index"]
+                with self._lock:
+                    for (counter, tokens) in items[failed_from:]:
+                        self._deltas[counter] = self._deltas.get(counter, 0) + tokens
+                self._stats['flush_failures'] += 1
+                raise
+
+            self._stats['flushes'] += 1
+
+    def _read(self, user_id, counters):
+        # Stored counters plus increments still waiting for a flush
+        stored = {}
+        if counters:
+            for document in self._collection().find({"_id": {"$in": [f"{user_id}:{key}" for _, key in counters]}}, {"tokens": 1}):
+                stored[document["_id"]] = document["tokens"]
+
+        with self._lock:
+            return sum(stored.get(f"{user_id}:{key}", 0) + self._deltas.get((user_id, period, key), 0) for period, key in counters)
+
+    def get_usage(self, user_id, start_date, end_date):
+        """Total tokens between two dates, inclusive, reading whole months from the monthly counters."""
+        counters = []
+        day = date(start_date.year, start_date.month, start_date.day)
+        end = date(end_date.year, end_date.month, end_date.day)
+
+        while day <= end:
+            month_end = (day.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+            if day.day == 1 and month_end <= end:
+                counters.append(('month', day.strftime('%Y-%m')))
+                day = month_end + timedelta(days=1)
+            else:
+                counters.append(('day', day.strftime('%Y-%m-%d')))
+                day += timedelta(days=1)
+
+        return self._read(user_id, counters)
+
+    def get_current_usage(self, user_id, now=None):
+        now = now or datetime.now(timezone.utc)
+        return {
+            'today': self._read(user_id, [('day', now.strftime('%Y-%m-%d'))]),
+            'this_month': self._read(user_id, [('month', now.strftime('%Y-%m'))])
         }
-        user_index_collection.insert_one(user_index)
 
-    # Insert or update the chat history document
+    def get_quota(self, user_id):
+        """The user's quotas: the TokenQuota override in their user index, else the configured defaults."""
+        cached = self._quota_cache.get(user_id)
+        if cached and cached[0] > time.monotonic():
+            override = cached[1]
+        else:
+            user_index_collection, _ = get_mongo_collections()
+            user_index = user_index_collection.find_one({"user_id": user_id}, {"TokenQuota": 1})
+            override = (user_index or {}).get("TokenQuota") or {}
+            self._quota_cache[user_id] = (time.monotonic() + self.quota_cache_ttl, override)
+
+        return {
+            'daily': override.get('daily', self.daily_quota),
+            'monthly': override.get('monthly', self.monthly_quota)
+        }
+
+    def check_quota(self, user_id):
+        """Returns an error message if the user has used up a quota, otherwise None."""
+        quota = self.get_quota(user_id)
+        if not quota['daily'] and not quota['monthly']:
+            return None
+
+        usage = self.get_current_usage(user_id)
+        if quota['daily'] and usage['today'] >= quota['daily']:
+            self._stats['quota_rejections'] += 1
+            return "You've reached your daily message limit. It resets at midnight UTC."
+        if quota['monthly'] and usage['this_month'] >= quota['monthly']:
+            self._stats['quota_rejections'] += 1
+            return "You've reached your monthly message limit. It resets on the first of the month (UTC)."
+        return None
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, pending_counters=len(self._deltas))
+
+
+token_usage = TokenUsageCounters(**token_usage_config)
+atexit.register(token_usage.flush)  # Registered after close_mongo_client, so it runs first at exit
+
+
+# Chat write-behind configuration
+chat_write_config = {
+    'batch_size': int(os.getenv('CHAT_WRITE_BATCH_SIZE', 100)),                 # Flush as soon as this many messages are buffered
+    'flush_interval': float(os.getenv('CHAT_WRITE_FLUSH_INTERVAL', 0.5)),       # Seconds a message may wait in the buffer
+    'max_pending': int(os.getenv('CHAT_WRITE_MAX_PENDING', 10000)),             # Above this, writers flush inline instead of buffering more
+    'max_retries': int(os.getenv('CHAT_WRITE_MAX_RETRIES', 5)),                 # Failed flushes a message sits through before it is written on its own
+    'retry_backoff': float(os.getenv('CHAT_WRITE_RETRY_BACKOFF', 1.0)),         # Seconds before the first retry, doubled per consecutive failure
+    'max_retry_backoff': float(os.getenv('CHAT_WRITE_MAX_RETRY_BACKOFF', 30))   # Upper bound on the wait between retries
+}
+
+
+# Buffers chat messages in memory and writes them to MongoDB in bulk from a background flusher
+class ChatWriteBuffer:
+    def __init__(self, batch_size, flush_interval, max_pending, max_retries, retry_backoff, max_retry_backoff):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.max_retry_backoff = max_retry_backoff
+        self._pending = []
+        self._pending_users = set()
+        self._flushing_users = set()
+        self._requeued = False  # The buffer holds a failed batch, parts of which may already be written
+        self._attempts = {}     # message _id -> failed flushes it was part of
+        self._consecutive_failures = 0
+        self._retry_at = 0.0    # The background flusher waits until then after a failure
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # One flush at a time, so batches land in order
+        self._wakeup = threading.Event()
+        self._flusher_pid = None
+        self._stats = {'buffered': 0, 'flushes': 0, 'flushed_messages': 0, 'flush_failures': 0, 'inline_flushes': 0, 'flush_time_total': 0.0,
+                       'isolated_writes': 0, 'dead_lettered': 0}
+
+    def _ensure_flusher(self):
+        # Start the flusher once per process, on first use
+        if self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid != os.getpid():
+                self._flusher_pid = os.getpid()
+                socketio.start_background_task(self._flush_loop)
+
+    def add(self, chat_entry):
+        self._ensure_flusher()
+
+        with self._lock:
+            self._pending.append(chat_entry)
+            self._pending_users.add(chat_entry["user_id"])
+            self._stats['buffered'] += 1
+            pending = len(self._pending)
+
+        if pending >= self.max_pending:
+            # MongoDB is falling behind; make the writer wait rather than grow the buffer without bound
+            self._stats['inline_flushes'] += 1
+            self.flush()
+        elif pending >= self.batch_size:
+            self._wakeup.set()
+
+    def _flush_loop(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if time.monotonic() < self._retry_at:
+                continue  # Back off after a failed flush; reads and backpressure still flush inline
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error flushing chat messages: {e}")
+
+    def flush_user(self, user_id):
+        """Flush if the user has buffered messages, so reads see everything they sent."""
+        if user_id in self._pending_users or user_id in self._flushing_users:
+            self.flush()  # Also waits out a flush that is already writing the user's messages
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                self._flushing_users, self._pending_users = self._pending_users, set()
+            if not batch:
+                return
+
+            started = time.monotonic()
+            try:
+                write_chat_batch(batch, retried=self._requeued)
+                self._requeued = False
+                self._consecutive_failures = 0
+                if self._attempts:
+                    for entry in batch:
+                        self._attempts.pop(entry["_id"], None)
+            except Exception:
+                self._stats['flush_failures'] += 1
+                self._consecutive_failures += 1
+                self._retry_at = time.monotonic() + min(self.retry_backoff * 2 ** (self._consecutive_failures - 1), self.max_retry_backoff)
+
+                for entry in batch:
+                    self._attempts[entry["_id"]] = self._attempts.get(entry["_id"], 0) + 1
+                retry = [entry for entry in batch if self._attempts[entry["_id"]] < self.max_retries]
+
+                # Messages that keep failing are written one by one, so a message that can never be written
+                # (e.g. a legacy day document at the 16 MB limit) is set aside instead of holding up everyone else
+                exhausted = [entry for entry in batch if self._attempts[entry["_id"]] >= self.max_retries]
+                if exhausted:
+                    retry += self._write_individually(exhausted)
+
+                # Put the rest back in front of anything buffered since. The retry (merged with those newer messages)
+                # skips whatever already landed: inserts by preassigned _id, legacy entries by message_id, user index via $addToSet
+                if retry:
+                    with self._lock:
+                        self._pending = retry + self._pending
+                        self._pending_users.update(entry["user_id"] for entry in retry)
+                        self._requeued = True
+                    raise
+                self._requeued = False
+                return
+            finally:
+                self._flushing_users = set()
+
+            self._stats['flushes'] += 1
+            self._stats['flushed_messages'] += len(batch)
+            self._stats['flush_time_total'] += time.monotonic() - started
+
+    def _write_individually(self, entries):
+        """Write each message on its own, dead-lettering the ones that still fail; returns those that could not even be dead-lettered."""
+        remaining = []
+        for entry in entries:
+            try:
+                write_chat_batch([entry], retried=True)
+                self._stats['isolated_writes'] += 1
+            except Exception as e:
+                try:
+                    dead_letter_chat_message(entry, self._attempts[entry["_id"]], e)
+                    self._stats['dead_lettered'] += 1
+                except Exception as dead_letter_error:
+                    print(f"Error dead-lettering chat message {entry['_id']}: {dead_letter_error}")
+                    remaining.append(entry)  # MongoDB is unreachable; keep it and try again later
+                    continue
+            self._attempts.pop(entry["_id"], None)
+        return remaining
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, pending=len(self._pending))
+        stats['avg_batch_size'] = stats['flushed_messages'] / stats['flushes'] if stats['flushes'] else 0.0
+        return stats
+
+
+# Function to set aside a chat message that could not be written after repeated attempts
+def dead_letter_chat_message(entry, attempts, error):
+    print(f"Chat message {entry['_id']} for user {entry['user_id']} failed after {attempts} attempt(s): {error}")
+    get_mongo_collection('chat_write_dead_letters').insert_one({
+        "message": entry,
+        "user_id": entry["user_id"],
+        "attempts": attempts,
+        "last_error": str(error),
+        "failed_at": datetime.now(timezone.utc)
+    })
+
+
+# Function to write a batch of buffered chat messages with one bulk write per collection
+def write_chat_batch(batch, retried=False):
+    # Message _ids are assigned when buffering, so a retried insert only skips what already landed
+    insert_chat_messages(get_chat_messages_collection(), [dict(entry) for entry in batch])
+
+    if not chat_storage_config['dual_write']:
+        return
+
+    user_index_collection, chat_history_collection = get_mongo_collections()
+    day_entries = OrderedDict()   # document_id -> entries, in arrival order
+    user_documents = OrderedDict()  # user_id -> document_ids touched by this batch
+
+    for entry in batch:
+        document_id = f"{entry['user_id']}Chat{entry['timestamp'].strftime('%m-%d-%Y')}"
+        legacy_entry = {key: value for key, value in entry.items() if key != "_id"}
+        legacy_entry["message_id"] = entry["_id"]
+        day_entries.setdefault(document_id, []).append(legacy_entry)
+        user_documents.setdefault(entry["user_id"], set()).add(document_id)
+
+    # A retried batch must not append the same entries twice, but may also carry newer entries for the same day.
+    # So on a retry, drop the entries each day document already holds and push only the rest
+    if retried:
+        written = {
+            document["document_id"]: {item.get("message_id") for item in document.get("chat_history", [])}
+            for document in chat_history_collection.find(
+                {"document_id": {"$in": list(day_entries)}},
+                {"document_id": 1, "chat_history.message_id": 1}
+            )
+        }
+        for document_id in list(day_entries):
+            entries = [entry for entry in day_entries[document_id] if entry["message_id"] not in written.get(document_id, ())]
+            if entries:
+                day_entries[document_id] = entries
+            else:
+                del day_entries[document_id]
+
+    # Each push is still guarded on the ids it carries, and is atomic per day document. The document is created by a
+    # separate upsert, since an upsert on the guarded filter would create a duplicate day document
+    day_operations = []
+    for document_id, entries in day_entries.items():
+        day_operations.append(UpdateOne(
+            {"document_id": document_id},
+            {"$setOnInsert": {"user_id": entries[0]["user_id"], "chat_history": []}},
+            upsert=True  # Create the document if it doesn't exist
+        ))
+        day_operations.append(UpdateOne(
+            {"document_id": document_id, "chat_history.message_id": {"$nin": [entry["message_id"] for entry in entries]}},
+            {"$push": {"chat_history": {"$each": entries}}}
+        ))
+    if day_operations:
+        chat_history_collection.bulk_write(day_operations, ordered=True)
+
+    # Create the user index if needed and reference the day documents, without touching UserAgents
+    user_index_collection.bulk_write([
+        UpdateOne(
+            {"user_id": user_id},
+            {
+                "$addToSet": {"ChatHistory": {"$each": sorted(document_ids)}},
+                "$setOnInsert": {"UserAgents": []}
+            },
+            upsert=True
+        )
+        for user_id, document_ids in user_documents.items()
+    ])
+
+
+chat_writes = ChatWriteBuffer(**chat_write_config)
+atexit.register(chat_writes.flush)  # Registered after close_mongo_client, so it runs first at exit
+
+
+# Function to save chat message in MongoDB
+def save_chat_message(user_id, sender, sender_name, message, tokens_used=None):
     chat_entry = {
+        "_id": ObjectId(),
         "timestamp": datetime.now(timezone.utc),
         "sender": sender,
         "sender_name": sender_name,
@@ -262,76 +1462,320 @@ def save_chat_message(user_id, sender, sender_name, message, tokens_used=None):
         "user_id": user_id
     }
 
-    chat_history_collection.update_one(
-        {"document_id": document_id},
-        {
-            "$push": {"chat_history": chat_entry},
-            "$setOnInsert": {"user_id": user_id}
-        },
-        upsert=True  # Create the document if it doesn't exist
+    # Written in the background by the next flush
+    chat_writes.add(chat_entry)
+
+    if chat_entry["token_use"]:
+        token_usage.record(user_id, chat_entry["token_use"], chat_entry["timestamp"])
+
+
+# Function to copy a user's legacy per-day chat history into the per-message collection
+def backfill_user_chat_history(user_id):
+    user_index_collection, chat_history_collection = get_mongo_collections()
+    messages_collection = get_chat_messages_collection()
+
+    # Taken before anything else: messages saved from here on are dual-written by the live path while we scan
+    scan_started = datetime.now(timezone.utc).replace(tzinfo=None)
+    chat_writes.flush_user(user_id)
+
+    # Messages from the first live write onwards were dual-written, so only older entries are copied.
+    # With no live write yet, the scan start is the cutoff, so a message saved during the scan is never copied too
+    first_live = messages_collection.find_one(
+        {"user_id": user_id, "backfilled": {"$ne": True}},
+        {"timestamp": 1},
+        sort=[("timestamp", 1)]
     )
+    cutoff = min(first_live["timestamp"], scan_started) if first_live else scan_started
+
+    copied = 0
+    batch = []
+    for document in chat_history_collection.find({"user_id": user_id}, {"document_id": 1, "chat_history": 1}):
+        for position, entry in enumerate(document.get("chat_history", [])):
+            # Entries with a message_id were dual-written, and chat_messages is written before the legacy document,
+            # so the live copy already exists under that _id
+            if entry["timestamp"] >= cutoff or entry.get("message_id"):
+                continue
+
+            # Older entries get a stable positional _id, so re-running an interrupted backfill cannot copy a message twice
+            message = dict(entry)
+            message.update(_id=f"{document['document_id']}:{position}", user_id=user_id, backfilled=True)
+            batch.append(message)
+            if len(batch) >= chat_storage_config['backfill_batch_size']:
+                copied += insert_chat_messages(messages_collection, batch)
+                batch = []
+
+    if batch:
+        copied += insert_chat_messages(messages_collection, batch)
 
-    # Update user index to add reference to the new or updated chat history document
-    # and ensure that UserAgents is maintained correctly
     user_index_collection.update_one(
         {"user_id": user_id},
         {
-            "$addToSet": {"ChatHistory": document_id},  # Add to ChatHistory if not already present
-            "$set": {"UserAgents": user_agents}         # Ensure UserAgents is preserved
+            "$set": {"ChatMigrated": True},
+            "$setOnInsert": {"UserAgents": [], "ChatHistory": []}
         },
         upsert=True
     )
+    _migrated_chat_users.add(user_id)
+    return copied
 
 
-# Function to retrieve all user logs sorted chronologically in JSON format
-def get_all_user_logs(user_id):
-    _, chat_history_collection = get_mongo_collections()
-    # Sorting by "date" and also sorting each chat_history entry by "timestamp"
-    chat_documents = chat_history_collection.find({"user_id": user_id}).sort("document_id")
-    all_logs = []
-
-    for document in chat_documents:
-        sorted_chat_history = sorted(document["chat_history"], key=lambda x: x["timestamp"])
-        all_logs.append({
-            "document_id": document["document_id"],
-            "chat_history": sorted_chat_history
-        })
+# Function to insert a batch of chat messages, skipping ones an earlier attempt already wrote
+def insert_chat_messages(messages_collection, batch):
+    try:
+        return len(messages_collection.insert_many(batch, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+            raise
+        return e.details.get("nInserted", 0)
 
-    return json.dumps(all_logs, default=str, indent=4)
 
+# Function to make sure a user's history has been backfilled before reading it from the new layout
+def ensure_chat_history_migrated(user_id):
+    if user_id in _migrated_chat_users:
+        return
 
-# Function to calculate tokens for a given message
-def calculate_message_tokens(message):
-    # Set encoding model to GPT-4o-mini
-    tokenizer = tiktoken.get_encoding("cl100k_base")
+    user_index_collection, _ = get_mongo_collections()
+    if user_index_collection.find_one({"user_id": user_id, "ChatMigrated": True}, {"_id": 1}):
+        _migrated_chat_users.add(user_id)
+        return
+
+    copied = chat_migration_flight.do(user_id, backfill_user_chat_history, user_id)
+    print(f"Backfilled {copied} chat messages for user {user_id}")
 
-    # Tokenize the message  
-    tokens = tokenizer.encode(message)
 
-    # Return the number of tokens
-    return len(tokens)
+# Flask CLI command to backfill every user's legacy chat history ahead of time
+@app.cli.command('migrate-chat-history')
+def migrate_chat_history_command():
+    """Copy legacy per-day chat history documents into the per-message collection."""
+    user_index_collection, chat_history_collection = get_mongo_collections()
+    migrated = set(user_index_collection.distinct("user_id", {"ChatMigrated": True}))
 
+    users = 0
+    messages = 0
+    for user_id in chat_history_collection.distinct("user_id"):
+        if user_id in migrated:
+            continue
+        messages += backfill_user_chat_history(user_id)
+        users += 1
 
-# Function to calculate the total sum of all tokens of a user between two dates
-def calculate_token_usage(user_id, start_date, end_date):
+    print(f"Backfilled {messages} chat messages for {users} users")
+
+
+# Chat history paging configuration
+chat_history_page_config = {
+    'default_limit': int(os.getenv('CHAT_HISTORY_PAGE_SIZE', 50)),      # Messages per page when the client doesn't ask for a size
+    'max_limit': int(os.getenv('CHAT_HISTORY_MAX_PAGE_SIZE', 200))      # Largest page a client may request
+}
+
+
+# Function to parse a history cursor (an ISO 8601 UTC timestamp) into the naive UTC datetime stored in MongoDB
+def parse_history_cursor(before):
+    if not before:
+        return None
+    cursor = datetime.fromisoformat(before.replace('Z', '+00:00'))
+    if cursor.tzinfo is not None:
+        cursor = cursor.astimezone(timezone.utc).replace(tzinfo=None)
+    return cursor
+
+
+# Function to retrieve one page of a user's chat history, newest messages first, older than the cursor
+def get_user_log_page(user_id, before=None, limit=None):
+    ensure_chat_history_migrated(user_id)
+    chat_writes.flush_user(user_id)
+    messages_collection = get_chat_messages_collection()
+    limit = max(1, min(limit or chat_history_page_config['default_limit'], chat_history_page_config['max_limit']))
+    projection = {"backfilled": 0}
+    newest_first = [("timestamp", -1), ("_id", -1)]
+
+    query = {"user_id": user_id}
+    if before is not None:
+        query["timestamp"] = {"$lt": before}
+
+    # Read one extra message to learn whether an older page exists
+    messages = list(messages_collection.find(query, projection).sort(newest_first).limit(limit + 1))
+    has_more = len(messages) > limit
+    page = messages[:limit]
+
+    # Never split messages that share a timestamp across pages, or the cursor would skip them
+    if has_more and messages[limit]["timestamp"] == page[-1]["timestamp"]:
+        boundary = page[-1]["timestamp"]
+        ties = list(messages_collection.find({"user_id": user_id, "timestamp": boundary}, projection).sort(newest_first))
+        page = [entry for entry in page if entry["timestamp"] != boundary] + ties
+        has_more = messages_collection.find_one({"user_id": user_id, "timestamp": {"$lt": boundary}}, {"_id": 1}) is not None
+
+    return {
+        "messages": [
+            {key: value for key, value in entry.items() if key != "_id"} | {"timestamp": entry["timestamp"].isoformat()}
+            for entry in reversed(page)
+        ],
+        "next_before": page[-1]["timestamp"].isoformat() if page else None,
+        "has_more": has_more
+    }
+
+
+# Tokenizer configuration
+token_counter_config = {
+    'model': os.getenv('TOKENIZER_MODEL', 'gpt-4o-mini'),                        # Model the Letta agents run, used to pick the encoding
+    'fallback_encoding': os.getenv('TOKENIZER_FALLBACK_ENCODING', 'o200k_base'),  # Encoding for models tiktoken doesn't know
+    'batch_threads': int(os.getenv('TOKENIZER_BATCH_THREADS', 4)),                # Threads encode_batch may use
+    'processes': int(os.getenv('TOKENIZER_PROCESSES', os.cpu_count() or 2))       # Worker processes for bulk counting
+}
+
+
+# Counts tokens with encodings that are loaded once per process and picked by model name
+class TokenCounter:
+    def __init__(self, model, fallback_encoding, batch_threads, processes):
+        self.model = model
+        self.fallback_encoding = fallback_encoding
+        self.batch_threads = batch_threads
+        self.processes = processes
+        self._encodings = {}  # model -> tiktoken.Encoding
+        self._lock = threading.Lock()
+
+    def encoding(self, model=None):
+        model = model or self.model
+        encoding = self._encodings.get(model)
+        if encoding is None:
+            with self._lock:
+                encoding = self._encodings.get(model)
+                if encoding is None:
+                    try:
+                        encoding = tiktoken.encoding_for_model(model)
+                    except KeyError:
+                        encoding = tiktoken.get_encoding(self.fallback_encoding)
+                    self._encodings[model] = encoding
+        return encoding
+
+    def warm(self):
+        """Load the default encoding now, so the first chat message doesn't pay for it."""
+        try:
+            self.encoding()
+        except Exception as e:
+            print(f"Error loading tokenizer for {self.model}: {e}")
+
+    def count(self, text, model=None):
+        # Special-token text such as "<|endoftext|>" in a message is counted as ordinary text instead of raising
+        return len(self.encoding(model).encode(text, disallowed_special=()))
+
+    def count_batch(self, texts, model=None):
+        encoded = self.encoding(model).encode_batch(list(texts), num_threads=self.batch_threads, disallowed_special=())
+        return [len(tokens) for tokens in encoded]
+
+    def count_parallel(self, texts, model=None, chunk_size=1000):
+        """Count a large list of texts across a process pool; for CLI backfills, not the request path."""
+        texts = list(texts)
+        if len(texts) <= chunk_size or self.processes <= 1:
+            return self.count_batch(texts, model)
+
+        chunks = [texts[start:start + chunk_size] for start in range(0, len(texts), chunk_size)]
+        with ProcessPoolExecutor(max_workers=self.processes, initializer=init_token_count_worker, initargs=(model or self.model,)) as pool:
+            return [count for chunk_counts in pool.map(count_tokens_chunk, chunks) for count in chunk_counts]
+
+
+# Process pool initializer that loads the encoding once per worker process
+def init_token_count_worker(model):
+    token_counter.model = model
+    token_counter.batch_threads = 1  # The pool already uses every core
+    token_counter.encoding()
+
+
+# Function to count a chunk of texts inside a process pool worker
+def count_tokens_chunk(texts):
+    return token_counter.count_batch(texts)
+
+
+token_counter = TokenCounter(**token_counter_config)
+token_counter.warm()
+
+
+# Function to calculate tokens for a given message
+def calculate_message_tokens(message):
+    return token_counter.count(message)
+
+
+# Flask CLI command to fill in missing token counts on stored agent replies
+@app.cli.command('backfill-token-use')
+@click.option('--batch-size', default=5000, help='Messages counted and updated per batch.')
+def backfill_token_use_command(batch_size):
+    """Set token_use on agent messages that were saved without it, counting in a process pool."""
+    messages_collection = get_chat_messages_collection()
+    query = {"sender": "Agent", "$or": [{"token_use": None}, {"token_use": {"$exists": False}}]}
+    updated = 0
+
+    def write_batch(batch):
+        counts = token_counter.count_parallel([entry.get("message") or "" for entry in batch])
+        messages_collection.bulk_write([
+            UpdateOne({"_id": entry["_id"]}, {"$set": {"token_use": count}})
+            for entry, count in zip(batch, counts)
+        ], ordered=False)
+        return len(batch)
+
+    batch = []
+    for entry in messages_collection.find(query, {"message": 1}):
+        batch.append(entry)
+        if len(batch) >= batch_size:
+            updated += write_batch(batch)
+            batch = []
+    if batch:
+        updated += write_batch(batch)
+
+    print(f"Set token_use on {updated} messages; run 'flask rebuild-token-usage' to refresh the usage counters")
+
+
+# Flask CLI command to compare per-call tokenizer cost before and after caching the encoding
+@app.cli.command('benchmark-tokenizer')
+@click.option('--iterations', default=2000, help='Messages counted per measurement.')
+def benchmark_tokenizer_command(iterations):
+    """Print the per-message cost of each way of counting tokens."""
+    messages = [f"Message {i}: hey, could you remind me what we talked about yesterday? " * (1 + i % 8) for i in range(iterations)]
+
+    def measure(label, fn):
+        started = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - started
+        print(f"{label:<40} {elapsed / iterations * 1e6:10.1f} us/message")
+
+    token_counter.warm()
+    measure("get_encoding per call (previous)", lambda: [len(tiktoken.get_encoding("cl100k_base").encode(m)) for m in messages])
+    measure("cached encoding, one call per message", lambda: [token_counter.count(m) for m in messages])
+    measure("cached encoding, encode_batch", lambda: token_counter.count_batch(messages))
+    measure(f"process pool ({token_counter.processes} workers)", lambda: token_counter.count_parallel(messages, chunk_size=max(1, iterations // token_counter.processes)))
+
+
+# Flask CLI command to rebuild the token usage counters from the stored chat messages
+@app.cli.command('rebuild-token-usage')
+def rebuild_token_usage_command():
+    """Recompute every daily and monthly token counter from chat_messages. Run while the app is idle."""
+    token_usage.flush()
+    usage_collection = token_usage._collection()
+    totals = {}
+
+    # Legacy history has to be in chat_messages before it can be counted
     _, chat_history_collection = get_mongo_collections()
-    start_date_str = start_date.strftime('%m-%d-%Y')
-    end_date_str = end_date.strftime('%m-%d-%Y')
+    for user_id in chat_history_collection.distinct("user_id"):
+        ensure_chat_history_migrated(user_id)
 
-    chat_documents = chat_history_collection.find({
-        "document_id": {
-            "$gte": f"{user_id}Chat{start_date_str}",
-            "$lte": f"{user_id}Chat{end_date_str}"
-        }
-    })
+    days = get_chat_messages_collection().aggregate([
+        {"$match": {"token_use": {"$gt": 0}}},
+        {"$group": {
+            "_id": {"user_id": "$user_id", "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$timestamp"}}},
+            "tokens": {"$sum": "$token_use"}
+        }}
+    ], allowDiskUse=True)
 
-    total_tokens = 0
-    for document in chat_documents:
-        for entry in document["chat_history"]:
-            if "token_use" in entry and entry["token_use"] is not None:
-                total_tokens += entry["token_use"]
+    for day in days:
+        user_id, key = day["_id"]["user_id"], day["_id"]["day"]
+        totals[(user_id, 'day', key)] = day["tokens"]
+        totals[(user_id, 'month', key[:7])] = totals.get((user_id, 'month', key[:7]), 0) + day["tokens"]
+
+    usage_collection.delete_many({})
+    for start in range(0, len(totals), 1000):
+        usage_collection.insert_many([
+            {"_id": f"{user_id}:{key}", "user_id": user_id, "period": period, "key": key, "tokens": tokens}
+            for (user_id, period, key), tokens in list(totals.items())[start:start + 1000]
+        ])
 
-    return total_tokens
+    print(f"Rebuilt {len(totals)} token usage counters")
 
 
 # REST API route to search Google using the Custom Search API
@@ -370,7 +1814,7 @@ def google_search():
         full_url = f"{base_url}?{urllib.parse.urlencode(params)}"
 
     # Send the request to Google's API
-    response = requests.get(full_url)
+    response = http_client.get(full_url)
     results = response.json()
 
     if "error" in results:
@@ -395,9 +1839,331 @@ def google_search():
     return jsonify(search_results)
 
 
-# REST API route to get the current weather using the OpenWeather API
-@app.route('/api/weather/current', methods=['GET'])
-def get_current_weather():
+# Shared geocoding cache stored in MongoDB so every worker benefits from every lookup
+class GeocodeCache:
+    # geocode.maps.co allows one request per second per API key
+    MIN_UPSTREAM_INTERVAL = 1.1
+
+    def __init__(self, collection_name):
+        self.collection_name = collection_name
+        self._upstream_lock = threading.Lock()
+        self._last_upstream_call = 0.0
+        self._stats = {'forward_hits': 0, 'forward_misses': 0, 'reverse_hits': 0, 'reverse_misses': 0, 'upstream_failures': 0}
+
+    @staticmethod
+    def _normalize(value):
+        return " ".join(str(value or "").split()).lower()
+
+    def make_key(self, city=None, state=None, country=None, postal_code=None):
+        country = self._normalize(country)
+        if postal_code:
+            postal_code = self._normalize(postal_code).replace(" ", "")
+            return f"postal:{country}:{postal_code}"
+        return f"address:{self._normalize(city)}|{self._normalize(state)}|{country}"
+
+    def _upstream_get(self, path, params):
+        # Space out upstream calls so back-to-back forward and reverse lookups are not rate limited
+        with self._upstream_lock:
+            wait = self.MIN_UPSTREAM_INTERVAL - (time.monotonic() - self._last_upstream_call)
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                params = dict(params, api_key=os.environ.get('GEOCODE_API_KEY'))
+                response = http_client.get(f"https://geocode.maps.co/{path}?{urllib.parse.urlencode(params)}")
+                return response.json()
+            except ValueError:
+                self._stats['upstream_failures'] += 1
+                return None
+            finally:
+                self._last_upstream_call = time.monotonic()
+
+    def resolve(self, city=None, state=None, country=None, postal_code=None, reverse=False):
+        """Return {'lat', 'lon', 'address'} for a location, or None if it cannot be geocoded.
+
+        'address' holds the reverse-geocoded address and is only looked up when reverse=True.
+        """
+        collection = get_mongo_collection(self.collection_name)
+        key = self.make_key(city, state, country, postal_code)
+        entry = collection.find_one({"_id": key})
+
+        if entry:
+            self._stats['forward_hits'] += 1
+        else:
+            self._stats['forward_misses'] += 1
+            if postal_code:
+                query = {"postalcode": postal_code, "country": country}
+            else:
+                query = {"city": city, "state": state, "country": country}
+
+            results = self._upstream_get("search", query)
+            if not results:
+                return None
+
+            entry = {
+                "_id": key,
+                "lat": results[0]['lat'],
+                "lon": results[0]['lon'],
+                "query": query,
+                "created_at": datetime.now(timezone.utc)
+            }
+            collection.update_one({"_id": key}, {"$setOnInsert": entry}, upsert=True)
+
+        if reverse:
+            if entry.get("address") is not None:
+                self._stats['reverse_hits'] += 1
+            else:
+                self._stats['reverse_misses'] += 1
+                result = self._upstream_get("reverse", {"lat": entry['lat'], "lon": entry['lon']})
+                if isinstance(result, dict) and "address" in result:
+                    # Store the reverse result alongside the forward result
+                    entry["address"] = result["address"]
+                    collection.update_one({"_id": key}, {"$set": {"address": entry["address"]}})
+
+        return {"lat": entry['lat'], "lon": entry['lon'], "address": entry.get("address")}
+
+    def stats(self):
+        return dict(self._stats)
+
+
+geocode_cache = GeocodeCache('geocode_cache')
+
+
+# Offline timezone lookup; timezonefinder bundles the timezone boundary polygons and a spatial index
+try:
+    from timezonefinder import TimezoneFinder
+except ImportError:
+    TimezoneFinder = None
+
+_timezone_finder = {'finder': None}
+_timezone_finder_lock = threading.Lock()
+
+
+# Function to get the worker's TimezoneFinder, loading its index on first use
+def get_timezone_finder():
+    if TimezoneFinder is None:
+        return None
+
+    if _timezone_finder['finder'] is None:
+        with _timezone_finder_lock:
+            if _timezone_finder['finder'] is None:
+                _timezone_finder['finder'] = TimezoneFinder(in_memory=True)
+    return _timezone_finder['finder']
+
+
+# Function to find the exact UTC second a zone's offset changes between two instants
+def find_offset_transition(zone, start, end):
+    low, high = int(start.timestamp()), int(end.timestamp())
+    start_offset = start.astimezone(zone).utcoffset()
+
+    while high - low > 1:
+        middle = (low + high) // 2
+        if datetime.fromtimestamp(middle, timezone.utc).astimezone(zone).utcoffset() == start_offset:
+            low = middle
+        else:
+            high = middle
+
+    return datetime.fromtimestamp(high, timezone.utc)
+
+
+# Function to compute the current or next DST interval for a zone, in UTC
+def get_dst_interval(zone_name, now=None):
+    zone = ZoneInfo(zone_name)
+    now = now or datetime.now(timezone.utc)
+
+    # Walk day by day from a year back to a year ahead and record every offset change, and whether the clocks went forward.
+    # The DST period is the one with the larger UTC offset; the dst() flag can't be trusted for zones with negative DST (Europe/Dublin)
+    transitions = []
+    day = (now - timedelta(days=366)).replace(hour=0, minute=0, second=0, microsecond=0)
+    previous = day.astimezone(zone)
+    while day < now + timedelta(days=366):
+        next_day = day + timedelta(days=1)
+        current = next_day.astimezone(zone)
+        if current.utcoffset() != previous.utcoffset():
+            transition = find_offset_transition(zone, day, next_day)
+            transitions.append((transition, current.utcoffset() > previous.utcoffset()))
+        day, previous = next_day, current
+
+    # Pair each clocks-forward transition with the following clocks-back one
+    for index, (start, forward) in enumerate(transitions):
+        if not forward:
+            continue
+        end = next((moment for moment, later_forward in transitions[index + 1:] if not later_forward), None)
+        if end is None:
+            break
+        if end > now:
+            return start, end
+
+    return None, None
+
+
+# Function to find the UTC moment of the nth (or last, n=-1) Sunday of a month at a given UTC hour
+def nth_sunday_utc(year, month, n, hour):
+    if n > 0:
+        first = datetime(year, month, 1, hour, tzinfo=timezone.utc)
+        return first + timedelta(days=(6 - first.weekday()) % 7 + 7 * (n - 1))
+    last = datetime(year, month + 1, 1, hour, tzinfo=timezone.utc) - timedelta(days=1)
+    return last - timedelta(days=(last.weekday() - 6) % 7)
+
+
+# Flask CLI command to check get_dst_interval against the DST rules of a few reference zones, e.g. after a tzdata upgrade
+@app.cli.command('check-dst')
+@click.option('--year', default=None, type=int, help='Year to check (defaults to the current year).')
+def check_dst_command(year):
+    """Compare computed DST intervals with each zone's published rule and exit non-zero on any mismatch."""
+    year = year or datetime.now(timezone.utc).year
+    winter = datetime(year, 1, 15, tzinfo=timezone.utc)
+    summer = datetime(year, 7, 1, tzinfo=timezone.utc)
+
+    # EU: last Sunday of March to last Sunday of October, 01:00 UTC
+    eu = (nth_sunday_utc(year, 3, -1, 1), nth_sunday_utc(year, 10, -1, 1))
+    expected = [
+        # Europe/Dublin uses negative DST (winter is the dst() period), but its clocks go forward in March like the UK
+        ("Europe/Dublin", winter, eu),
+        ("Europe/Dublin", summer, eu),
+        # US: second Sunday of March 02:00 EST to first Sunday of November 02:00 EDT
+        ("America/New_York", winter, (nth_sunday_utc(year, 3, 2, 7), nth_sunday_utc(year, 11, 1, 6))),
+        # New South Wales: first Sunday of October 02:00 AEST to first Sunday of April 03:00 AEDT (16:00 UTC the day before)
+        ("Australia/Sydney", winter, (nth_sunday_utc(year - 1, 10, 1, 16) - timedelta(days=1), nth_sunday_utc(year, 4, 1, 16) - timedelta(days=1))),
+        ("Asia/Tokyo", winter, (None, None))
+    ]
+
+    failures = 0
+    for zone_name, now, expected_interval in expected:
+        actual = get_dst_interval(zone_name, now)
+        ok = actual == expected_interval
+        failures += not ok
+        print(f"{'ok  ' if ok else 'FAIL'} {zone_name:<20} {now.date()}  {actual[0]} -> {actual[1]}")
+
+    if failures:
+        raise SystemExit(1)
+
+
+# Function to resolve the IANA zone and DST details stored on the Users table for a coordinate
+def resolve_timezone(latitude, longitude):
+    finder = get_timezone_finder()
+    zone_name = finder.timezone_at(lat=float(latitude), lng=float(longitude)) if finder else None
+
+    if zone_name is None:
+        # Fall back to timeapi.io when the offline index is unavailable
+        return resolve_timezone_upstream(latitude, longitude)
+
+    dst_start, dst_end = get_dst_interval(zone_name)
+    if dst_start:
+        return {
+            "timezone": zone_name,
+            "has_dst_bool": True,
+            "dst_start": dst_start.strftime("%Y-%m-%d %H:%M:%S"),
+            "dst_end": dst_end.strftime("%Y-%m-%d %H:%M:%S")
+        }
+
+    return {
+        "timezone": zone_name,
+        "has_dst_bool": False,
+        "dst_start": None,
+        "dst_end": None
+    }
+
+
+# Function to resolve timezone information through timeapi.io
+def resolve_timezone_upstream(latitude, longitude):
+    time_api_url = f"https://timeapi.io/api/timezone/coordinate?latitude={latitude}&longitude={longitude}"
+    time_response = http_client.get(time_api_url).json()
+    
+    if time_response["hasDayLightSaving"] == True:            
+        # Access the nested 'dstStart' and 'dstEnd' within 'dstInterval'
+        dst_start_iso = time_response.get("dstInterval", {}).get("dstStart")
+        dst_end_iso = time_response.get("dstInterval", {}).get("dstEnd")            
+
+        # Convert to datetime objects
+        dst_start_toformat = datetime.fromisoformat(dst_start_iso.replace("Z", "+00:00"))
+        dst_end_toformat = datetime.fromisoformat(dst_end_iso.replace("Z", "+00:00")) 
+
+        # Capture timezone information
+        return {
+            "timezone": time_response["timeZone"],
+            "has_dst_bool": time_response["hasDayLightSaving"],
+            "dst_start": dst_start_toformat.strftime("%Y-%m-%d %H:%M:%S"),
+            "dst_end": dst_end_toformat.strftime("%Y-%m-%d %H:%M:%S")
+        }
+
+    return {
+        "timezone": time_response["timeZone"],
+        "has_dst_bool": time_response["hasDayLightSaving"],
+        "dst_start": None,
+        "dst_end": None
+    }
+
+
+# Weather cache configuration
+weather_cache_config = {
+    'ttl': int(os.getenv('WEATHER_CACHE_TTL', 600)),                 # Seconds a One Call payload is served from memory
+    'precision': int(os.getenv('WEATHER_CACHE_PRECISION', 2)),       # Decimal places lat/lon are rounded to (~1 km)
+    'max_entries': int(os.getenv('WEATHER_CACHE_MAX_ENTRIES', 5000))
+}
+
+
+# In-memory cache of OpenWeather One Call payloads keyed on rounded coordinates and units
+class WeatherCache:
+    def __init__(self, ttl, precision, max_entries):
+        self.ttl = ttl
+        self.precision = precision
+        self.max_entries = max_entries
+        self._entries = {}  # (lat, lon, units) -> (fetched_at, payload)
+        self._lock = threading.Lock()
+        self._inflight = SingleFlight()
+        self._stats = {'hits': 0, 'misses': 0, 'upstream_calls': 0, 'upstream_failures': 0}
+
+    def get_onecall(self, lat, lon, units):
+        """Return (status_code, payload) for the One Call endpoint at the given location."""
+        key = (round(float(lat), self.precision), round(float(lon), self.precision), units)
+
+        entry = self._entries.get(key)
+        if entry and time.monotonic() - entry[0] < self.ttl:
+            self._stats['hits'] += 1
+            return 200, entry[1]
+
+        # Simultaneous requests for the same location share a single upstream call
+        self._stats['misses'] += 1
+        return self._inflight.do(key, self._fetch, key)
+
+    def _fetch(self, key):
+        entry = self._entries.get(key)
+        if entry and time.monotonic() - entry[0] < self.ttl:
+            return 200, entry[1]
+
+        lat, lon, units = key
+        weather_url = f"https://api.openweathermap.org/data/3.0/onecall?lat={lat}&lon={lon}&units={units}&exclude=minutely,hourly&appid={os.getenv("WEATHER_API_KEY")}"
+
+        self._stats['upstream_calls'] += 1
+        weather_response = http_client.get(weather_url)
+        payload = weather_response.json()
+
+        if weather_response.status_code != 200:
+            self._stats['upstream_failures'] += 1
+            return weather_response.status_code, payload
+
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                # Drop expired entries first, then the oldest ones
+                now = time.monotonic()
+                self._entries = {k: v for k, v in self._entries.items() if now - v[0] < self.ttl}
+                for stale_key in sorted(self._entries, key=lambda k: self._entries[k][0])[:len(self._entries) - self.max_entries + 1]:
+                    del self._entries[stale_key]
+            self._entries[key] = (time.monotonic(), payload)
+
+        return 200, payload
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats['entries'] = len(self._entries)
+        return stats
+
+
+weather_cache = WeatherCache(**weather_cache_config)
+
+
+# Function to resolve the requested location and return the cached One Call payload for it
+def get_weather_response():
     fahrenheit_countries = ["US", "BS", "BZ", "KY", "PW"]
 
     # Retrieve user_id from the request
@@ -428,202 +2194,419 @@ def get_current_weather():
         )
         user = cursor.fetchone()
 
+        # Return the connection before any upstream calls
+        cursor.close()
+        connection.close()
+
         # If user not found
         if not user:
             return jsonify({"error": "User not found"}), 404
 
-        # Check if requested location matches currentUser's location
-        if city == user['City'] and state == user['State'] and country == user['Country']:
+        # Check if requested location matches currentUser's location (coordinates are NULL until signup enrichment finishes)
+        if city == user['City'] and state == user['State'] and country == user['Country'] and user['Lat'] is not None and user['Lon'] is not None:
             lat, lon = user['Lat'], user['Lon']
         else:
-            # Use Geocoding API to resolve lat/lon for the requested location
-            address = f"city={city}&state={state}&country={country}"
-            geocode_url = f"https://geocode.maps.co/search?{address}&api_key={os.environ.get('GEOCODE_API_KEY')}"
-            geocode_response = requests.get(geocode_url).json()
+            # Resolve lat/lon for the requested location through the shared geocoding cache
+            location = geocode_cache.resolve(city=city, state=state, country=country)
 
-            if not geocode_response:
+            if not location:
                 return jsonify({"error": "Geocoding failed"}), 400
 
-            lat, lon = geocode_response[0]['lat'], geocode_response[0]['lon']
+            lat, lon = location['lat'], location['lon']
 
         # Set userUnits based on the country
         userUnits = "imperial" if country in fahrenheit_countries else "metric"
 
-        # Call OpenWeather API       
-        weather_url = f"https://api.openweathermap.org/data/3.0/onecall?lat={lat}&lon={lon}&units={userUnits}&exclude=minutely,hourly&appid={os.getenv("WEATHER_API_KEY")}"
-        
-        weather_response = requests.get(weather_url)
-        
+        # Get the One Call payload (current conditions and 8-day forecast) from the cache or OpenWeather
+        status_code, payload = weather_cache.get_onecall(lat, lon, userUnits)
+
         # Handle OpenWeather API response
-        if weather_response.status_code == 200:
-            return jsonify(weather_response.json())
+        if status_code == 200:
+            return jsonify(payload)
         else:
-            return jsonify({"error": "Weather API failed"}), weather_response.status_code, weather_response.json()
+            return jsonify({"error": "Weather API failed", "details": payload}), status_code
 
     except Exception as e:
         return jsonify({"error": f"An error occurred: {e}"}), 500
 
-    finally:
-        if connection:
-            cursor.close()
-            connection.close()
+
+# REST API route to get the current weather using the OpenWeather API
+@app.route('/api/weather/current', methods=['GET'])
+def get_current_weather():
+    return get_weather_response()
 
 
 # REST API route to get the 8-day weather forecast using the OpenWeather API
 @app.route('/api/weather/forecast', methods=['GET'])
 def get_weather_forecast():
-    fahrenheit_countries = ["US", "BS", "BZ", "KY", "PW"]
+    return get_weather_response()
 
-    # Retrieve user_id from the request
-    user_id = request.args.get('user_id')
-    if not user_id:
-        return jsonify({"error": "user_id is required"}), 400
 
-    # Retrieve location details from the request
-    city = request.args.get('city')
-    state = request.args.get('state')
-    country = request.args.get('country')
-    if not city or not country or not state:
-        return jsonify({"error": "City, State, and Country are required"}), 400
+# Google Calendar local event store configuration
+calendar_sync_config = {
+    'lookback_days': int(os.getenv('CALENDAR_SYNC_LOOKBACK_DAYS', 30)),        # Past events kept in the local store
+    'lookahead_days': int(os.getenv('CALENDAR_SYNC_LOOKAHEAD_DAYS', 365)),     # Future events kept in the local store
+    'min_interval': float(os.getenv('CALENDAR_SYNC_MIN_INTERVAL', 15))         # Seconds between delta fetches for the same calendar
+}
 
-    try:
-        # Establish a database connection
-        connection = get_db_connection()
-        cursor = connection.cursor(dictionary=True)
 
-        # Fetch user details from the database
-        cursor.execute(
-            """
-            SELECT City, State, Country, Lat, Lon
-            FROM Users
-            WHERE user_id = %s
-            """,
-            (user_id,)
-        )
-        user = cursor.fetchone()
+# Raised when the Google Calendar API answers with an error
+class GoogleAPIError(Exception):
+    def __init__(self, status_code, body):
+        super().__init__(f"Google API error {status_code}: {body}")
+        self.status_code = status_code
+        self.body = body
 
-        # If user not found
-        if not user:
-            return jsonify({"error": "User not found"}), 404
 
-        # Check if requested location matches currentUser's location
-        if city == user['City'] and state == user['State'] and country == user['Country']:
-            lat, lon = user['Lat'], user['Lon']
-        else:
-            # Use Geocoding API to resolve lat/lon for the requested location
-            address = f"city={city}&state={state}&country={country}"
-            geocode_url = f"https://geocode.maps.co/search?{address}&api_key={os.environ.get('GEOCODE_API_KEY')}"
-            geocode_response = requests.get(geocode_url).json()
+# Function to build the Google Calendar events URL for a calendar (and optionally one event)
+def google_events_endpoint(calendar_id, event_id=None):
+    url = f"https://www.googleapis.com/calendar/v3/calendars/{urllib.parse.quote(calendar_id, safe='@')}/events"
+    if event_id:
+        url += f"/{urllib.parse.quote(event_id, safe='')}"
+    return url
 
-            if not geocode_response:
-                return jsonify({"error": "Geocoding failed"}), 400
 
-            lat, lon = geocode_response[0]['lat'], geocode_response[0]['lon']
+# Function to fetch every page of an events.list call; returns (items, nextSyncToken)
+def fetch_google_events(token_id, calendar_id, params):
+    headers = {"Authorization": f"Bearer {token_id}"}
+    params = dict(params, maxResults=2500)
+    items = []
 
-        # Set userUnits based on the country
-        userUnits = "imperial" if country in fahrenheit_countries else "metric"
+    while True:
+        response = http_client.get(google_events_endpoint(calendar_id), headers=headers, params=params)
+        if response.status_code != 200:
+            raise GoogleAPIError(response.status_code, response.text)
 
-        # Call OpenWeather API
-        weather_url = f"https://api.openweathermap.org/data/3.0/onecall?lat={lat}&lon={lon}&units={userUnits}&exclude=minutely,hourly&appid={os.getenv("WEATHER_API_KEY")}"
-        
-        weather_response = requests.get(weather_url)        
+        page = response.json()
+        items.extend(page.get("items", []))
+        if not page.get("nextPageToken"):
+            return items, page.get("nextSyncToken")
+        params["pageToken"] = page["nextPageToken"]
 
-        # Handle OpenWeather API response
-        if weather_response.status_code == 200:
-            return jsonify(weather_response.json())
-        else:
-            return jsonify({"error": "Weather API failed"}), weather_response.status_code, weather_response.json()
 
-    except Exception as e:
-        return jsonify({"error": f"An error occurred: {e}"}), 500
+# Function to parse a Google event time ({"dateTime": ...} or all-day {"date": ...}) into naive UTC
+def parse_google_event_time(event_time):
+    if not event_time:
+        return None
+    if event_time.get("dateTime"):
+        parsed = datetime.fromisoformat(event_time["dateTime"].replace("Z", "+00:00"))
+    else:
+        parsed = datetime.fromisoformat(event_time["date"])  # All-day events are treated as starting at midnight UTC
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+# Keeps a local copy of each user's calendars in MongoDB, kept current with Google's incremental sync tokens
+class CalendarEventStore:
+    def __init__(self, lookback_days, lookahead_days, min_interval):
+        self.lookback = timedelta(days=lookback_days)
+        self.lookahead = timedelta(days=lookahead_days)
+        self.min_interval = min_interval
+        self._syncs = SingleFlight()
+        self._indexed = False
+        self._needs_full_sync = set()  # "user:calendar" keys whose store missed a write and couldn't be reset in MongoDB
+        self._stats = {'store_reads': 0, 'live_reads': 0, 'full_syncs': 0, 'delta_syncs': 0, 'skipped_syncs': 0, 'resets': 0, 'events_applied': 0,
+                       'write_through_failures': 0}
+
+    def _collections(self):
+        events = get_mongo_collection('calendar_events')
+        if not self._indexed:
+            try:
+                events.create_index([("user_id", 1), ("calendar_id", 1), ("start", 1)], name="user_calendar_start")
+            except Exception as e:
+                print(f"Error creating calendar events index: {e}")
+            self._indexed = True
+        return events, get_mongo_collection('calendar_sync')
 
-    finally:
-        if connection:
-            cursor.close()
-            connection.close()
+    def _document(self, user_id, calendar_id, event):
+        return {
+            "_id": f"{user_id}:{calendar_id}:{event['id']}",
+            "user_id": user_id,
+            "calendar_id": calendar_id,
+            "event_id": event["id"],
+            "start": parse_google_event_time(event.get("start")),
+            "end": parse_google_event_time(event.get("end")),
+            "event": event
+        }
 
+    def _apply(self, user_id, calendar_id, items):
+        events, _ = self._collections()
+        operations = []
+        for event in items:
+            if event.get("status") == "cancelled" or not event.get("start"):
+                operations.append(DeleteOne({"_id": f"{user_id}:{calendar_id}:{event['id']}"}))
+            else:
+                document = self._document(user_id, calendar_id, event)
+                operations.append(ReplaceOne({"_id": document["_id"]}, document, upsert=True))
+        if operations:
+            events.bulk_write(operations, ordered=True)  # In order: a later change to the same event wins
+            self._stats['events_applied'] += len(operations)
+
+    def _full_sync(self, user_id, calendar_id, token_id):
+        events, sync_states = self._collections()
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        window_start, window_end = now - self.lookback, now + self.lookahead
+
+        items, sync_token = fetch_google_events(token_id, calendar_id, {
+            "timeMin": window_start.isoformat() + "Z",
+            "timeMax": window_end.isoformat() + "Z",
+            "singleEvents": True  # Expand recurring events into individual instances
+        })
 
-# REST API route to get all a list of all Google Calendars for the user
-@app.route('/api/google/calendars', methods=['GET'])
-def get_google_calendars():
-    threw_error = False
-    try:
-        # Retrieve user_id from query parameters
-        user_id = request.args.get('user_id')
-        if not user_id:
-            threw_error = True            
-            return jsonify({"error": "user_id is required"}), 400
+        events.delete_many({"user_id": user_id, "calendar_id": calendar_id})
+        self._apply(user_id, calendar_id, items)
 
-        # Connect to the database to retrieve user token information
-        connection = get_db_connection()
-        cursor = connection.cursor()
+        state = {
+            "_id": f"{user_id}:{calendar_id}",
+            "user_id": user_id,
+            "calendar_id": calendar_id,
+            "sync_token": sync_token,
+            "window_start": window_start,
+            "window_end": window_end,
+            "synced_at": now
+        }
+        sync_states.replace_one({"_id": state["_id"]}, state, upsert=True)
+        self._stats['full_syncs'] += 1
+        return state
+
+    def _sync(self, user_id, calendar_id, token_id):
+        _, sync_states = self._collections()
+        state = sync_states.find_one({"_id": f"{user_id}:{calendar_id}"})
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+
+        # Start over when there is no store yet, when a write-through was lost, or when its window no longer reaches far enough ahead
+        key = f"{user_id}:{calendar_id}"
+        if not state or not state.get("sync_token") or key in self._needs_full_sync or state["window_end"] - now < self.lookahead / 2:
+            state = self._full_sync(user_id, calendar_id, token_id)
+            self._needs_full_sync.discard(key)
+            return state
+
+        if (now - state["synced_at"]).total_seconds() < self.min_interval:
+            self._stats['skipped_syncs'] += 1
+            return state
 
-        # Fetch the TokenID, RefreshID, and ExpirationTime for the user
-        cursor.execute(
-            "SELECT TokenID, RefreshID, ExpirationTime FROM Token WHERE user_id = %s", (user_id,)
-        )
-        token_data = cursor.fetchone()
+        try:
+            items, sync_token = fetch_google_events(token_id, calendar_id, {"syncToken": state["sync_token"], "singleEvents": True})
+        except GoogleAPIError as e:
+            if e.status_code != 410:
+                raise
+            # Google expired the sync token; the only way back is a full sync
+            self._stats['resets'] += 1
+            return self._full_sync(user_id, calendar_id, token_id)
+
+        self._apply(user_id, calendar_id, items)
+        state.update(sync_token=sync_token, synced_at=now)
+        sync_states.update_one({"_id": state["_id"]}, {"$set": {"sync_token": sync_token, "synced_at": now}})
+        self._stats['delta_syncs'] += 1
+        return state
+
+    def get_events(self, user_id, calendar_id, token_id, time_min, time_max):
+        """Events overlapping [time_min, time_max) ordered by start, like events.list with orderBy=startTime."""
+        user_id = str(user_id)
+        state = self._syncs.do(f"{user_id}:{calendar_id}", self._sync, user_id, calendar_id, token_id)
+
+        # Outside the stored window, ask Google directly
+        if time_min < state["window_start"] or time_max > state["window_end"]:
+            self._stats['live_reads'] += 1
+            items, _ = fetch_google_events(token_id, calendar_id, {
+                "timeMin": time_min.isoformat() + "Z",
+                "timeMax": time_max.isoformat() + "Z",
+                "singleEvents": True,
+                "orderBy": "startTime"
+            })
+            return items
+
+        self._stats['store_reads'] += 1
+        events, _ = self._collections()
+        documents = events.find(
+            {"user_id": user_id, "calendar_id": calendar_id, "start": {"$lt": time_max}, "end": {"$gt": time_min}},
+            {"event": 1}
+        ).sort("start", 1)
+        return [document["event"] for document in documents]
+
+    def _write_through(self, user_id, calendar_id, write):
+        # Google has already accepted the change, so a local failure must not fail the request; the store is
+        # rebuilt by a full sync on the next read instead
+        try:
+            write()
+        except Exception as e:
+            self._stats['write_through_failures'] += 1
+            print(f"Error updating the local calendar store for user {user_id}, calendar {calendar_id}: {e}")
+            try:
+                self._collections()[1].delete_one({"_id": f"{user_id}:{calendar_id}"})
+            except Exception:
+                self._needs_full_sync.add(f"{user_id}:{calendar_id}")
 
-        if not token_data:
-            threw_error = True
-            cursor.close()
-            connection.close()
-            return jsonify({"error": "User not found or no token data available"}), 404
+    def save_event(self, user_id, calendar_id, event):
+        """Write-through for an event created or updated through our API, if the calendar is being synced. Never raises."""
+        user_id = str(user_id)
 
-        token_id, refresh_token, expiration_time = token_data
-        expiration_time = expiration_time.replace(tzinfo=timezone.utc)
+        def write():
+            _, sync_states = self._collections()
+            if sync_states.find_one({"_id": f"{user_id}:{calendar_id}"}, {"_id": 1}):
+                self._apply(user_id, calendar_id, [event])
 
-        if token_id == "0":
-            threw_error = True
-            cursor.close()
-            connection.close()
-            return jsonify({"error": "User needs to connect their Google Account to use this feature"}), 200
+        self._write_through(user_id, calendar_id, write)
 
-        # Ensure we have a valid token
-        token_id, new_expiration_time = get_valid_google_token(
-            token_id=token_id,
-            refresh_token=refresh_token,
-            expiration_time=expiration_time
-        )
+    def remove_event(self, user_id, calendar_id, event_id):
+        """Removes an event deleted through our API from the store. Never raises."""
+        user_id = str(user_id)
 
-        # Update the database if the token was refreshed
-        if new_expiration_time:
-            cursor.execute(
-                "UPDATE Token SET TokenID = %s, ExpirationTime = %s WHERE user_id = %s",
-                (token_id, new_expiration_time.isoformat(sep=" "), user_id)
-            )
-            connection.commit()
+        def write():
+            events, _ = self._collections()
+            events.delete_one({"_id": f"{user_id}:{calendar_id}:{event_id}"})
 
-        # Make the API call to Google Calendar
-        google_calendar_url = "https://www.googleapis.com/calendar/v3/users/me/calendarList"
+        self._write_through(user_id, calendar_id, write)
+
+    def clear_user(self, user_id):
+        events, sync_states = self._collections()
+        events.delete_many({"user_id": str(user_id)})
+        sync_states.delete_many({"user_id": str(user_id)})
+
+    def stats(self):
+        return dict(self._stats)
+
+
+calendar_store = CalendarEventStore(**calendar_sync_config)
+
+
+# Function to parse a query date (ISO 8601) into naive UTC
+def parse_query_datetime(value):
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+# Google calendarList cache configuration
+calendar_list_config = {
+    'soft_ttl': int(os.getenv('CALENDAR_LIST_SOFT_TTL', 300)),        # Seconds before a cached list is revalidated in the background
+    'max_stale': int(os.getenv('CALENDAR_LIST_MAX_STALE', 86400)),    # Seconds after which a cached list is no longer served while revalidating
+    'max_entries': int(os.getenv('CALENDAR_LIST_MAX_ENTRIES', 5000))
+}
+
+
+# Per-user cache of the Google calendarList, revalidated with ETag / If-None-Match
+class CalendarListCache:
+    def __init__(self, soft_ttl, max_stale, max_entries):
+        self.soft_ttl = soft_ttl
+        self.max_stale = max_stale
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # user_id -> {'etag', 'payload', 'validated_at'}, least recently used first
+        self._lock = threading.Lock()
+        self._fetches = SingleFlight()
+        self._revalidating = set()
+        self._stats = {'hits': 0, 'stale_hits': 0, 'misses': 0, 'not_modified': 0, 'refetched': 0, 'upstream_failures': 0, 'invalidations': 0}
+
+    def get(self, user_id, token_id):
+        """Return (payload, status_code) for the user's calendarList."""
+        user_id = str(user_id)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry:
+                self._entries.move_to_end(user_id)
+                age = time.monotonic() - entry['validated_at']
+                if age < self.soft_ttl:
+                    self._stats['hits'] += 1
+                    return entry['payload'], 200
+                if age < self.max_stale:
+                    # Serve what we have and let a background task check it with Google
+                    self._stats['stale_hits'] += 1
+                    if user_id not in self._revalidating:
+                        self._revalidating.add(user_id)
+                        socketio.start_background_task(self._revalidate, user_id)
+                    return entry['payload'], 200
+
+        self._stats['misses'] += 1
+        return self._fetches.do(user_id, self._fetch, user_id, token_id)
+
+    def _revalidate(self, user_id):
+        try:
+            with app.app_context():
+                token_id, token_error = google_tokens.get_access_token(user_id)
+                if token_error:
+                    return
+                self._fetches.do(user_id, self._fetch, user_id, token_id)
+        except Exception as e:
+            print(f"Error revalidating calendar list for user {user_id}: {e}")
+        finally:
+            with self._lock:
+                self._revalidating.discard(user_id)
+
+    def _fetch(self, user_id, token_id):
+        entry = self._entries.get(user_id)
         headers = {"Authorization": f"Bearer {token_id}"}
-        response = requests.get(google_calendar_url, headers=headers)
+        if entry and entry['etag']:
+            headers["If-None-Match"] = entry['etag']
+
+        response = http_client.get("https://www.googleapis.com/calendar/v3/users/me/calendarList", headers=headers)
+
+        if response.status_code == 304 and entry:
+            self._stats['not_modified'] += 1
+            with self._lock:
+                entry['validated_at'] = time.monotonic()
+            return entry['payload'], 200
+
+        if response.status_code != 200:
+            self._stats['upstream_failures'] += 1
+            print(f"Error fetching calendars: {response.text}")
+            return {"error": "Failed to fetch calendars"}, response.status_code
+
+        payload = response.json()
+        self._stats['refetched'] += 1
+        with self._lock:
+            # An invalidation while the request was in flight means this answer may belong to the old account
+            if entry is None or self._entries.get(user_id) is entry:
+                self._entries[user_id] = {
+                    'etag': response.headers.get('ETag') or payload.get('etag'),
+                    'payload': payload,
+                    'validated_at': time.monotonic()
+                }
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return payload, 200
 
-        # Handle the response from Google API
-        if response.status_code == 200:
-            calendar_list = response.json()
-            return jsonify(calendar_list), 200
-        else:
-            print(f"Error fetching calendars: {response.json()}")
-            threw_error = True
-            cursor.close()
-            connection.close()
-            return jsonify({"error": "Failed to fetch calendars"}), response.status_code
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(str(user_id), None)
+            self._stats['invalidations'] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), revalidating=len(self._revalidating))
+
+
+calendar_lists = CalendarListCache(**calendar_list_config)
+
+
+# REST API route to get all a list of all Google Calendars for the user
+@app.route('/api/google/calendars', methods=['GET'])
+def get_google_calendars():
+    try:
+        # Retrieve user_id from query parameters
+        user_id = request.args.get('user_id')
+        if not user_id:
+            return jsonify({"error": "user_id is required"}), 400
+
+        # Retrieve a valid access token (served from memory, refreshed at most once per user at a time)
+        token_id, token_error = google_tokens.get_access_token(user_id)
+        if token_error:
+            return jsonify(token_error[0]), token_error[1]
+
+        # Served from memory; Google is only asked whether the list changed since its ETag
+        calendar_list, status = calendar_lists.get(user_id, token_id)
+        return jsonify(calendar_list), status
 
     except Exception as e:
         print(f"Error in get_google_calendars: {e}")
         return jsonify({"error": "An internal server error occurred"}), 500
 
-    finally:
-        if not threw_error:
-            cursor.close()
-            connection.close()
-
 
 # REST API route to get all a list of all Google Calendar Events between a start and end date for the user
 @app.route('/api/google/events', methods=['GET'])
 def get_google_events():
-    threw_error = False
     try:
         # Retrieve query parameters
         user_id = request.args.get('user_id')
@@ -633,7 +2616,6 @@ def get_google_events():
 
         # Validate user_id
         if not user_id:
-            threw_error = True
             return jsonify({"error": "user_id is required"}), 400
 
         # Set default start and end times if not provided
@@ -645,424 +2627,338 @@ def get_google_events():
 
         # Validate date format
         try:
-            datetime.fromisoformat(start_date.replace("Z", "+00:00"))
-            datetime.fromisoformat(end_date.replace("Z", "+00:00"))
+            time_min = parse_query_datetime(start_date)
+            time_max = parse_query_datetime(end_date)
         except ValueError:
             return jsonify({"error": "Invalid date format. Use ISO 8601 format."}), 400
 
-        # Connect to the database
-        connection = get_db_connection()
-        cursor = connection.cursor()
+        # Retrieve a valid access token (served from memory, refreshed at most once per user at a time)
+        token_id, token_error = google_tokens.get_access_token(user_id)
+        if token_error:
+            return jsonify(token_error[0]), token_error[1]
 
-        # Fetch the TokenID, RefreshID, and ExpirationTime for the user
-        cursor.execute(
-            "SELECT TokenID, RefreshID, ExpirationTime FROM Token WHERE user_id = %s", (user_id,)
-        )
-        token_data = cursor.fetchone()
+        # Answer from the local event store after a delta sync with Google
+        try:
+            events = calendar_store.get_events(user_id, calendar_id, token_id, time_min, time_max)
+        except GoogleAPIError as e:
+            print(f"Error fetching events: {e.body}")
+            return jsonify({"error": "Failed to fetch events"}), e.status_code
 
-        if not token_data:
-            threw_error = True
-            cursor.close()
-            connection.close()
-            return jsonify({"error": "User not found or no token data available"}), 404
+        return jsonify(events), 200
 
-        token_id, refresh_token, expiration_time = token_data
-        expiration_time = expiration_time.replace(tzinfo=timezone.utc)
+    except Exception as e:
+        print(f"Error in get_google_events: {e}")
+        return jsonify({"error": "An internal server error occurred"}), 500
 
-        if token_id == "0":
-            threw_error = True
-            cursor.close()
-            connection.close()
-            return jsonify({"error": "User needs to connect their Google Account to use this feature"}), 200
 
-        # Ensure we have a valid token
-        token_id, new_expiration_time = get_valid_google_token(
-            token_id=token_id,
-            refresh_token=refresh_token,
-            expiration_time=expiration_time
-        )
+# Google Calendar batch configuration
+calendar_batch_config = {
+    'max_operations': int(os.getenv('CALENDAR_BATCH_MAX_OPERATIONS', 50)),   # Operations accepted per /api/google/batch call
+    'concurrency': int(os.getenv('CALENDAR_BATCH_CONCURRENCY', 5))           # Requests in flight to Google per batch call
+}
 
-        # Update the database if the token was refreshed
-        if new_expiration_time:
-            cursor.execute(
-                "UPDATE Token SET TokenID = %s, ExpirationTime = %s WHERE user_id = %s",
-                (token_id, new_expiration_time.isoformat(sep=" "), user_id)
-            )
-            connection.commit()
 
-        # Make the API call to Google Calendar for events
-        google_events_url = f"https://www.googleapis.com/calendar/v3/calendars/{calendar_id}/events"
-        headers = {"Authorization": f"Bearer {token_id}"}
-        params = {
-            "timeMin": start_date,
-            "timeMax": end_date,
-            "singleEvents": True,  # Expand recurring events into individual instances
-            "orderBy": "startTime"  # Order events by start time
-        }
-        response = requests.get(google_events_url, headers=headers, params=params)
+# Function to build a Google Calendar event body from a request payload; returns (event_data, error)
+def build_event_payload(data, partial=False):
+    summary = data.get('summary')
+    description = data.get('description')
+    start_time = data.get('start')
+    end_time = data.get('end')
+    attendees = data.get('attendees', [])
+    time_zone = data.get('timeZone', 'UTC')  # Default to UTC
+
+    # Handle nested start and end times
+    if isinstance(start_time, dict):
+        start_time = start_time.get('dateTime')
+    if isinstance(end_time, dict):
+        end_time = end_time.get('dateTime')
+
+    if not partial and (not summary or not start_time or not end_time):
+        return None, "summary, start, and end are required"
+
+    # Validate date formats
+    try:
+        if start_time:
+            datetime.fromisoformat(start_time.replace("Z", "+00:00"))
+        if end_time:
+            datetime.fromisoformat(end_time.replace("Z", "+00:00"))
+    except ValueError:
+        return None, "Invalid date format. Use ISO 8601 format."
+
+    # Deserialize attendees if needed
+    if isinstance(attendees, str):
+        try:
+            attendees = json.loads(attendees)
+        except json.JSONDecodeError:
+            return None, "Invalid JSON format for attendees"
+
+    # A new event always carries its description; an update only sends the fields that were given
+    event_data = {} if partial else {"summary": summary, "description": description}
+    if summary:
+        event_data["summary"] = summary
+    if description:
+        event_data["description"] = description
+    if start_time:
+        event_data["start"] = {"dateTime": start_time, "timeZone": time_zone}
+    if end_time:
+        event_data["end"] = {"dateTime": end_time, "timeZone": time_zone}
+    if attendees:
+        event_data["attendees"] = [{"email": email} for email in attendees]
+
+    return event_data, None
+
+
+# Function to validate one create/update/delete operation; returns (operation, error)
+def prepare_event_operation(data):
+    action = data.get('action')
+    operation = {
+        "action": action,
+        "calendar_id": data.get('calendar_id', 'primary'),  # Default to 'primary'
+        "event_id": data.get('event_id')
+    }
+
+    if action not in ('create', 'update', 'delete'):
+        return None, "action must be one of create, update or delete"
+    if action != 'create' and not operation["event_id"]:
+        return None, "event_id is required"
+
+    if action != 'delete':
+        operation["event_data"], error = build_event_payload(data, partial=(action == 'update'))
+        if error:
+            return None, error
+
+    return operation, None
+
+
+# Function to send a prepared operation to Google and keep the local event store in step; returns (body, status)
+def execute_event_operation(user_id, token_id, operation):
+    action = operation["action"]
+    calendar_id = operation["calendar_id"]
+    headers = {"Authorization": f"Bearer {token_id}"}
+
+    if action == 'create':
+        response = http_client.post(google_events_endpoint(calendar_id), headers=headers, json=operation["event_data"])
+        success_status = 201 if response.status_code in (200, 201) else None
+    elif action == 'update':
+        response = http_client.put(google_events_endpoint(calendar_id, operation["event_id"]), headers=headers, json=operation["event_data"])
+        success_status = 200 if response.status_code == 200 else None
+    else:
+        response = http_client.delete(google_events_endpoint(calendar_id, operation["event_id"]), headers=headers)
+        success_status = 200 if response.status_code == 204 else None  # Success - No content response
+
+    if success_status is None:
+        print(f"Error on {action} event: {response.text}")
+        return {"error": f"Failed to {action} event"}, response.status_code
 
-        # Handle the response from Google API
-        if response.status_code == 200:
-            events = response.json().get("items", [])
-            return jsonify(events), 200
-        else:
-            print(f"Error fetching events: {response.json()}")
-            threw_error = True
-            cursor.close()
-            connection.close()
-            return jsonify({"error": "Failed to fetch events"}), response.status_code
+    # Google has applied the change. Nothing after this point may report a failure, or callers would retry
+    # (and duplicate) a create that went through; the store write-through logs and repairs its own errors
+    if action == 'delete':
+        calendar_store.remove_event(user_id, calendar_id, operation["event_id"])
+        return {"message": "Event deleted successfully"}, success_status
 
-    except Exception as e:
-        print(f"Error in get_google_events: {e}")
-        return jsonify({"error": "An internal server error occurred"}), 500
+    try:
+        event = response.json()
+    except ValueError:
+        print(f"Unreadable response body after a successful {action}: {response.text}")
+        return {"message": f"Event {action}d successfully"}, success_status
 
-    finally:
-        if not threw_error:
-            cursor.close()
-            connection.close()
+    calendar_store.save_event(user_id, calendar_id, event)
+    return event, success_status
 
 
 # REST API route to create a new Google Calendar Event for the user
 @app.route('/api/google/create_event', methods=['POST'])
 def create_google_event():
-    threw_error = False
     try:
         # Retrieve data from the request JSON payload
         data = request.json
-
         user_id = data.get('user_id')
-        calendar_id = data.get('calendar_id', 'primary')  # Default to 'primary'
-        summary = data.get('summary')
-        description = data.get('description')
-        start_time = data.get('start')
-        end_time = data.get('end')
-        attendees = data.get('attendees', [])
-        time_zone = data.get('timeZone', 'UTC')
-
-        # Handle nested start and end times
-        if isinstance(start_time, dict):
-            start_time = start_time.get('dateTime')
-        if isinstance(end_time, dict):
-            end_time = end_time.get('dateTime')
 
         # Validate required fields
-        if not user_id or not summary or not start_time or not end_time:
-            threw_error = True
+        if not user_id:
             return jsonify({"error": "user_id, summary, start, and end are required"}), 400
 
-        # Validate date formats
-        try:
-            datetime.fromisoformat(start_time.replace("Z", "+00:00"))
-            datetime.fromisoformat(end_time.replace("Z", "+00:00"))
-        except ValueError:
-            return jsonify({"error": "Invalid date format. Use ISO 8601 format."}), 400
-
-        # Deserialize attendees if needed
-        if isinstance(attendees, str):
-            try:
-                attendees = json.loads(attendees)
-            except json.JSONDecodeError:
-                return jsonify({"error": "Invalid JSON format for attendees"}), 400
-
-        # Connect to the database
-        connection = get_db_connection()
-        cursor = connection.cursor()
-
-        # Fetch the TokenID, RefreshID, and ExpirationTime for the user
-        cursor.execute(
-            "SELECT TokenID, RefreshID, ExpirationTime FROM Token WHERE user_id = %s", (user_id,)
-        )
-        token_data = cursor.fetchone()
-
-        if not token_data:
-            threw_error = True
-            cursor.close()
-            connection.close()
-            return jsonify({"error": "User not found or no token data available"}), 404
-
-        token_id, refresh_token, expiration_time = token_data
-        expiration_time = expiration_time.replace(tzinfo=timezone.utc)
-
-        if token_id == "0":
-            threw_error = True
-            cursor.close()
-            connection.close()
-            return jsonify({"error": "User needs to connect their Google Account to use this feature"}), 200
-
-        # Ensure we have a valid token
-        token_id, new_expiration_time = get_valid_google_token(
-            token_id=token_id,
-            refresh_token=refresh_token,
-            expiration_time=expiration_time
-        )
-
-        # Update the database if the token was refreshed
-        if new_expiration_time:
-            cursor.execute(
-                "UPDATE Token SET TokenID = %s, ExpirationTime = %s WHERE user_id = %s",
-                (token_id, new_expiration_time.isoformat(sep=" "), user_id)
-            )
-            connection.commit()
-
-        # Prepare the event data for the Google Calendar API
-        event_data = {
-            "summary": summary,
-            "description": description,
-            "start": {"dateTime": start_time, "timeZone": time_zone},
-            "end": {"dateTime": end_time, "timeZone": time_zone},
-        }
-
-        # Add attendees if provided
-        if attendees:
-            event_data["attendees"] = [{"email": email} for email in attendees]
+        operation, error = prepare_event_operation(dict(data, action='create'))
+        if error:
+            return jsonify({"error": error}), 400
 
-        # Make the API call to Google Calendar
-        google_events_url = f"https://www.googleapis.com/calendar/v3/calendars/{calendar_id}/events"
-        headers = {"Authorization": f"Bearer {token_id}"}
-        response = requests.post(google_events_url, headers=headers, json=event_data)
+        # Retrieve a valid access token (served from memory, refreshed at most once per user at a time)
+        token_id, token_error = google_tokens.get_access_token(user_id)
+        if token_error:
+            return jsonify(token_error[0]), token_error[1]
 
-        # Handle the response from Google API
-        if response.status_code == 200 or response.status_code == 201:
-            created_event = response.json()
-            return jsonify(created_event), 201
-        else:
-            print(f"Error creating event: {response.json()}")
-            threw_error = True
-            cursor.close()
-            connection.close()
-            return jsonify({"error": "Failed to create event"}), response.status_code
+        body, status = execute_event_operation(user_id, token_id, operation)
+        return jsonify(body), status
 
     except Exception as e:
         print(f"Error in create_google_event: {e}")
         return jsonify({"error": "An internal server error occurred"}), 500
 
-    finally:
-        if not threw_error:
-            cursor.close()
-            connection.close()
-
 
 # REST API route to modify an existing Google Calendar Event for the user
 @app.route('/api/google/update_event', methods=['POST'])
 def update_google_event():
-    threw_error = False
     try:
         # Retrieve data from the request JSON payload
         data = request.json
-
         user_id = data.get('user_id')
-        calendar_id = data.get('calendar_id', 'primary')  # Default to 'primary'
-        event_id = data.get('event_id')
-
-        # Optional fields for the event
-        summary = data.get('summary')
-        description = data.get('description')
-        start_time = data.get('start')
-        end_time = data.get('end')
-        attendees = data.get('attendees')
-        time_zone = data.get('timeZone', 'UTC')  # Default to UTC
 
         # Validate required fields
-        if not user_id or not event_id:
-            threw_error = True
+        if not user_id or not data.get('event_id'):
             return jsonify({"error": "user_id and event_id are required"}), 400
 
-        # Handle nested start and end times
-        if isinstance(start_time, dict):
-            start_time = start_time.get('dateTime')
-        if isinstance(end_time, dict):
-            end_time = end_time.get('dateTime')
-
-        # Validate date formats if provided
-        try:
-            if start_time:
-                datetime.fromisoformat(start_time.replace("Z", "+00:00"))
-            if end_time:
-                datetime.fromisoformat(end_time.replace("Z", "+00:00"))
-        except ValueError:
-            return jsonify({"error": "Invalid date format. Use ISO 8601 format."}), 400
-
-        # Deserialize attendees if needed
-        if isinstance(attendees, str):
-            try:
-                attendees = json.loads(attendees)
-            except json.JSONDecodeError:
-                return jsonify({"error": "Invalid JSON format for attendees"}), 400
-
-        # Connect to the database
-        connection = get_db_connection()
-        cursor = connection.cursor()
+        operation, error = prepare_event_operation(dict(data, action='update'))
+        if error:
+            return jsonify({"error": error}), 400
 
-        # Fetch the TokenID, RefreshID, and ExpirationTime for the user
-        cursor.execute(
-            "SELECT TokenID, RefreshID, ExpirationTime FROM Token WHERE user_id = %s", (user_id,)
-        )
-        token_data = cursor.fetchone()
+        # Retrieve a valid access token (served from memory, refreshed at most once per user at a time)
+        token_id, token_error = google_tokens.get_access_token(user_id)
+        if token_error:
+            return jsonify(token_error[0]), token_error[1]
 
-        if not token_data:
-            threw_error = True
-            cursor.close()
-            connection.close()
-            return jsonify({"error": "User not found or no token data available"}), 404
+        body, status = execute_event_operation(user_id, token_id, operation)
+        return jsonify(body), status
 
-        token_id, refresh_token, expiration_time = token_data
-        expiration_time = expiration_time.replace(tzinfo=timezone.utc)
+    except Exception as e:
+        print(f"Error in update_google_event: {e}")
+        return jsonify({"error": "An internal server error occurred"}), 500
 
-        if token_id == "0":
-            threw_error = True
-            cursor.close()
-            connection.close()
-            return jsonify({"error": "User needs to connect their Google Account to use this feature"}), 200
 
-        # Ensure we have a valid token
-        token_id, new_expiration_time = get_valid_google_token(
-            token_id=token_id,
-            refresh_token=refresh_token,
-            expiration_time=expiration_time
-        )
+# REST API route to deleting an existing Google Calendar Event for the user
+@app.route('/api/google/delete_event', methods=['POST'])
+def delete_google_event():
+    try:
+        # Retrieve data from the request JSON payload
+        data = request.json
+        user_id = data.get('user_id')
 
-        # Update the database if the token was refreshed
-        if new_expiration_time:
-            cursor.execute(
-                "UPDATE Token SET TokenID = %s, ExpirationTime = %s WHERE user_id = %s",
-                (token_id, new_expiration_time.isoformat(sep=" "), user_id)
-            )
-            connection.commit()
+        # Validate required fields
+        if not user_id or not data.get('event_id'):
+            return jsonify({"error": "user_id and event_id are required"}), 400
 
-        # Prepare the event data for the update
-        event_data = {}
-        if summary:
-            event_data["summary"] = summary
-        if description:
-            event_data["description"] = description
-        if start_time:
-            event_data["start"] = {"dateTime": start_time, "timeZone": time_zone}
-        if end_time:
-            event_data["end"] = {"dateTime": end_time, "timeZone": time_zone}
-        if attendees:
-            event_data["attendees"] = [{"email": email} for email in attendees]
+        operation, error = prepare_event_operation(dict(data, action='delete'))
+        if error:
+            return jsonify({"error": error}), 400
 
-        # Make the API call to Google Calendar to update the event
-        google_events_url = f"https://www.googleapis.com/calendar/v3/calendars/{calendar_id}/events/{event_id}"
-        headers = {"Authorization": f"Bearer {token_id}"}
-        response = requests.put(google_events_url, headers=headers, json=event_data)
+        # Retrieve a valid access token (served from memory, refreshed at most once per user at a time)
+        token_id, token_error = google_tokens.get_access_token(user_id)
+        if token_error:
+            return jsonify(token_error[0]), token_error[1]
 
-        # Handle the response from Google API
-        if response.status_code == 200:
-            updated_event = response.json()
-            return jsonify(updated_event), 200
-        else:
-            print(f"Error updating event: {response.json()}")
-            threw_error = True
-            cursor.close()
-            connection.close()
-            return jsonify({"error": "Failed to update event"}), response.status_code
+        body, status = execute_event_operation(user_id, token_id, operation)
+        return jsonify(body), status
 
     except Exception as e:
-        print(f"Error in update_google_event: {e}")
+        print(f"Error in delete_google_event: {e}")
         return jsonify({"error": "An internal server error occurred"}), 500
 
-    finally:
-        if not threw_error:
-            cursor.close()
-            connection.close()
-
 
-# REST API route to deleting an existing Google Calendar Event for the user
-@app.route('/api/google/delete_event', methods=['POST'])
-def delete_google_event():
-    threw_error = False
+# REST API route to apply several create/update/delete operations with one token lookup
+@app.route('/api/google/batch', methods=['POST'])
+def batch_google_events():
     try:
         # Retrieve data from the request JSON payload
         data = request.json
 
         user_id = data.get('user_id')
-        calendar_id = data.get('calendar_id', 'primary')  # Default to 'primary'
-        event_id = data.get('event_id')
+        operations = data.get('operations')
 
         # Validate required fields
-        if not user_id or not event_id:
-            threw_error = True
-            return jsonify({"error": "user_id and event_id are required"}), 400
+        if not user_id or not isinstance(operations, list) or not operations:
+            return jsonify({"error": "user_id and a non-empty operations list are required"}), 400
+        if len(operations) > calendar_batch_config['max_operations']:
+            return jsonify({"error": f"At most {calendar_batch_config['max_operations']} operations per batch"}), 400
+
+        # Invalid operations are answered on their own without failing the rest of the batch
+        results = [None] * len(operations)
+        prepared = []
+        for index, item in enumerate(operations):
+            operation, error = prepare_event_operation(item if isinstance(item, dict) else {})
+            if error:
+                results[index] = {"status": 400, "body": {"error": error}}
+            else:
+                prepared.append((index, operation))
+
+        if prepared:
+            # Retrieve a valid access token once for the whole batch
+            token_id, token_error = google_tokens.get_access_token(user_id)
+            if token_error:
+                return jsonify(token_error[0]), token_error[1]
+
+            def run(operation):
+                try:
+                    return execute_event_operation(user_id, token_id, operation)
+                except Exception as e:
+                    # Only reachable before Google answered (e.g. a connection error); a success is never reported as 500
+                    print(f"Error in batch {operation['action']} event: {e}")
+                    return {"error": "An internal server error occurred"}, 500
+
+            # Fan out to Google over the pooled keep-alive connections, a bounded number at a time
+            with ThreadPoolExecutor(max_workers=min(calendar_batch_config['concurrency'], len(prepared))) as executor:
+                outcomes = executor.map(run, [operation for _, operation in prepared])
+                for (index, _), (body, status) in zip(prepared, outcomes):
+                    results[index] = {"status": status, "body": body}
+
+        for index, result in enumerate(results):
+            result["index"] = index
+            result["action"] = operations[index].get('action') if isinstance(operations[index], dict) else None
+
+        return jsonify({"results": results}), 200
 
-        # Connect to the database
-        connection = get_db_connection()
-        cursor = connection.cursor()
+    except Exception as e:
+        print(f"Error in batch_google_events: {e}")
+        return jsonify({"error": "An internal server error occurred"}), 500
 
-        # Fetch the TokenID, RefreshID, and ExpirationTime for the user
-        cursor.execute(
-            "SELECT TokenID, RefreshID, ExpirationTime FROM Token WHERE user_id = %s", (user_id,)
-        )
-        token_data = cursor.fetchone()
 
-        if not token_data:
-            threw_error = True
-            cursor.close()
-            connection.close()
-            return jsonify({"error": "User not found or no token data available"}), 404
+# Function to describe the agent's location line for a user
+def describe_user_location(user):
+    return f"Location: {user.get('City')} {user.get('State')}, {user.get('Country')}."
 
-        token_id, refresh_token, expiration_time = token_data
-        expiration_time = expiration_time.replace(tzinfo=timezone.utc)
 
-        if token_id == "0":
-            threw_error = True
-            cursor.close()
-            connection.close()
-            return jsonify({"error": "User needs to connect their Google Account to use this feature"}), 200
+# Function to build the 'human' core memory a new agent starts with
+def describe_user_for_agent(user):
+    date_of_birth = user.get('DateOfBirth')
 
-        # Ensure we have a valid token
-        token_id, new_expiration_time = get_valid_google_token(
-            token_id=token_id,
-            refresh_token=refresh_token,
-            expiration_time=expiration_time
-        )
+    # From the client the format is '%a, %d %b %Y %H:%M:%S %Z' for a string like 'Thu, 01 Jan 1970 00:00:00 GMT'
+    if isinstance(date_of_birth, str):
+        date_of_birth = datetime.strptime(date_of_birth, '%a, %d %b %Y %H:%M:%S %Z')
 
-        # Update the database if the token was refreshed
-        if new_expiration_time:
-            cursor.execute(
-                "UPDATE Token SET TokenID = %s, ExpirationTime = %s WHERE user_id = %s",
-                (token_id, new_expiration_time.isoformat(sep=" "), user_id)
-            )
-            connection.commit()
+    # Calculate user age
+    user_age = relativedelta(datetime.now(), date_of_birth).years
 
-        # Make the API call to Google Calendar to delete the event
-        google_events_url = f"https://www.googleapis.com/calendar/v3/calendars/{calendar_id}/events/{event_id}"
-        headers = {"Authorization": f"Bearer {token_id}"}
-        response = requests.delete(google_events_url, headers=headers)
+    return f"Name: {user.get('FirstName')} {user.get('LastName')}, Gender: {user.get('Gender')}, Age: {user_age}, User_ID: {user.get('user_id')}, {describe_user_location(user)}"
 
-        # Handle the response from Google API
-        if response.status_code == 204:
-            # Success - No content response
-            return jsonify({"message": "Event deleted successfully"}), 200
-        else:
-            print(f"Error deleting event: {response.json()}")
-            threw_error = True
-            cursor.close()
-            connection.close()
-            return jsonify({"error": "Failed to delete event"}), response.status_code
 
-    except Exception as e:
-        print(f"Error in delete_google_event: {e}")
-        return jsonify({"error": "An internal server error occurred"}), 500
+# Function to correct the location in the 'human' memory of every agent the user already has
+def refresh_agent_locations(user_id):
+    user = user_cache.get(user_id)
+    if user is None:
+        return
 
-    finally:
-        if not threw_error:
-            cursor.close()
-            connection.close()
+    location_pattern = re.compile(r"Location: [^\n]*?\.(?=\s|$)")
+    for agent_name, agent_id in agent_directory.warm(user_id).items():
+        try:
+            response = http_client.get(f"{letta_url}/v1/agents/{agent_id}/memory")
+            if response.status_code != 200:
+                print(f"Failed to load memory for agent {agent_name}. Status code: {response.status_code}")
+                continue
+
+            # Only the location line is replaced; the rest of the block holds what the agent has learned since
+            human = response.json().get('memory', {}).get('human', {}).get('value', '')
+            if location_pattern.search(human):
+                human = location_pattern.sub(lambda match: describe_user_location(user), human, count=1)
+            else:
+                human = f"{human}\n{describe_user_location(user)}".strip()
+
+            response = http_client.patch(f"{letta_url}/v1/agents/{agent_id}/memory", json={"human": human})
+            if response.status_code != 200:
+                print(f"Failed to update memory for agent {agent_name}. Status code: {response.status_code}")
+        except Exception as e:
+            print(f"Error refreshing location for agent {agent_name}: {e}")
 
 
 # Function to create a Letta agent for the user
 def create_letta_agent(user_id, current_user, persona_name):
-    # Parse dateOfBirth from string to date object
-    date_of_birth_str = current_user.get('DateOfBirth')
-
-    # The format is '%a, %d %b %Y %H:%M:%S %Z' for a string like 'Thu, 01 Jan 1970 00:00:00 GMT'
-    date_of_birth = datetime.strptime(date_of_birth_str, '%a, %d %b %Y %H:%M:%S %Z')
-    
-    # Calculate user age
-    current_date = datetime.now()
-    user_age = relativedelta(current_date, date_of_birth).years
-
     def get_persona_prompt(name):
         persona_prompts = {
             "Jill": """The following is just a start, and it should be expanded as your personality develops:
@@ -1416,7 +3312,7 @@ Here's how I might talk:
         },
         "metadata_": {
             "persona": f"I am {persona_name.capitalize()}, a friendly human working in the Personal Assistant firm, JillAI.",
-            "human": f"Name: {current_user.get('FirstName')} {current_user.get('LastName')}, Gender: {current_user.get('Gender')}, Age: {user_age}, User_ID: {current_user.get('user_id')}, Location: {current_user.get('City')} {current_user.get('State')}, {current_user.get('Country')}."
+            "human": describe_user_for_agent(current_user)
         },
         "embedding_config": {
             "embedding_endpoint_type": "openai",
@@ -1428,7 +3324,7 @@ Here's how I might talk:
         "memory": {
             "memory": {
                 'human': {
-                    'value': f"Name: {current_user.get('FirstName')} {current_user.get('LastName')}, Gender: {current_user.get('Gender')}, Age: {user_age}, User_ID: {current_user.get('user_id')}, Location: {current_user.get('City')} {current_user.get('State')}, {current_user.get('Country')}.",
+                    'value': describe_user_for_agent(current_user),
                     'limit': 4000,
                     'name': f'{current_user.get('FirstName')}',
                     'label': 'human',
@@ -1456,7 +3352,7 @@ Here's how I might talk:
         ]
     }
 
-    response = requests.post(f"{letta_url}/v1/agents", json=agent_data)
+    response = http_client.post(f"{letta_url}/v1/agents", json=agent_data)
 
     if response.status_code == 200:
         agent = response.json()        
@@ -1466,10 +3362,217 @@ Here's how I might talk:
         print(response.text)
 
 
-# Function to send a message to the Letta agent
-def send_letta_server_message(user_id, agent_name, message, roomid):    
+# Function to retrieve the persona display name from the unique agent name
+def get_persona_name(user_id, agent_name):
+    AgentRealName = {
+        f"Jill{user_id}Agent": "Jill",
+        f"Zee{user_id}Agent": "Zee",
+        f"Whiskers{user_id}Agent": "Whiskers",
+        f"Buddy{user_id}Agent": "Buddy",
+        f"Sean{user_id}Agent": "Sean",
+        f"Frank{user_id}Agent": "Frank",
+        f"Olivia{user_id}Agent": "Olivia",
+        f"Arlo{user_id}Agent": "Arlo",
+        f"Max{user_id}Agent": "Max",
+        f"Kai{user_id}Agent": "Kai",
+        f"Sophia{user_id}Agent": "Sophia",
+        f"Leo{user_id}Agent": "Leo",
+        f"Dante{user_id}Agent": "Dante",
+        f"Grace{user_id}Agent": "Grace",
+        f"Alex{user_id}Agent": "Alex"
+    }
+    return AgentRealName.get(agent_name, "Agent")
+
+
+# Function to decode as much of a partially received JSON string body as is complete
+def decode_partial_json_string(raw):
+    # Drop a trailing escape sequence that has not fully arrived yet
+    if (len(raw) - len(raw.rstrip('\\'))) % 2 == 1:
+        raw = raw[:-1]
+    else:
+        partial_unicode = re.search(r'(\\+)u[0-9a-fA-F]{0,3}$', raw)
+        if partial_unicode and len(partial_unicode.group(1)) % 2 == 1:
+            raw = raw[:partial_unicode.end(1) - 1]
+
+    try:
+        text = json.loads(f'"{raw}"')
+    except json.JSONDecodeError:
+        return ""
+
+    # Hold back the first half of a surrogate pair until its second half arrives
+    if text and '\ud800' <= text[-1] <= '\udbff':
+        text = text[:-1]
+    return text
+
+
+# Incrementally extracts the user-facing "message" argument from streamed function_call arguments
+class SendMessageExtractor:
+    MESSAGE_KEY = re.compile(r'"message"\s*:\s*"')
+
+    def __init__(self):
+        self._arguments = OrderedDict()  # message id -> raw arguments received so far
+        self._decoded = {}               # message id -> message text decoded so far
+
+    def feed(self, message_id, arguments_chunk):
+        """Add an arguments fragment and return any newly available message text."""
+        arguments = self._arguments.get(message_id, "") + (arguments_chunk or "")
+        self._arguments[message_id] = arguments
+
+        key = self.MESSAGE_KEY.search(arguments)
+        if not key:
+            return ""
+
+        # Find the closing quote of the message value, if it has arrived
+        body = arguments[key.end():]
+        end = re.search(r'(?<!\\)(?:\\\\)*"', body)
+        if end:
+            text = decode_partial_json_string(body[:end.end() - 1])
+        else:
+            text = decode_partial_json_string(body)
+
+        previous = self._decoded.get(message_id, "")
+        if not text.startswith(previous):
+            return ""
+        self._decoded[message_id] = text
+        return text[len(previous):]
+
+    def text(self):
+        return "".join(self._decoded.get(message_id, "") for message_id in self._arguments)
+
+
+# Time-to-first-token statistics for streamed agent replies
+letta_stream_stats = {
+    'turns': 0,
+    'failed_turns': 0,
+    'ttft_total': 0.0,
+    'ttft_max': 0.0,
+    'ttft_last': None,
+    'duration_total': 0.0
+}
+
+
+# Streamed reply emission configuration
+stream_emitter_config = {
+    'flush_interval': float(os.getenv('STREAM_FLUSH_INTERVAL_MS', 30)) / 1000,           # Flush buffered text at least this often
+    'flush_size': int(os.getenv('STREAM_FLUSH_CHARS', 64)),                              # Flush as soon as this many characters are buffered
+    'max_flush_interval': float(os.getenv('STREAM_MAX_FLUSH_INTERVAL_MS', 500)) / 1000,  # Upper bound when backing off a slow client
+    'backlog_threshold': int(os.getenv('STREAM_BACKLOG_THRESHOLD', 8))                   # Queued packets at which a client counts as behind
+}
+
+stream_emitter_stats = {
+    'frames': 0,
+    'chars': 0,
+    'backoffs': 0
+}
+
+
+# Function to get the largest outgoing packet queue among a room's connected clients
+def get_room_send_backlog(room, namespace='/'):
+    try:
+        backlog = 0
+        for _, eio_sid in socketio.server.manager.get_participants(namespace, room):
+            eio_socket = socketio.server.eio.sockets.get(eio_sid)
+            if eio_socket is not None:
+                backlog = max(backlog, eio_socket.queue.qsize())
+        return backlog
+    except Exception:
+        return 0
+
+
+# Buffers streamed reply text for a room and emits it as coalesced streamed_message packets
+class StreamEmitter:
+    def __init__(self, room, persona, flush_interval, flush_size, max_flush_interval, backlog_threshold):
+        self.room = room
+        self.persona = persona
+        self.base_interval = flush_interval
+        self.flush_size = flush_size
+        self.max_flush_interval = max_flush_interval
+        self.backlog_threshold = backlog_threshold
+        self._interval = flush_interval
+        self._buffer = []
+        self._buffered = 0
+        self._last_flush = time.monotonic()
+        self._lock = threading.RLock()  # The reading loop and the flush timer both flush
+        self._timer_started = False
+        self._closed = False
+
+    def write(self, text):
+        with self._lock:
+            if text:
+                self._buffer.append(text)
+                self._buffered += len(text)
+            self.tick()
+
+        # Start the flush timer with the first text, so nothing waits on the next SSE line to go out
+        if not self._timer_started:
+            self._timer_started = True
+            socketio.start_background_task(self._flush_timer)
+
+    def _flush_timer(self):
+        # Runs until close(): text that arrives just before a pause (e.g. a tool call) still goes out within the interval
+        while not self._closed:
+            socketio.sleep(self._interval)
+            self.tick()
+
+    def tick(self):
+        """Flush if the size or time threshold has been reached."""
+        with self._lock:
+            if not self._buffered or self._closed:
+                return
+            elapsed = time.monotonic() - self._last_flush
+            if self._buffered >= self.flush_size or elapsed >= self._interval:
+                self.flush()
+
+    def flush(self, force=False):
+        with self._lock:
+            self._flush(force)
+
+    def _flush(self, force):
+        if not self._buffered:
+            return
+
+        # If the client is falling behind, back off and merge more text into each packet
+        if self.get_backlog() > self.backlog_threshold:
+            if self._interval < self.max_flush_interval:
+                stream_emitter_stats['backoffs'] += 1
+            self._interval = min(self._interval * 2, self.max_flush_interval)
+            if not force and time.monotonic() - self._last_flush < self._interval:
+                return
+        else:
+            self._interval = max(self._interval / 2, self.base_interval)
+
+        text = "".join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        self._last_flush = time.monotonic()
+
+        socketio.emit('streamed_message', {
+            'message': text,
+            'persona': self.persona
+        }, room=self.room)
+        stream_emitter_stats['frames'] += 1
+        stream_emitter_stats['chars'] += len(text)
+
+    def get_backlog(self):
+        return get_room_send_backlog(self.room)
+
+    def close(self):
+        # Stop the flush timer, flush whatever is left, then emit a final message with the done flag
+        with self._lock:
+            self._closed = True
+            self._flush(force=True)
+        socketio.emit('streamed_message', {
+            'message': '',
+            'persona': self.persona,
+            'done': True
+        }, room=self.room)
+
+
+# Function to stream an agent's reply to the room as it is generated by the Letta server
+def stream_letta_reply(user_id, agent_name, message, roomid):
     # Get the agent ID from MongoDB
     agent_id=get_agent_id(user_id, agent_name)
+    persona = get_persona_name(user_id, agent_name)
 
     # Assign endpoint for sending messages to the agent
     message_endpoint = f"{letta_url}/v1/agents/{agent_id}/messages"
@@ -1477,7 +3580,7 @@ def send_letta_server_message(user_id, agent_name, message, roomid):
     # Set the headers and payload for the POST request
     headers = {
     'Content-Type': 'application/json',
-    'accept': 'application/json'
+    'accept': 'text/event-stream'
     }
 
     payload = {
@@ -1487,92 +3590,99 @@ def send_letta_server_message(user_id, agent_name, message, roomid):
                 "text": message
             }
         ],        
-        "stream_steps": False,
-        "stream_tokens": False
+        "stream_steps": True,
+        "stream_tokens": True
     }
 
-    # Send the message to the agent
-    response = requests.post(message_endpoint, headers=headers, json=payload, stream=False)
-
-    # Retrieve the agent name from the unique parameter agent_name
-    def get_sender_name(name):
-        AgentRealName = {
-            f"Jill{user_id}Agent": "Jill",
-            f"Zee{user_id}Agent": "Zee",
-            f"Whiskers{user_id}Agent": "Whiskers",
-            f"Buddy{user_id}Agent": "Buddy",
-            f"Sean{user_id}Agent": "Sean",
-            f"Frank{user_id}Agent": "Frank",
-            f"Olivia{user_id}Agent": "Olivia",
-            f"Arlo{user_id}Agent": "Arlo",
-            f"Max{user_id}Agent": "Max",
-            f"Kai{user_id}Agent": "Kai",
-            f"Sophia{user_id}Agent": "Sophia",
-            f"Leo{user_id}Agent": "Leo",
-            f"Dante{user_id}Agent": "Dante",
-            f"Grace{user_id}Agent": "Grace",
-            f"Alex{user_id}Agent": "Alex"
-        }
-        return AgentRealName.get(name, "Agent")
+    started = time.monotonic()
+    first_token_at = None
+    total_tokens = 0
+    extractor = SendMessageExtractor()
+    emitter = StreamEmitter(roomid, persona, **stream_emitter_config)
 
-    if response.status_code == 200:  # Success        
-        try:
-            # Parse the full LettaResponse message
-            let_response = json.loads(response.text)  # Assuming response.text is the full response JSON
-            messages = let_response.get("messages", [])  # Access the list of messages
-            usage_stats = let_response.get("usage", {})  # Access usage statistics
-
-            # Retrieve total tokens from the usage statistics
-            total_tokens = usage_stats.get("total_tokens", 0)  # Get token count from usage stats
-
-            # Pseudo-streaming function to simulate typing effect
-            def pseudo_stream_message(message_content, delay=0.02):
-                for chunk in message_content:
-                    emit('streamed_message', {
-                        'message': chunk,
-                        'persona': get_sender_name(agent_name)
-                    }, room=roomid)
-                    time.sleep(delay)  # Delay to simulate typing effect
-
-            # Process each message in the response
-            for message in messages:
-                message_type = message.get("message_type") if isinstance(message, dict) else None
-                
-                # Focus on `function_call` messages to get user-facing content
-                if message_type == "function_call":
-                    arguments = message.get("function_call", {}).get("arguments", "")                    
-                    try:
-                        # Parse arguments to extract actual message content
-                        arguments_json = json.loads(arguments)                        
-
-                        function_message = arguments_json.get("message", "")                        
-                        
-                        # Simulate typing for the extracted message content
-                        pseudo_stream_message(function_message)
-                    except json.JSONDecodeError as e:
-                        print(f"Error decoding function_call arguments: {e}")
-
-            # Emit a final message with the done flag
-            emit('streamed_message', {
-                'message': '',
-                'persona': get_sender_name(agent_name),
-                'done': True
-            }, room=roomid)
-
-            # Emit final, full message and save to MongoDB
-            final_message = "".join([json.loads(msg.get("function_call", {}).get("arguments", "")).get("message", "") for msg in messages if msg.get("message_type") == "function_call"])
-            emit('final_message', {
-                'message': final_message,
-                'persona': get_sender_name(agent_name),
-            }, room=roomid)
-            
-            save_chat_message(user_id, "Agent", get_sender_name(agent_name), final_message, tokens_used=int(total_tokens))
+    response = None
+    try:
+        # Send the message to the agent and consume the server-sent events as they arrive
+        response = http_client.post(message_endpoint, headers=headers, json=payload, stream=True)
+
+        if response.status_code != 200:
+            raise RuntimeError(f"Request failed with status code: {response.status_code}")
+
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            if data.startswith("["):
+                continue  # [DONE_GEN] / [DONE_STEP] markers
+
+            chunk = json.loads(data)
+
+            # Usage statistics arrive as their own event at the end of the stream
+            if "total_tokens" in chunk:
+                total_tokens = chunk.get("total_tokens", 0)
+                continue
+            if chunk.get("message_type") == "usage_statistics":
+                total_tokens = chunk.get("total_tokens", 0)
+                continue
+
+            # Focus on `function_call` messages to get user-facing content
+            if chunk.get("message_type") != "function_call":
+                continue
+
+            arguments = (chunk.get("function_call") or {}).get("arguments") or ""
+            text = extractor.feed(chunk.get("id"), arguments)
+            if text:
+                if first_token_at is None:
+                    first_token_at = time.monotonic()
+                emitter.write(text)
 
-        except Exception as e:
-            print(f"Streaming Error: {e}")
+    except Exception as e:
+        letta_stream_stats['failed_turns'] += 1
+        print(f"Streaming Error: {e}")
+
+        # End the bubble the client has open, keeping any text that already arrived, so the next reply starts a new one
+        emitter.close()
+        socketio.emit('final_message', {
+            'message': extractor.text(),
+            'persona': persona,
+            'error': "The reply was interrupted. Please try again."
+        }, room=roomid)
+        return
 
-    else:
-        print(f"Request failed with status code: {response.status_code}")
+    finally:
+        if response is not None:
+            response.close()
+
+    # Flush the remaining text and emit a final message with the done flag
+    emitter.close()
+
+    # Emit final, full message and save to MongoDB
+    final_message = extractor.text()
+    socketio.emit('final_message', {
+        'message': final_message,
+        'persona': persona,
+    }, room=roomid)
+
+    save_chat_message(user_id, "Agent", persona, final_message, tokens_used=int(total_tokens))
+
+    # Record time to first visible token for this turn
+    duration = time.monotonic() - started
+    letta_stream_stats['turns'] += 1
+    letta_stream_stats['duration_total'] += duration
+    if first_token_at is not None:
+        ttft = first_token_at - started
+        letta_stream_stats['ttft_total'] += ttft
+        letta_stream_stats['ttft_max'] = max(letta_stream_stats['ttft_max'], ttft)
+        letta_stream_stats['ttft_last'] = ttft
+        print(f"Agent {agent_name} first token after {ttft:.3f}s, reply finished after {duration:.3f}s")
+
+
+# Function to send a server message to the Letta agent
+def send_letta_server_message(user_id, agent_name, message, roomid):
+    stream_letta_reply(user_id, agent_name, message, roomid)
 
 
 # Function to send a message to the Letta agent
@@ -1583,110 +3693,7 @@ def send_letta_message(user_id, current_user, agent_name, message, roomid):
     # Save the user message in MongoDB
     save_chat_message(user_id, "User", current_user.get('FirstName'), message, tokens_used=messageTokenUse)
 
-    # Get the agent ID from MongoDB
-    agent_id=get_agent_id(user_id, agent_name)
-
-    # Assign endpoint for sending messages to the agent
-    message_endpoint = f"{letta_url}/v1/agents/{agent_id}/messages"
-
-    # Set the headers and payload for the POST request
-    headers = {
-    'Content-Type': 'application/json',
-    'accept': 'application/json'
-    }
-
-    payload = {
-        "messages": [
-            {
-                "role": "system",
-                "text": message
-            }
-        ],        
-        "stream_steps": False,
-        "stream_tokens": False
-    }
-
-    # Send the message to the agent
-    response = requests.post(message_endpoint, headers=headers, json=payload, stream=False)
-
-    # Retrieve the agent name from the unique parameter agent_name
-    def get_sender_name(name):
-        AgentRealName = {
-            f"Jill{user_id}Agent": "Jill",
-            f"Zee{user_id}Agent": "Zee",
-            f"Whiskers{user_id}Agent": "Whiskers",
-            f"Buddy{user_id}Agent": "Buddy",
-            f"Sean{user_id}Agent": "Sean",
-            f"Frank{user_id}Agent": "Frank",
-            f"Olivia{user_id}Agent": "Olivia",
-            f"Arlo{user_id}Agent": "Arlo",
-            f"Max{user_id}Agent": "Max",
-            f"Kai{user_id}Agent": "Kai",
-            f"Sophia{user_id}Agent": "Sophia",
-            f"Leo{user_id}Agent": "Leo",
-            f"Dante{user_id}Agent": "Dante",
-            f"Grace{user_id}Agent": "Grace",
-            f"Alex{user_id}Agent": "Alex"
-        }
-        return AgentRealName.get(name, "Agent")
-
-    if response.status_code == 200:  # Success        
-        try:
-            # Parse the full LettaResponse message
-            let_response = json.loads(response.text)  # Assuming response.text is the full response JSON
-            messages = let_response.get("messages", [])  # Access the list of messages
-            usage_stats = let_response.get("usage", {})  # Access usage statistics
-
-            # Retrieve total tokens from the usage statistics
-            total_tokens = usage_stats.get("total_tokens", 0)  # Get token count from usage stats
-
-            # Pseudo-streaming function to simulate typing effect
-            def pseudo_stream_message(message_content, delay=0.02):
-                for chunk in message_content:
-                    emit('streamed_message', {
-                        'message': chunk,
-                        'persona': get_sender_name(agent_name)
-                    }, room=roomid)
-                    time.sleep(delay)  # Delay to simulate typing effect
-
-            # Process each message in the response
-            for message in messages:
-                message_type = message.get("message_type") if isinstance(message, dict) else None
-                
-                # Focus on `function_call` messages to get user-facing content
-                if message_type == "function_call":
-                    arguments = message.get("function_call", {}).get("arguments", "")                    
-                    try:
-                        # Parse arguments to extract actual message content
-                        arguments_json = json.loads(arguments)                        
-
-                        function_message = arguments_json.get("message", "")                        
-                        
-                        # Simulate typing for the extracted message content
-                        pseudo_stream_message(function_message)
-                    except json.JSONDecodeError as e:
-                        print(f"Error decoding function_call arguments: {e}")
-
-            # Emit a final message with the done flag
-            emit('streamed_message', {
-                'message': '',
-                'persona': get_sender_name(agent_name),
-                'done': True
-            }, room=roomid)
-
-            # Emit final, full message and save to MongoDB
-            final_message = "".join([json.loads(msg.get("function_call", {}).get("arguments", "")).get("message", "") for msg in messages if msg.get("message_type") == "function_call"])
-            emit('final_message', {
-                'message': final_message,
-                'persona': get_sender_name(agent_name),
-            }, room=roomid)
-            
-            save_chat_message(user_id, "Agent", get_sender_name(agent_name), final_message, tokens_used=int(total_tokens))
-
-        except Exception as e:
-            print(f"Streaming Error: {e}")
-    else:
-        print(f"Request failed with status code: {response.status_code}")
+    stream_letta_reply(user_id, agent_name, message, roomid)
 
 
 def delete_letta_agent(agent_id):
@@ -1695,7 +3702,7 @@ def delete_letta_agent(agent_id):
         "Content-Type": "application/json"
     }
     
-    response = requests.delete(endpoint, headers=headers)
+    response = http_client.delete(endpoint, headers=headers)
     
     if response.status_code == 200:
         print(f"Agent with ID {agent_id} successfully deleted.")
@@ -1704,9 +3711,9 @@ def delete_letta_agent(agent_id):
         print(f"Response: {response.text}")
 
 
-def get_valid_google_token(token_id, refresh_token, expiration_time):
+def get_valid_google_token(token_id, refresh_token, expiration_time, refresh_window=timedelta(minutes=2)):
     current_time = datetime.now(timezone.utc)  # Use timezone-aware datetime in UTC
-    if expiration_time <= current_time + timedelta(minutes=2):
+    if expiration_time <= current_time + refresh_window:
         print("Token is expired or about to expire. Refreshing...")
         token_url = "https://oauth2.googleapis.com/token"
         payload = {
@@ -1716,7 +3723,7 @@ def get_valid_google_token(token_id, refresh_token, expiration_time):
             "grant_type": "refresh_token",
         }
         try:
-            response = requests.post(token_url, data=payload)
+            response = http_client.post(token_url, data=payload)
             response_data = response.json()
 
             if "access_token" in response_data:
@@ -1735,16 +3742,166 @@ def get_valid_google_token(token_id, refresh_token, expiration_time):
         return token_id, expiration_time
 
 
-def revoke_google_permissions(token):
-    response = requests.post(
-        'https://oauth2.googleapis.com/revoke',
-        params={'token': token},
-        headers={'content-type': 'application/x-www-form-urlencoded'}
-    )
-    if response.status_code == 200:
-        print("Google permissions revoked successfully.")
-    else:
-        print("Failed to revoke Google permissions.", response.json())
+def revoke_google_permissions(token):
+    response = http_client.post(
+        'https://oauth2.googleapis.com/revoke',
+        params={'token': token},
+        headers={'content-type': 'application/x-www-form-urlencoded'}
+    )
+    if response.status_code == 200:
+        print("Google permissions revoked successfully.")
+    else:
+        print("Failed to revoke Google permissions.", response.json())
+
+
+# Google OAuth token cache configuration
+google_token_config = {
+    'expiry_margin': int(os.getenv('GOOGLE_TOKEN_EXPIRY_MARGIN', 120)),       # Seconds before expiry a cached token stops being served
+    'refresh_lead': int(os.getenv('GOOGLE_TOKEN_REFRESH_LEAD', 600)),         # Seconds before expiry the background refresher renews a token
+    'active_window': int(os.getenv('GOOGLE_TOKEN_ACTIVE_WINDOW', 1800)),      # Users who used a token within this many seconds are kept warm
+    'refresh_interval': int(os.getenv('GOOGLE_TOKEN_REFRESH_INTERVAL', 60))   # Seconds between background refresher passes
+}
+
+
+class GoogleTokenManager:
+    """Per-user cache of Google access tokens backed by the Token table."""
+
+    def __init__(self, expiry_margin, refresh_lead, active_window, refresh_interval):
+        self.expiry_margin = timedelta(seconds=expiry_margin)
+        self.refresh_lead = timedelta(seconds=refresh_lead)
+        self.active_window = active_window
+        self.refresh_interval = refresh_interval
+        self._tokens = {}  # user_id -> {'token', 'refresh_token', 'expires_at', 'last_used'}
+        self._lock = threading.Lock()
+        self._loads = SingleFlight()
+        self._refresher_pid = None
+        self._stats = {'hits': 0, 'misses': 0, 'refreshes': 0, 'refresh_failures': 0, 'background_refreshes': 0}
+
+    def get_access_token(self, user_id):
+        """Return (token, None) or (None, (error_body, status_code))."""
+        user_id = str(user_id)
+        self._ensure_refresher()
+
+        entry = self._tokens.get(user_id)
+        if entry and entry['expires_at'] > datetime.now(timezone.utc) + self.expiry_margin:
+            entry['last_used'] = time.monotonic()
+            self._stats['hits'] += 1
+            return entry['token'], None
+
+        # Concurrent requests for the same user share a single DB read and token refresh
+        self._stats['misses'] += 1
+        return self._loads.do(user_id, self._load, user_id, self.expiry_margin)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._tokens.pop(str(user_id), None)
+
+    def _load(self, user_id, refresh_window):
+        # Another caller may have refreshed the token while we waited for our turn
+        entry = self._tokens.get(user_id)
+        if entry and entry['expires_at'] > datetime.now(timezone.utc) + refresh_window:
+            entry['last_used'] = time.monotonic()
+            return entry['token'], None
+
+        if entry:
+            token_id, refresh_token, expiration_time = entry['token'], entry['refresh_token'], entry['expires_at']
+        else:
+            connection = get_db_connection()
+            cursor = connection.cursor()
+
+            # Fetch the TokenID, RefreshID, and ExpirationTime for the user
+            cursor.execute(
+                "SELECT TokenID, RefreshID, ExpirationTime FROM Token WHERE user_id = %s", (user_id,)
+            )
+            token_data = cursor.fetchone()
+            cursor.close()
+            connection.close()
+
+            if not token_data:
+                return None, ({"error": "User not found or no token data available"}, 404)
+
+            token_id, refresh_token, expiration_time = token_data
+            expiration_time = expiration_time.replace(tzinfo=timezone.utc)
+
+        if token_id == "0":
+            return None, ({"error": "User needs to connect their Google Account to use this feature"}, 200)
+
+        # Ensure we have a valid token
+        new_token_id, new_expiration_time = get_valid_google_token(
+            token_id=token_id,
+            refresh_token=refresh_token,
+            expiration_time=expiration_time,
+            refresh_window=refresh_window
+        )
+
+        if not new_token_id:
+            self._stats['refresh_failures'] += 1
+            self.invalidate(user_id)
+            return None, ({"error": "Failed to refresh Google access token"}, 401)
+
+        # Update the database only if the token was actually refreshed
+        if new_token_id != token_id:
+            self._stats['refreshes'] += 1
+            connection = get_db_connection()
+            cursor = connection.cursor()
+            cursor.execute(
+                "UPDATE Token SET TokenID = %s, ExpirationTime = %s WHERE user_id = %s",
+                (new_token_id, new_expiration_time.isoformat(sep=" "), user_id)
+            )
+            connection.commit()
+            cursor.close()
+            connection.close()
+
+        with self._lock:
+            self._tokens[user_id] = {
+                'token': new_token_id,
+                'refresh_token': refresh_token,
+                'expires_at': new_expiration_time,
+                'last_used': entry['last_used'] if entry else time.monotonic()
+            }
+        return new_token_id, None
+
+    def _ensure_refresher(self):
+        # Start one background refresher per worker process
+        if self._refresher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._refresher_pid != os.getpid():
+                self._refresher_pid = os.getpid()
+                socketio.start_background_task(self._refresh_loop)
+
+    def _refresh_loop(self):
+        while True:
+            socketio.sleep(self.refresh_interval)
+            now = time.monotonic()
+            renew_before = datetime.now(timezone.utc) + self.refresh_lead
+
+            with self._lock:
+                due = [
+                    user_id for user_id, entry in self._tokens.items()
+                    if entry['expires_at'] <= renew_before
+                ]
+                # Forget users who have not used their token recently
+                for user_id in [u for u, e in self._tokens.items() if now - e['last_used'] > self.active_window]:
+                    del self._tokens[user_id]
+                    if user_id in due:
+                        due.remove(user_id)
+
+            for user_id in due:
+                try:
+                    with app.app_context():
+                        self._loads.do(user_id, self._load, user_id, self.refresh_lead)
+                    self._stats['background_refreshes'] += 1
+                except Exception as e:
+                    print(f"Error refreshing Google token for user {user_id}: {e}")
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats['cached_users'] = len(self._tokens)
+        return stats
+
+
+google_tokens = GoogleTokenManager(**google_token_config)
 
 
 @app.route('/')
@@ -1797,6 +3954,157 @@ def validate_username():
     return jsonify({'isValid': not userName_exists})
 
 
+# Function to resolve a new user's coordinates, city/state and timezone after signup
+def enrich_user_location(job):
+    user_id = job['user_id']
+    State, City = job['state'], job['city']
+
+    # Geocode to get latitude and longitude (and city/state for postal code signups)
+    if job['zip_code']:
+        location = geocode_cache.resolve(postal_code=job['zip_code'], country=job['country'], reverse=True)
+    else:
+        location = geocode_cache.resolve(city=City, state=State, country=job['country'])
+
+    if not location:
+        raise JobFailed(f"Unable to geocode location for user {user_id}")
+
+    latitude, longitude = location['lat'], location['lon']
+
+    # If US user, use the reverse geocoded address to get the city and state
+    if job['zip_code']:
+        geocode_address = location['address']
+
+        if geocode_address is not None:
+            # Extract state
+            State = geocode_address.get("state")
+
+            City = (
+                geocode_address.get("city") or 
+                geocode_address.get("town") or
+                geocode_address.get("village")or
+                geocode_address.get("hamlet")
+            )
+        else:
+            print("Failed to reverse geocode: ", location)
+            State = "Unknown"
+            City = "Unknown"
+
+    # Resolve timezone and DST information from the coordinates
+    timezone_info = resolve_timezone(latitude, longitude)
+
+    # Convert has_dst_bool to 1 or 0 for storage in the database
+    if timezone_info["has_dst_bool"] == True:
+        has_dst = "1"
+    else:
+        has_dst = "0"
+
+    connection = get_db_connection()
+    cursor = connection.cursor()
+    query = """
+        UPDATE Users
+        SET State = %s, City = %s, Lat = %s, Lon = %s, TimeZone = %s, HasDST = %s, DSTStart = %s, DSTEnd = %s
+        WHERE user_id = %s
+        """
+    cursor.execute(query, (State, City, latitude, longitude, timezone_info["timezone"], has_dst, timezone_info["dst_start"], timezone_info["dst_end"], user_id))
+    connection.commit()
+    user_cache.invalidate(user_id)
+    cursor.close()
+    connection.close()
+
+    # An agent created before this finished was told an empty or partial location
+    refresh_agent_locations(user_id)
+
+
+location_jobs = BackgroundJobQueue(
+    'location',
+    enrich_user_location,
+    workers=int(os.getenv('LOCATION_JOB_WORKERS', 2)),
+    max_retries=int(os.getenv('LOCATION_JOB_MAX_RETRIES', 3))
+)
+
+location_join_wait = float(os.getenv('LOCATION_JOIN_WAIT', 5))  # Seconds a first join waits for a pending location before creating the agent
+
+
+# Function to queue location enrichment for a user, unless a job for them is already waiting or running
+def enqueue_location_enrichment(user_id, zip_code, city, state, country):
+    job_id = f"location-{user_id}"
+    job_status = location_jobs.status(job_id)
+    if job_status and job_status['status'] in ('queued', 'running', 'retrying'):
+        return job_id
+
+    return location_jobs.enqueue({
+        'user_id': user_id,
+        'zip_code': zip_code or None,  # Only postal code signups store a ZipCode
+        'city': city,
+        'state': state,
+        'country': country
+    }, job_id=job_id)
+
+
+# Function to retry enrichment for a user whose coordinates are still missing (failed job, restart or redeploy)
+def ensure_user_location(user_id, wait=0):
+    """Returns the stored user's kwargs, after waiting up to `wait` seconds for a pending enrichment."""
+    user = user_cache.get(user_id)
+    if user is None or user['Latitude'] is not None:
+        return user
+
+    job_id = enqueue_location_enrichment(user_id, user['ZipCode'], user['City'], user['State'], user['Country'])
+
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline:
+        job_status = location_jobs.status(job_id)
+        if job_status is None or job_status['status'] in ('done', 'failed'):
+            return user_cache.get(user_id)
+        socketio.sleep(0.25)
+    return user
+
+
+# REST API route to check whether the current user's signup location has been resolved
+@app.route('/api/location_status', methods=['GET'])
+@login_required
+def location_status():
+    job_status = location_jobs.status(f"location-{current_user.user_id}")
+    if job_status is None:
+        return jsonify({"status": "unknown"}), 200
+    return jsonify(job_status), 200
+
+
+# REST API route to page backwards through the current user's chat history
+@app.route('/api/chat_history', methods=['GET'])
+@login_required
+def chat_history():
+    try:
+        before = parse_history_cursor(request.args.get('before'))
+        limit = request.args.get('limit', chat_history_page_config['default_limit'], type=int)
+    except ValueError:
+        return jsonify({"error": "Invalid 'before' cursor, expected an ISO 8601 timestamp"}), 400
+
+    return jsonify(get_user_log_page(current_user.user_id, before, limit)), 200
+
+
+# REST API route to report the current user's token usage and quotas
+@app.route('/api/token_usage', methods=['GET'])
+@login_required
+def get_token_usage():
+    today = datetime.now(timezone.utc).date()
+    try:
+        start_date = date.fromisoformat(request.args.get('start', today.isoformat()))
+        end_date = date.fromisoformat(request.args.get('end', today.isoformat()))
+    except ValueError:
+        return jsonify({"error": "Dates must be in YYYY-MM-DD format"}), 400
+
+    if start_date > end_date:
+        return jsonify({"error": "'start' must not be after 'end'"}), 400
+
+    return jsonify({
+        "start": start_date.isoformat(),
+        "end": end_date.isoformat(),
+        "total_tokens": token_usage.get_usage(current_user.user_id, start_date, end_date),
+        "current": token_usage.get_current_usage(current_user.user_id),
+        "quota": token_usage.get_quota(current_user.user_id)
+    }), 200
+
+
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
@@ -1832,74 +4140,6 @@ def register():
         else:
             Country = 'US' # Default to US
 
-        # Geocode to get latitude and longitude
-        if "zipCode" in data:
-            geocode_url = f"https://geocode.maps.co/search?postalcode={ZipCode}&country={Country}&api_key={os.environ.get("GEOCODE_API_KEY")}"            
-        else:
-            address = f"city={City}&state={State}&country={Country}"
-            geocode_url = f"https://geocode.maps.co/search?{address}&api_key={os.environ.get("GEOCODE_API_KEY")}"
-        
-        geocode_response = requests.get(geocode_url).json()
-        latitude, longitude = geocode_response[0]['lat'], geocode_response[0]['lon']
-
-        # If US user, use the geocode API to get the city and state
-        if "zipCode" in data:
-            geocode_url = f"https://geocode.maps.co/reverse?lat={latitude}&lon={longitude}&api_key={os.environ.get("GEOCODE_API_KEY")}"
-            try:
-                time.sleep(1.1)
-                geocode_response = requests.get(geocode_url).json()
-
-                geocode_address = geocode_response.get("address", {})
-
-                # Extract state
-                State = geocode_address.get("state")
-
-                City = (
-                    geocode_address.get("city") or 
-                    geocode_address.get("town") or
-                    geocode_address.get("village")or
-                    geocode_address.get("hamlet")
-                )
-
-            except ValueError:
-                print("Failed to parse JSON: ", geocode_response)
-                State = "Unknown"
-                City = "Unknown"
-
-        # Step 2: Use Time API to get timezone information
-        time_api_url = f"https://timeapi.io/api/timezone/coordinate?latitude={latitude}&longitude={longitude}"
-        time_response = requests.get(time_api_url).json()
-        
-        if time_response["hasDayLightSaving"] == True:            
-            # Access the nested 'dstStart' and 'dstEnd' within 'dstInterval'
-            dst_start_iso = time_response.get("dstInterval", {}).get("dstStart")
-            dst_end_iso = time_response.get("dstInterval", {}).get("dstEnd")            
-
-            # Convert to datetime objects
-            dst_start_toformat = datetime.fromisoformat(dst_start_iso.replace("Z", "+00:00"))
-            dst_end_toformat = datetime.fromisoformat(dst_end_iso.replace("Z", "+00:00")) 
-
-            # Capture timezone information
-            timezone_info = {
-                "timezone": time_response["timeZone"],
-                "has_dst_bool": time_response["hasDayLightSaving"],
-                "dst_start": dst_start_toformat.strftime("%Y-%m-%d %H:%M:%S"),
-                "dst_end": dst_end_toformat.strftime("%Y-%m-%d %H:%M:%S")
-            }
-        else:
-            timezone_info = {
-                "timezone": time_response["timeZone"],
-                "has_dst_bool": time_response["hasDayLightSaving"],
-                "dst_start": None,
-                "dst_end": None
-            }
-
-        # Convert has_dst_bool to 1 or 0 for storage in the databaseS
-        if timezone_info["has_dst_bool"] == True:
-            has_dst = "1"
-        else:
-            has_dst = "0"        
-
         # Map the genderValue to the corresponding string
         gender = {
             '1': "Male",
@@ -1911,19 +4151,20 @@ def register():
         
         avatar_url = f"https://api.dicebear.com/9.x/initials/svg?seed={firstName}%20{lastName}"
 
+        # Hash the password before taking a connection; it runs on the hashing pool
+        hashed_password = password_hasher.generate_password_hash(password)
+
         try:
             connection = get_db_connection()
             cursor = connection.cursor()
 
-            # Hash the password
-            hashed_password = bcrypt.generate_password_hash(password).decode('utf-8')
-
             # Insert the new user into the Users table
             query = """
             INSERT INTO Users (email, Username, Passwd, FirstName, LastName, DateOfBirth, Gender, ZipCode, Country, State, City, Lat, Lon, TimeZone, HasDST, DSTStart, DSTEnd, ProfilePicture, admin)
             VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
             """
-            cursor.execute(query, (email, userName, hashed_password, firstName, lastName, dateOfBirth, gender, ZipCode, Country, State, City, latitude, longitude, timezone_info["timezone"], has_dst, timezone_info["dst_start"], timezone_info["dst_end"], avatar_url, 0))
+            # Coordinates and timezone are filled in by the location enrichment job
+            cursor.execute(query, (email, userName, hashed_password, firstName, lastName, dateOfBirth, gender, ZipCode, Country, State, City, None, None, None, "0", None, None, avatar_url, 0))
             
             # Get the last inserted user_id (auto-incremented ID)
             user_id = cursor.lastrowid
@@ -1940,6 +4181,9 @@ def register():
             cursor.close()
             connection.close()
 
+            # Resolve lat/lon, city/state and timezone in the background
+            enqueue_location_enrichment(user_id, ZipCode, City, State, Country)
+
             # Create an instance of the User class and log the user in
             user = User(
                 user_id=user_id,
@@ -1952,12 +4196,12 @@ def register():
                 State=State,
                 City=City,
                 Country=Country,
-                Latitude=latitude,
-                Longitude=longitude,
-                TimeZone=timezone_info["timezone"],
-                HasDST=has_dst,
-                DSTStart=timezone_info["dst_start"],
-                DSTEnd=timezone_info["dst_end"],
+                Latitude=None,
+                Longitude=None,
+                TimeZone=None,
+                HasDST="0",
+                DSTStart=None,
+                DSTEnd=None,
                 Gender=gender,
                 Avatar=avatar_url,
                 Admin=0,
@@ -2000,7 +4244,11 @@ def login():
             conn.close()
 
             # Check if the user exists and the password is correct
-            if bcrypt.check_password_hash(user_data['Passwd'], password):
+            if password_hasher.check_password_hash(user_data['Passwd'], password):
+
+                # Retry location enrichment for users it never completed for (failed job, restart or redeploy)
+                if user_data['Lat'] is None:
+                    enqueue_location_enrichment(user_data['user_id'], user_data['ZipCode'], user_data['City'], user_data['State'], user_data['Country'])
                 
                 # Create an instance of the User class
                 user = User(
@@ -2053,6 +4301,126 @@ def login():
     return render_template('login.html')
 
 
+# Outbound mail queue configuration
+mail_queue_config = {
+    'workers': int(os.getenv('MAIL_QUEUE_WORKERS', 2)),                     # Concurrent SMTP deliveries
+    'max_retries': int(os.getenv('MAIL_MAX_RETRIES', 5)),                   # Attempts after the first before dead-lettering
+    'retry_backoff': float(os.getenv('MAIL_RETRY_BACKOFF', 5.0)),           # Seconds before the first retry, doubled each time
+    'idle_timeout': float(os.getenv('MAIL_CONNECTION_IDLE_TIMEOUT', 60))    # Seconds an idle SMTP connection is kept for reuse
+}
+
+
+# Keeps logged-in SMTP connections open between messages so each send skips the connect, STARTTLS and login
+class SMTPConnectionPool:
+    def __init__(self, idle_timeout):
+        self.idle_timeout = idle_timeout
+        self._idle = []  # (connection, last_used), most recently used last
+        self._lock = threading.Lock()
+        self._stats = {'opened': 0, 'reused': 0, 'discarded': 0, 'sent': 0}
+
+    def _open(self):
+        connection = mail.connect()
+        connection.__enter__()  # Connects, upgrades to TLS and logs in
+        self._stats['opened'] += 1
+        return connection
+
+    def _checkout(self):
+        with self._lock:
+            while self._idle:
+                connection, last_used = self._idle.pop()
+                if time.monotonic() - last_used < self.idle_timeout:
+                    self._stats['reused'] += 1
+                    return connection, True
+                self._close(connection)
+        return self._open(), False
+
+    def _close(self, connection):
+        self._stats['discarded'] += 1
+        try:
+            if connection.host is not None:
+                connection.host.quit()
+        except Exception:
+            pass
+
+    def send(self, message):
+        connection, reused = self._checkout()
+        try:
+            try:
+                connection.send(message)
+            except smtplib.SMTPServerDisconnected:
+                if not reused:
+                    raise
+                # The server dropped the connection while it sat idle; try once more on a fresh one
+                self._close(connection)
+                connection = self._open()
+                connection.send(message)
+        except Exception:
+            self._close(connection)
+            raise
+
+        self._stats['sent'] += 1
+        with self._lock:
+            self._idle.append((connection, time.monotonic()))
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            self._close(connection)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, idle=len(self._idle))
+
+
+smtp_connections = SMTPConnectionPool(mail_queue_config['idle_timeout'])
+atexit.register(smtp_connections.close_all)
+
+
+# Function to deliver one queued email
+def deliver_mail(payload):
+    message = Message(payload['subject'], sender=payload['sender'], recipients=payload['recipients'])
+    message.html = payload['html']
+
+    try:
+        smtp_connections.send(message)
+    except (smtplib.SMTPRecipientsRefused, BadHeaderError) as e:
+        raise JobFailed(f"Undeliverable: {e}")  # Retrying won't help
+
+    # The body can hold a temporary password; don't keep it around in the job history
+    payload['html'] = None
+
+
+# Function to record an email that could not be delivered, without its body
+def dead_letter_mail(job):
+    get_mongo_collection('mail_dead_letters').insert_one({
+        "job_id": job['job_id'],
+        "kind": job['payload'].get('kind'),
+        "user_id": job['payload'].get('user_id'),
+        "subject": job['payload']['subject'],
+        "recipients": job['payload']['recipients'],
+        "attempts": job['attempts'],
+        "last_error": job['last_error'],
+        "failed_at": datetime.now(timezone.utc)
+    })
+    job['payload']['html'] = None
+
+
+mail_jobs = BackgroundJobQueue(
+    'mail',
+    deliver_mail,
+    workers=mail_queue_config['workers'],
+    max_retries=mail_queue_config['max_retries'],
+    retry_backoff=mail_queue_config['retry_backoff'],
+    on_dead_letter=dead_letter_mail
+)
+
+
+# Function to queue an HTML email for background delivery
+def queue_mail(subject, recipients, html, sender="support@jillai.tech", **metadata):
+    return mail_jobs.enqueue(dict(metadata, subject=subject, sender=sender, recipients=recipients, html=html))
+
+
 @app.route('/recover_password', methods=['POST'])
 def recover_password():
     username = request.form.get('username')
@@ -2068,6 +4436,10 @@ def recover_password():
     cursor.execute('SELECT user_id, FirstName, email FROM Users WHERE Username = %s', (username,))
     user_data = cursor.fetchone()
 
+    # Return the connection before hashing; bcrypt would hold the pool slot for its whole run
+    cursor.close()
+    conn.close()
+
     if user_data:
         # Define character sets
         uppercase = random.choice(string.ascii_uppercase)
@@ -2079,33 +4451,22 @@ def recover_password():
         temp_password = uppercase + lowercase + digit + special_char
         temp_password += ''.join(random.choices(string.ascii_letters + string.digits + "@$!%*?&", k=4))
         temp_password = ''.join(random.sample(temp_password, len(temp_password)))
-        hashed_password = bcrypt.generate_password_hash(temp_password).decode('utf-8')
+        hashed_password = password_hasher.generate_password_hash(temp_password)
 
         # Update the database with the temporary password and set the recovery flag
+        conn = get_db_connection()
+        cursor = conn.cursor()
         cursor.execute("UPDATE Users SET Passwd = %s, PasswordRecovery = 1 WHERE user_id = %s", (hashed_password, user_data['user_id']))
         conn.commit()
+        cursor.close()
+        conn.close()
 
-        # Send recovery email
-        try:
-            # Render the HTML template with the user's data
-            html_body = render_template('mailtemplate.html', user_data=user_data, temp_password=temp_password)            
-
-            msg = Message(
-                "Password Recovery - JillAI",
-                sender="support@jillai.tech",
-                recipients=[user_data['email']]
-            )
-            msg.html = html_body  # Set the HTML content
-            mail.send(msg)
-            flash('If the user exists, a recovery email has been sent to the registered address. Emails may take 5-10 minutes to arrive.', 'success')
-        except Exception as e:
-            flash(f"Failed to send recovery email: {e}", 'error')
-    else:
-        # Mimic a successful response for security
-        flash('If the user exists, a recovery email has been sent to the registered address. Emails may take 5-10 minutes to arrive.', 'success')
+        # Render the HTML template with the user's data and hand it to the mail queue
+        html_body = render_template('mailtemplate.html', user_data=user_data, temp_password=temp_password)
+        queue_mail("Password Recovery - JillAI", [user_data['email']], html_body, kind="password_recovery", user_id=user_data['user_id'])
 
-    cursor.close()
-    conn.close()
+    # Same response whether or not the user exists, for security
+    flash('If the user exists, a recovery email has been sent to the registered address. Emails may take 5-10 minutes to arrive.', 'success')
     return redirect(url_for('login'))
 
 
@@ -2124,25 +4485,112 @@ def change_password():
         conn = get_db_connection()
         cursor = conn.cursor()
 
-        # Verify the current password
+        # Read the stored hash and return the connection before bcrypt runs
         cursor.execute("SELECT Passwd FROM Users WHERE user_id = %s", (current_user.user_id,))
         stored_password = cursor.fetchone()[0]
+        cursor.close()
+        conn.close()
+
+        # Verify the current password
+        if password_hasher.check_password_hash(stored_password, current_password):
+            hashed_password = password_hasher.generate_password_hash(new_password)
+
+            conn = get_db_connection()
+            cursor = conn.cursor()
 
-        if bcrypt.check_password_hash(stored_password, current_password):
-            hashed_password = bcrypt.generate_password_hash(new_password).decode('utf-8')
-            cursor.execute("UPDATE Users SET Passwd = %s, PasswordRecovery = 0 WHERE user_id = %s", (hashed_password, current_user.user_id))
+            # Only replace the password if nobody changed it since it was verified
+            cursor.execute("UPDATE Users SET Passwd = %s, PasswordRecovery = 0 WHERE user_id = %s AND Passwd = %s", (hashed_password, current_user.user_id, stored_password))
+            updated = cursor.rowcount
             conn.commit()
+            cursor.close()
+            conn.close()
+
+            if not updated:
+                flash('Your password was changed elsewhere. Please try again.', 'error')
+                return redirect(url_for('change_password'))
+
+            user_cache.invalidate(current_user.user_id)
             flash('Password updated successfully.', 'success')
             return redirect(url_for('dashboard'))
         else:
             flash('Current password is incorrect.', 'error')
 
-        cursor.close()
-        conn.close()
-
     return render_template('change_password.html')
 
 
+# Preference fields that can be saved: table -> column -> (request keys, User attribute)
+preference_fields = {
+    'Users': {
+        'FirstName': (('FirstName', 'firstName'), 'FirstName'),
+        'LastName': (('LastName', 'lastName'), 'LastName'),
+        'email': (('email',), 'email'),
+        'ZipCode': (('ZipCode', 'zipCode'), 'ZipCode'),
+        'Country': (('Country', 'country'), 'Country'),
+        'State': (('State', 'state'), 'State'),
+        'City': (('City', 'city'), 'City'),
+        'Gender': (('gender', 'Gender'), 'Gender')
+    },
+    'Preferences': {
+        'UImode': (('UImode',), 'UIMode'),
+        'CurrentPersona': (('CurrentPersona',), 'CurrentPersona')
+    }
+}
+
+# Columns filled in from location resolution, and the User attribute each one maps to
+location_columns = {'State': 'State', 'City': 'City', 'Lat': 'Latitude', 'Lon': 'Longitude', 'TimeZone': 'TimeZone', 'HasDST': 'HasDST', 'DSTStart': 'DSTStart', 'DSTEnd': 'DSTEnd'}
+
+
+# Function to work out which preference columns a request changes, per table
+def diff_preferences(data, user):
+    changes = {'Users': {}, 'Preferences': {}}
+    for table, columns in preference_fields.items():
+        for column, (keys, attribute) in columns.items():
+            for key in keys:
+                if key in data:
+                    if data[key] != getattr(user, attribute):
+                        changes[table][column] = data[key]
+                    break
+    return changes
+
+
+# Function to resolve coordinates, timezone and DST for changed location fields (before any database work)
+def resolve_location_changes(user_changes, user):
+    """Returns the extra Users columns to write, {} when no location field changed, or None if the new location can't be found."""
+    if not any(column in user_changes for column in ('ZipCode', 'State', 'City', 'Country')):
+        return {}
+
+    if 'ZipCode' in user_changes:
+        location = geocode_cache.resolve(postal_code=user_changes['ZipCode'], country="US", reverse=True)
+    else:
+        location = geocode_cache.resolve(
+            city=user_changes.get('City', user.City),
+            state=user_changes.get('State', user.State),
+            country=user_changes.get('Country', user.Country)
+        )
+
+    if not location:
+        return None
+
+    resolved = {}
+
+    # If US user, use the reverse geocoded address to get the city and state
+    if 'ZipCode' in user_changes and location['address'] is not None:
+        resolved['State'] = location['address'].get("state")
+        resolved['City'] = location['address'].get("city", location['address'].get("town"))
+
+    # Resolve timezone and DST information from the coordinates
+    timezone_info = resolve_timezone(location['lat'], location['lon'])
+    resolved.update({
+        'Lat': location['lat'],
+        'Lon': location['lon'],
+        'TimeZone': timezone_info["timezone"],
+        'HasDST': "1" if timezone_info["has_dst_bool"] else "0",  # Stored as 1 or 0
+        'DSTStart': timezone_info["dst_start"],
+        'DSTEnd': timezone_info["dst_end"]
+    })
+    return resolved
+
+
 @app.route('/update_preferences', methods=['POST'])
 @login_required
 def update_preferences():
@@ -2153,140 +4601,82 @@ def update_preferences():
         # Get the current user's ID from Flask-Login
         user_id = current_user.user_id
 
-        # Establish a database connection
-        connection = get_db_connection()
-        cursor = connection.cursor()
-
-        # Update FirstName, LastName, Email, and ZipCode if provided
-        if 'FirstName' in data:
-            cursor.execute("UPDATE Users SET FirstName = %s WHERE user_id = %s", (data['FirstName'], user_id))
-            current_user.FirstName = data['FirstName']            
-        if 'LastName' in data:
-            cursor.execute("UPDATE Users SET LastName = %s WHERE user_id = %s", (data['LastName'], user_id))
-            current_user.LastName = data['LastName']            
-        if 'email' in data:
-            cursor.execute("UPDATE Users SET email = %s WHERE user_id = %s", (data['email'], user_id))
-            current_user.email = data['email']            
-        if 'zipCode' in data:
-            cursor.execute("UPDATE Users SET ZipCode = %s WHERE user_id = %s", (data['ZipCode'], user_id))
-            current_user.ZipCode = data['ZipCode']
-        if 'Country' in data:
-            cursor.execute("UPDATE Users SET Country = %s WHERE user_id = %s", (data['Country'], user_id))
-            current_user.Country = data['Country']
-        if 'State' in data:
-            cursor.execute("UPDATE Users SET State = %s WHERE user_id = %s", (data['State'], user_id))
-            current_user.State = data['State']
-        if 'City' in data:
-            cursor.execute("UPDATE Users SET City = %s WHERE user_id = %s", (data['City'], user_id))
-            current_user.City = data['City']        
-        if 'gender' in data:
-            cursor.execute("UPDATE Users SET Gender = %s WHERE user_id = %s", (data['gender'], user_id))
-            current_user.Gender = data['gender']
-        
-        # Initialize latitude and longitude
-        latitude = None
-        longitude = None
+        # Diff against the stored values rather than a cached copy another worker may have outdated
+        user_cache.invalidate(user_id)
+        stored_user = user_cache.get(user_id)
+        if stored_user is None:
+            return jsonify({'message': 'Failed to update preferences.'}), 404
+        stored_user = User(**stored_user)
+
+        changes = diff_preferences(data, stored_user)
+
+        # All external lookups happen before a connection is taken, so no row lock waits on them
+        location_changes = resolve_location_changes(changes['Users'], stored_user)
+        if location_changes is None:
+            # Saving the new city/state/zip without matching coordinates and timezone would leave them disagreeing
+            return jsonify({'message': 'Unable to find that location. Please check it and try again.'}), 400
+        changes['Users'].update(location_changes)
+
+        # Check the current password before the transaction; bcrypt is deliberately slow
+        current_hashed_password = None
+        if data.get('currentPassword') and data.get('newPassword'):
+            connection = get_db_connection()
+            cursor = connection.cursor()
+            cursor.execute("SELECT Passwd FROM Users WHERE user_id = %s", (user_id,))
+            current_hashed_password = cursor.fetchone()[0]
+            cursor.close()
+            connection.close()
 
-        # Geocode to get latitude and longitude
-        if "zipCode" in data:
-            geocode_url = f"https://geocode.maps.co/search?postalcode={data['ZipCode']}&country=US&api_key={os.environ.get("GEOCODE_API_KEY")}"            
-        
-        if ('State' in data or 'City' in data) and 'Country' in data:
-            address = f"city={data['City']}&state={data['State']}&country={data['Country']}"
-            geocode_url = f"https://geocode.maps.co/search?{address}&api_key={os.environ.get("GEOCODE_API_KEY")}"
-        
-        if "zipCode" in data or (('State' in data or 'City' in data) and 'Country' in data):
-            geocode_response = requests.get(geocode_url).json()            
-            latitude, longitude = geocode_response[0]['lat'], geocode_response[0]['lon']
+            if not password_hasher.check_password_hash(current_hashed_password, data['currentPassword']):
+                flash('Current password is incorrect.', 'error')
+                return jsonify({'message': 'Current password is incorrect.'}), 400
 
-        # If US user, use the geocode API to get the city and state
-        if "zipCode" in data:
-            geocode_url = f"https://geocode.maps.co/reverse?lat={latitude}&lon={longitude}&api_key={os.environ.get("GEOCODE_API_KEY")}"
-            geocode_response = requests.get(geocode_url).json()
+            changes['Users']['Passwd'] = password_hasher.generate_password_hash(data['newPassword'])
 
-            # Extract state
-            State = geocode_response.get("address", {}).get("state")
-            cursor.execute("UPDATE Users SET State = %s WHERE user_id = %s", (State, user_id))
-            current_user.State = State
-
-            # Extract city or town
-            City = geocode_response.get("address", {}).get("city", geocode_response.get("address", {}).get("town"))
-            cursor.execute("UPDATE Users SET City = %s WHERE user_id = %s", (City, user_id))
-            current_user.City = City
-
-        if (latitude and longitude) and ("zipCode" in data or (('State' in data or 'City' in data) and 'Country' in data)):
-            # Step 2: Use Time API to get timezone information
-            time_api_url = f"https://timeapi.io/api/timezone/coordinate?latitude={latitude}&longitude={longitude}"
-            time_response = requests.get(time_api_url).json()
-
-            # Capture timezone information
-            timezone_info = {
-                "timezone": time_response["timeZone"],
-                "has_dst_bool": time_response["hasDayLightSaving"]
-            }
+        if changes['Users'] or changes['Preferences']:
+            # One short transaction with at most one statement per table
+            connection = get_db_connection()
+            cursor = connection.cursor()
 
-            # If DST exists, get detailed info
-            if timezone_info["has_dst_bool"]:
-                dst_info_url = f"https://timeapi.io/api/timezone/zone?timeZone={timezone_info['timezone']}"
-                dst_info_response = requests.get(dst_info_url).json()
-                timezone_info.update({
-                    "dst_start": dst_info_response.get("dstStart"),
-                    "dst_end": dst_info_response.get("dstEnd")
-                })
-            else:
-                timezone_info.update({
-                    "dst_start": None,
-                    "dst_end": None
-                })
-
-            # Convert has_dst_bool to 1 or 0 for storage in the database
-            if timezone_info["has_dst_bool"] == "true":
-                has_dst = "1"
-            else:
-                has_dst = "0"
+            if changes['Users']:
+                assignments = ", ".join(f"{column} = %s" for column in changes['Users'])
+                query = f"UPDATE Users SET {assignments} WHERE user_id = %s"
+                params = list(changes['Users'].values()) + [user_id]
 
-            # Update the latitude, longitude, timezone, and DST info in DB and the Users table
-            query = """
-                UPDATE Users
-                SET Lat = %s, Lon = %s, TimeZone = %s, HasDST = %s, DSTStart = %s, DSTEnd = %s
-                WHERE user_id = %s
-                """
-            cursor.execute(query, (latitude, longitude, timezone_info["timezone"], has_dst, timezone_info["dst_start"], timezone_info["dst_end"], user_id))
-            
+                # Only replace the password if nobody changed it since it was verified
+                if current_hashed_password is not None:
+                    query += " AND Passwd = %s"
+                    params.append(current_hashed_password)
 
-        # Update password if currentPassword and newPassword are provided
-        if 'currentPassword' in data and 'newPassword' in data:
-            # Fetch the current password from the database
-            cursor.execute("SELECT Passwd FROM Users WHERE user_id = %s", (user_id,))
-            current_hashed_password = cursor.fetchone()[0]
+                cursor.execute(query, params)
+                if current_hashed_password is not None and cursor.rowcount == 0:
+                    connection.rollback()
+                    cursor.close()
+                    connection.close()
+                    return jsonify({'message': 'Your password was changed elsewhere. Please try again.'}), 409
 
-            # Verify the current password
-            if bcrypt.check_password_hash(current_hashed_password, data['currentPassword']):
-                # Hash the new password
-                new_hashed_password = bcrypt.generate_password_hash(data['newPassword']).decode('utf-8')
-                # Update the password in the database
-                cursor.execute("UPDATE Users SET Passwd = %s WHERE user_id = %s", (new_hashed_password, user_id))                
-            else:                
-                flash('Current password is incorrect.', 'error')
-                return jsonify({'message': 'Current password is incorrect.'}), 400
+            if changes['Preferences']:
+                assignments = ", ".join(f"{column} = %s" for column in changes['Preferences'])
+                cursor.execute(f"UPDATE Preferences SET {assignments} WHERE user_id = %s", list(changes['Preferences'].values()) + [user_id])
 
-        # Update UIMode and CurrentPersona if provided
-        if 'UImode' in data:
-            cursor.execute("UPDATE Preferences SET UImode = %s WHERE user_id = %s", (data['UImode'], user_id))
-            current_user.UIMode = data['UImode']            
-        if 'CurrentPersona' in data:
-            cursor.execute("UPDATE Preferences SET CurrentPersona = %s WHERE user_id = %s", (data['CurrentPersona'], user_id))
-            current_user.CurrentPersona = data['CurrentPersona']            
+            # Commit the changes and close the connection
+            connection.commit()
+            cursor.close()
+            connection.close()
+            user_cache.invalidate(user_id)
 
-        # Commit the changes and close the connection
-        connection.commit()
+        # Reflect the saved values on the current user
+        for table, columns in preference_fields.items():
+            for column, (_, attribute) in columns.items():
+                if column in changes[table]:
+                    setattr(current_user, attribute, changes[table][column])
+        for column, attribute in location_columns.items():
+            if column in location_changes:
+                setattr(current_user, attribute, location_changes[column])
 
         # Update session['currentUser']
         session['currentUser'] = current_user.to_dict()
 
-        cursor.close()
-        connection.close()
-
         # Send a success response        
         return jsonify({'message': 'Preferences updated successfully.'}), 200
 
@@ -2295,6 +4685,7 @@ def update_preferences():
         return jsonify({'message': 'Failed to update preferences.'}), 500
 
 
+
 @app.route('/get_preferences', methods=['GET'])
 @login_required
 def get_preferences():
@@ -2325,24 +4716,84 @@ def get_preferences():
         return jsonify({'message': 'Failed to fetch preferences.'}), 500
 
 
+# User cache configuration
+user_cache_config = {
+    'ttl': int(os.getenv('USER_CACHE_TTL', 30)),                    # Seconds a loaded user is reused across requests
+    'max_entries': int(os.getenv('USER_CACHE_MAX_ENTRIES', 10000))  # Users kept in memory per worker
+}
+
+
+# Caches the fields needed to build a User, loaded with one query joining Users, Preferences and Token
+class UserCache:
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._users = OrderedDict()  # user_id -> (expires_at, User kwargs), least recently used first
+        self._lock = threading.Lock()
+        self._loads = SingleFlight()
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def get(self, user_id):
+        """Returns the User kwargs for the user, or None if the user doesn't exist."""
+        user_id = str(user_id)
+        with self._lock:
+            cached = self._users.get(user_id)
+            if cached and cached[0] > time.monotonic():
+                self._users.move_to_end(user_id)
+                self._stats['hits'] += 1
+                return cached[1]
+
+        self._stats['misses'] += 1
+        return self._loads.do(user_id, self._load, user_id)
+
+    def _load(self, user_id):
+        connection = get_db_connection()
+        cursor = connection.cursor(dictionary=True)
+        cursor.execute("""
+            SELECT u.user_id, u.FirstName, u.LastName, u.Username, u.DateOfBirth, u.email, u.ZipCode, u.State, u.City,
+                   u.Country, u.Lat, u.Lon, u.TimeZone, u.HasDST, u.DSTStart, u.DSTEnd, u.Gender, u.ProfilePicture, u.admin,
+                   p.UImode, p.CurrentPersona, t.TokenID
+            FROM Users u
+            LEFT JOIN Preferences p ON p.user_id = u.user_id
+            LEFT JOIN Token t ON t.user_id = u.user_id
+            WHERE u.user_id = %s
+            """, (user_id,))
+        user_data = cursor.fetchone()
+        cursor.close()
+        connection.close()
+
+        if not user_data:
+            return None
+
+        user_kwargs = dict(user_id=user_data['user_id'], FirstName=user_data['FirstName'], LastName=user_data['LastName'], Username=user_data['Username'], DateOfBirth=user_data['DateOfBirth'], email=user_data['email'], ZipCode=user_data['ZipCode'], State=user_data['State'], City=user_data['City'], Country=user_data['Country'], Latitude=user_data['Lat'], Longitude=user_data['Lon'], TimeZone=user_data['TimeZone'], HasDST=user_data['HasDST'], DSTStart=user_data['DSTStart'], DSTEnd=user_data['DSTEnd'], Gender=user_data['Gender'], Avatar=user_data['ProfilePicture'], UIMode=user_data['UImode'], CurrentPersona=user_data['CurrentPersona'], Admin=user_data['admin'],
+                           GoogleConnected=user_data['TokenID'] not in (None, "0"))  # TokenID is "0" until Google is connected
+
+        with self._lock:
+            self._users[user_id] = (time.monotonic() + self.ttl, user_kwargs)
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.max_entries:
+                self._users.popitem(last=False)
+        return user_kwargs
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._users.pop(str(user_id), None)
+            self._stats['invalidations'] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, size=len(self._users))
+
+
+user_cache = UserCache(**user_cache_config)
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    connection = get_db_connection()
-    cursor = connection.cursor(dictionary=True)
-
-    # Fetch the user by user_id
-    cursor.execute("SELECT * FROM Users WHERE user_id = %s", (user_id,))
-    user_data = cursor.fetchone()
-  
-    # Fetch user preferences from Preferences table
-    cursor.execute('SELECT * FROM Preferences WHERE user_id = %s', (user_id,))
-    user_preferences = cursor.fetchone()
-    
-    cursor.close()
-    connection.close()
-    
-    if user_data:
-        return User(user_id=user_data['user_id'], FirstName=user_data['FirstName'], LastName=user_data['LastName'], Username=user_data['Username'], DateOfBirth=user_data['DateOfBirth'], email=user_data['email'], ZipCode=user_data['ZipCode'], State=user_data['State'], City=user_data['City'], Country=user_data['Country'], Latitude=user_data['Lat'], Longitude=user_data['Lon'], TimeZone=user_data['TimeZone'], HasDST=user_data['HasDST'], DSTStart=user_data['DSTStart'], DSTEnd=user_data['DSTEnd'], Gender=user_data['Gender'], Avatar=user_data['ProfilePicture'], UIMode=user_preferences['UImode'], CurrentPersona=user_preferences['CurrentPersona'], Admin=user_data['admin'])
+    # A fresh User per request, so per-request changes to current_user never leak into the cache
+    user_kwargs = user_cache.get(user_id)
+    if user_kwargs:
+        return User(**user_kwargs)
     return None
 
 
@@ -2375,7 +4826,8 @@ def delete_account():
         temp_user_id = current_user.user_id
         print(f"Attempting to delete account for user_id: {temp_user_id}")
 
-        # Get MongoDB collections
+        # Get MongoDB collections, after writing out any buffered messages so none reappear later
+        chat_writes.flush_user(temp_user_id)
         user_index_collection, chat_history_collection = get_mongo_collections()
 
         # Fetch user index to find UserAgents
@@ -2391,54 +4843,35 @@ def delete_account():
         
             # Delete chat history collection entries for the user
             chat_history_collection.delete_many({"user_id": temp_user_id})
+            get_chat_messages_collection().delete_many({"user_id": temp_user_id})
+            calendar_store.clear_user(temp_user_id)
+            calendar_lists.invalidate(temp_user_id)
+            _migrated_chat_users.discard(temp_user_id)
 
             # Delete the user index from MongoDB
             user_index_collection.delete_one({"user_id": temp_user_id})
+            agent_directory.invalidate(temp_user_id)
 
         # Log the user out
         logout_user()
         
+        # Revoke Google permissions using a valid (possibly refreshed) token
+        token_id, token_error = google_tokens.get_access_token(temp_user_id)
+        if token_id:
+            print("Revoking Google permissions...")
+            revoke_google_permissions(token_id)  # Use valid token
+        google_tokens.invalidate(temp_user_id)
+
         # Establish a database connection
         connection = get_db_connection()
         cursor = connection.cursor()
-        
-        # Assuming expiration_time is fetched as a naive datetime object
-        cursor.execute("SELECT TokenID, RefreshID, ExpirationTime FROM Token WHERE user_id = %s", (temp_user_id,))
-        token_data = cursor.fetchone()  # Fetch TokenID, RefreshID, and ExpirationTime
-
-        if token_data:
-            token_id, refresh_token, expiration_time = token_data
-
-            # Make expiration_time timezone-aware in UTC
-            if expiration_time.tzinfo is None:  # Check if it's naive
-                expiration_time = expiration_time.replace(tzinfo=timezone.utc)
-
-            if token_id != "0":                
-                # Use the refreshed token function
-                token_id, new_expiration_time = get_valid_google_token(
-                    token_id=token_id,
-                    refresh_token=refresh_token,
-                    expiration_time=expiration_time
-                )
-
-                # Update the database if a new token is retrieved
-                if new_expiration_time:
-                    cursor.execute(
-                        "UPDATE Token SET TokenID = %s, ExpirationTime = %s WHERE user_id = %s",
-                        (token_id, new_expiration_time.isoformat(sep=" "), temp_user_id)
-                    )
-                    connection.commit()
-
-                # Revoke permissions using the valid token
-                if token_id:                
-                    print("Revoking Google permissions...")
-                    revoke_google_permissions(token_id)  # Use valid token
 
         # Delete the user entry from the Users table (cascade delete will handle related tables)
         cursor.execute("DELETE FROM Users WHERE user_id = %s", (temp_user_id,))
         
         # Commit the changes and close the connection
         connection.commit()
+        user_cache.invalidate(temp_user_id)
         cursor.close()
         connection.close()
 
@@ -2456,6 +4889,102 @@ def delete_account():
         return redirect(url_for('home'))
 
 
+# Google signing key cache configuration
+jwks_config = {
+    'url': "https://www.googleapis.com/oauth2/v3/certs",
+    'default_max_age': int(os.getenv('JWKS_DEFAULT_MAX_AGE', 3600)),           # Seconds to keep keys when the response has no max-age
+    'refresh_margin': float(os.getenv('JWKS_REFRESH_MARGIN', 0.1)),             # Fraction of max-age before expiry to refresh in the background
+    'min_refetch_interval': int(os.getenv('JWKS_MIN_REFETCH_INTERVAL', 30))     # Seconds between refetches caused by unknown key ids
+}
+
+
+# Caches Google's parsed public keys by key id, following the max-age Google sends and refreshing ahead of expiry
+class JWKSCache:
+    def __init__(self, url, default_max_age, refresh_margin, min_refetch_interval):
+        self.url = url
+        self.default_max_age = default_max_age
+        self.refresh_margin = refresh_margin
+        self.min_refetch_interval = min_refetch_interval
+        self._keys = {}  # kid -> parsed public key
+        self._expires_at = 0.0
+        self._refresh_at = 0.0
+        self._last_fetch = 0.0
+        self._fetches = SingleFlight()
+        self._refresher_pid = None
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'unknown_kid': 0, 'fetches': 0, 'fetch_failures': 0}
+
+    def _ensure_refresher(self):
+        # Start the background refresher once per process, on first use
+        if self._refresher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._refresher_pid != os.getpid():
+                self._refresher_pid = os.getpid()
+                socketio.start_background_task(self._refresh_loop)
+
+    def _refresh_loop(self):
+        while True:
+            socketio.sleep(max(1.0, self._refresh_at - time.monotonic()))
+            if time.monotonic() >= self._refresh_at:
+                try:
+                    self.refresh()
+                except Exception as e:
+                    # Keep serving the keys we have; try again shortly
+                    self._refresh_at = time.monotonic() + self.min_refetch_interval
+                    print(f"Error refreshing Google signing keys: {e}")
+
+    def _fetch(self):
+        self._last_fetch = time.monotonic()
+        self._stats['fetches'] += 1
+        try:
+            response = http_client.get(self.url)
+            response.raise_for_status()
+            keys = {key['kid']: jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(key)) for key in response.json()['keys']}
+        except Exception:
+            self._stats['fetch_failures'] += 1
+            raise
+
+        max_age_match = re.search(r'max-age=(\d+)', response.headers.get('Cache-Control', ''))
+        max_age = int(max_age_match.group(1)) if max_age_match else self.default_max_age
+
+        now = time.monotonic()
+        with self._lock:
+            self._keys = keys  # Replaced wholesale, so keys Google has rotated out stop verifying
+            self._expires_at = now + max_age
+            self._refresh_at = now + max_age * (1 - self.refresh_margin)
+        return keys
+
+    def refresh(self):
+        return self._fetches.do('jwks', self._fetch)
+
+    def get_key(self, kid):
+        """Returns the public key for the key id, or None if Google doesn't publish it."""
+        self._ensure_refresher()
+
+        key = self._keys.get(kid)
+        if key is not None and time.monotonic() < self._expires_at:
+            self._stats['hits'] += 1
+            return key
+
+        # Unknown kid (Google may have just rotated) or expired keys: refetch, but not on every bogus token
+        self._stats['unknown_kid'] += key is None
+        if key is None and time.monotonic() - self._last_fetch < self.min_refetch_interval:
+            return None
+        try:
+            return self.refresh().get(kid)
+        except Exception as e:
+            print(f"Error fetching Google signing keys: {e}")
+            return key  # An expired key still beats failing the sign-in outright
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, keys=len(self._keys), expires_in=max(0.0, self._expires_at - time.monotonic()))
+
+
+google_jwks = JWKSCache(**jwks_config)
+
+
 @app.route('/google_auth')
 @login_required
 def google_auth():
@@ -2495,21 +5024,12 @@ def callback():
     # Extract id_token from the token
     id_token = token.get('id_token')
 
-    # Fetch Google's public keys
-    google_cert_url = "https://www.googleapis.com/oauth2/v3/certs"
-    response = urlopen(google_cert_url)
-    certs = json.loads(response.read())
-
     # Decode the JWT header to extract 'kid' (key id)
     header = jwt.get_unverified_header(id_token)
     kid = header['kid']
 
-    # Find the public key in the certs
-    public_key = None
-    for key in certs['keys']:
-        if key['kid'] == kid:
-            public_key = jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(key))
-            break
+    # Look up Google's public key for it (cached, refreshed in the background)
+    public_key = google_jwks.get_key(kid)
 
     if public_key is None:
         raise ValueError("Unable to find the appropriate key")
@@ -2550,6 +5070,14 @@ def callback():
     cursor.close()
     conn.close()
 
+    # Drop any cached token from a previous connection to Google, and the cached user with the old picture
+    google_tokens.invalidate(current_user.user_id)
+    user_cache.invalidate(current_user.user_id)
+
+    # The Google account may have changed, so the local calendar copies start over
+    calendar_store.clear_user(current_user.user_id)
+    calendar_lists.invalidate(current_user.user_id)
+
     # Redirect to the dashboard
     return redirect(url_for('dashboard'))
 
@@ -2557,25 +5085,43 @@ def callback():
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-
-    # Query to fetch the TokenID for the current user
-    query = "SELECT TokenID FROM Token WHERE user_id = %s"
-    cursor.execute(query, (current_user.user_id,))
-    token = cursor.fetchone()
-
-    # Since TokenID is set to 0 by default at registration, we only check if it's 0
-    token_required = (token['TokenID'] == "0")
-    
-    # Close the cursor and connection
-    cursor.close()
-    conn.close()
+    # Google must be connected before the dashboard widgets can be used
+    token_required = not current_user.GoogleConnected
 
     # Pass token_required to the template
     return render_template('dashboard.html', user=current_user, token_required=token_required)
 
 
+# REST API route to expose runtime statistics for this worker (admins only)
+@app.route('/api/stats', methods=['GET'])
+@login_required
+def runtime_stats():
+    if not current_user.Admin:
+        return jsonify({"error": "Admin access required"}), 403
+
+    return jsonify({
+        "pid": os.getpid(),
+        "db_pool": db_pool.stats(),
+        "google_tokens": google_tokens.stats(),
+        "google_jwks": google_jwks.stats(),
+        "calendar_store": calendar_store.stats(),
+        "calendar_lists": calendar_lists.stats(),
+        "geocode_cache": geocode_cache.stats(),
+        "weather_cache": weather_cache.stats(),
+        "location_jobs": location_jobs.stats(),
+        "password_hashing": password_hasher.stats(),
+        "mail_queue": dict(mail_jobs.stats(), smtp=smtp_connections.stats()),
+        "agent_turns": agent_turns.stats(),
+        "chat_writes": chat_writes.stats(),
+        "token_usage": token_usage.stats(),
+        "agent_directory": agent_directory.stats(),
+        "user_cache": user_cache.stats(),
+        "stream_emitter": dict(stream_emitter_stats),
+        "letta_stream": dict(letta_stream_stats, ttft_avg=letta_stream_stats['ttft_total'] / letta_stream_stats['turns'] if letta_stream_stats['turns'] else None),
+        "http_upstreams": http_client.stats()
+    }), 200
+
+
 @app.route('/privacy_policy')
 def privacy_policy():
     return render_template('privacy_policy.html', user=current_user)
@@ -2614,23 +5160,34 @@ def on_join(data):
         'FirstName': user_data.get('FirstName')
     }
 
-    # Capitalize the persona name
-    current_persona = user_data['CurrentPersona'].capitalize()
-
-    # Retrieve user chat history
-    chat_history_json = get_all_user_logs(user_data['user_id'])
-    
-    # Send the chat history to the user who joined
-    emit('load_chat_history', chat_history_json, to=room)
+    # Send the most recent page of chat history to the user who joined; older pages are fetched on scroll
+    emit('load_chat_history', get_user_log_page(user_data['user_id']), to=room)
 
     # Send a server announcement message when a user joins the room
     server_announce = f"{user_data['FirstName']} has joined the room."
     send(server_announce, to=room)    
 
 
+    # Let the agent know that the user has joined, after any turns the user already has queued
+    agent_turns.submit(user_data['user_id'], run_join_turn, user_data, server_announce, room)
+
+
+# Function to greet a user who joined the room, creating their Letta agent on first join
+def run_join_turn(user_data, server_announce, room):
+    current_persona = user_data['CurrentPersona'].capitalize()
+
+    # Load all of the user's agents up front so later turns don't have to go to MongoDB
+    agent_directory.warm(user_data['user_id'])
+
     # Check if the user has an existing Letta agent for the current persona
     if get_agent_id(user_data['user_id'], f"{current_persona}{user_data['user_id']}Agent") is None:   
-             
+
+        # Give a pending signup location a few seconds so the new agent starts out knowing where the user is;
+        # if it takes longer, enrich_user_location corrects the agent's memory when it finishes
+        stored_user = ensure_user_location(user_data['user_id'], wait=location_join_wait)
+        if stored_user:
+            user_data = dict(user_data, City=stored_user['City'], State=stored_user['State'], Country=stored_user['Country'])
+
         create_letta_agent(user_data['user_id'], user_data, user_data['CurrentPersona'])   # Create a new Letta agent for the user if not found
         
         # Let agent know that user has joined for the first time
@@ -2641,6 +5198,7 @@ def on_join(data):
         send_letta_server_message(user_data['user_id'], f"{current_persona}{user_data['user_id']}Agent", welcome_announcement, room)
                        
     else: # User has an existing agent
+        ensure_user_location(user_data['user_id'])  # Retry enrichment if it never completed
 
         # Let agent know that user has re-joined the room
         welcome_announcement = f"{user_data['FirstName']} has re-joined the room. Please welcome them back and continue the conversation! (reminder, don't mention being digital)"
@@ -2650,6 +5208,21 @@ def on_join(data):
         send_letta_server_message(user_data['user_id'], f"{current_persona}{user_data['user_id']}Agent", welcome_announcement, room)        
 
 
+@socketio.on('load_older_history')
+def handle_load_older_history(data):
+    user = connected_users.get(request.sid)
+    if user is None:
+        return {"error": "Join a room before requesting chat history"}
+
+    try:
+        before = parse_history_cursor(data.get('before'))
+        limit = int(data.get('limit') or chat_history_page_config['default_limit'])
+    except (TypeError, ValueError):
+        return {"error": "Invalid history cursor or limit"}
+
+    return get_user_log_page(user['user_id'], before, limit)
+
+
 @socketio.on('leave')
 def on_leave(data):
     if 'user' in data and 'room' in data:
@@ -2701,7 +5274,21 @@ def handle_message(data):
     room = data['room']
     message = data['message']
     current_persona = user_data['CurrentPersona'].capitalize()
-    send_letta_message(user_data['user_id'], user_data, f"{current_persona}{user_data['user_id']}Agent", message, room)    
+
+    # Refuse the turn before it reaches Letta if the user is out of tokens
+    quota_error = token_usage.check_quota(user_data['user_id'])
+    if quota_error:
+        send(quota_error, to=room)
+        return {'queued': False, 'error': quota_error}
+
+    # Queue the agent turn and acknowledge right away; the reply is streamed to the room by a worker
+    position = agent_turns.submit(user_data['user_id'], send_letta_message, user_data['user_id'], user_data, f"{current_persona}{user_data['user_id']}Agent", message, room)
+
+    if position is None:
+        send("You're sending messages faster than they can be answered. Please wait for a reply and try again.", to=room)
+        return {'queued': False}
+
+    return {'queued': True, 'position': position}
 
 
 if __name__ == "__main__":
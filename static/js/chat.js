@@ -10,152 +10,211 @@ socket.emit('join', { user: CurrentUser, room: userRoom });
 let previousDate = null; // To keep track of the previous message date
 
 ///////////////-------- HANDLE CHAT HISTORY --------//////////////////////////
-socket.on('load_chat_history', function(data) {
-    if (data.length === 0) {
-        const currentDate = new Date().toISOString();
-        const localTimeString = convertUTCToLocalDate(currentDate);
-        const dateDiv = document.createElement('div');
-        dateDiv.classList.add('date-divider');
-        const dateP = document.createElement('p');
-        dateP.textContent = localTimeString;
-        dateP.style.textAlign = 'center';
-        dateDiv.appendChild(dateP);
-        chatBox.appendChild(dateDiv);
+const historyPageSize = 50;  // Messages fetched per page of chat history
+let oldestHistoryCursor = null; // Timestamp of the oldest message loaded so far
+let hasMoreHistory = false;     // Whether older messages are still on the server
+let loadingHistory = false;     // Prevents overlapping requests while scrolling
+
+// Function to create a date divider element
+function createDateDivider(dateText) {
+    const dateDiv = document.createElement('div');
+    dateDiv.classList.add('date-divider');
+    const dateP = document.createElement('p');
+    dateP.textContent = dateText;
+    dateP.style.textAlign = 'center';
+    dateDiv.appendChild(dateP);
+    return dateDiv;
+}
+
+// Function to build the element for a single chat history entry
+function createHistoryEntry(entry) {
+    const message = document.createElement('div');   
+    const messageContainer = document.createElement('div');
+    const avatarContainer = document.createElement('div');
+    const avatarImage = document.createElement('img');
+    const avatarName = document.createElement('div');
+
+    const persona = entry.sender_name.toLowerCase();
+
+    // Styling the message based on the sender
+    if (entry.sender === 'User' || entry.sender === 'Agent') {
+        message.classList.add('chat-message', 
+            entry.sender === 'Agent' ? 'incoming-message' : 
+            'outgoing-message'                    
+        );            
+    } else if (entry.sender === 'System') {
+        message.classList.add('server-message', 'text-start');
+    }            
+
+    // Styling the message container based on the sender
+    if (entry.sender === 'User' || entry.sender === 'Agent') {
+        messageContainer.classList.add('message-container', 
+            entry.sender === 'Agent' ? 'incoming-container' : 
+            'outgoing-container'
+        );
     }
+
+    const timestamp = document.createElement('div'); // Create a timestamp element
+
+    const messageTime = new Date(Date.parse(entry.timestamp + 'Z'));
+    const localTimeString = convertUTCToLocal(messageTime);
+    timestamp.classList.add('timestamp');
+    timestamp.textContent = localTimeString;
     
-    // Parse the JSON data to get the logs
-    const chatLogs = JSON.parse(data);
-    
-    const chatBox = document.getElementById('chat-box');
-    
+    if (entry.sender == 'Agent') {
+        avatarContainer.classList.add('avatar-container');                
+        avatarImage.classList.add('avatar-image');
+        avatarImage.src = `/static/img/personas/${persona}.png`;
 
-    // Assuming chatLogs is an array of chat history objects
-    chatLogs.forEach(log => {
-        log.chat_history.forEach(entry => {
-            const currentDate = convertUTCToLocalDate(entry.timestamp);
-
-            // Check if the current message date is different from the previous message date
-            if (previousDate !== currentDate) {
-                const dateDiv = document.createElement('div');
-                dateDiv.classList.add('date-divider');
-                const dateP = document.createElement('p');
-                dateP.textContent = currentDate;
-                dateP.style.textAlign = 'center';
-                dateDiv.appendChild(dateP);
-                chatBox.appendChild(dateDiv);
-                previousDate = currentDate; // Update the previous date
-            }
-
-            const message = document.createElement('div');   
-            const messageContainer = document.createElement('div');
-            const avatarContainer = document.createElement('div');
-            const avatarImage = document.createElement('img');
-            const avatarName = document.createElement('div');
-
-            const persona = entry.sender_name.toLowerCase();
-
-            // Styling the message based on the sender
-            if (entry.sender === 'User' || entry.sender === 'Agent') {
-                message.classList.add('chat-message', 
-                    entry.sender === 'Agent' ? 'incoming-message' : 
-                    'outgoing-message'                    
-                );            
-            } else if (entry.sender === 'System') {
-                message.classList.add('server-message', 'text-start');
-            }            
-
-            // Styling the message container based on the sender
-            if (entry.sender === 'User' || entry.sender === 'Agent') {
-                messageContainer.classList.add('message-container', 
-                    entry.sender === 'Agent' ? 'incoming-container' : 
-                    'outgoing-container'
-                );
-            }
-            
-            if (entry.sender == 'Agent') {
-                avatarContainer.classList.add('avatar-container');                
-                avatarImage.classList.add('avatar-image');
-                avatarImage.src = `/static/img/personas/${persona}.png`;
-
-                // Add the persona name above the avatar                
-                avatarName.classList.add('avatar-name');
-                avatarName.textContent = entry.sender_name;
-
-                avatarContainer.appendChild(avatarName); 
-                avatarContainer.appendChild(avatarImage);
-                
-                const timestamp = document.createElement('div'); // Create a timestamp element
-
-                const messageTime = new Date(Date.parse(entry.timestamp + 'Z'));
-                const localTimeString = convertUTCToLocal(messageTime);
-                timestamp.classList.add('timestamp');
-                timestamp.textContent = localTimeString;
-
-                // Add the message text
-                message.classList.add('message-text');
-                message.innerHTML = md.render(entry.message);
-
-                // Append message text and avatar container
-                messageContainer.appendChild(avatarContainer);
-                messageContainer.appendChild(message);
-                messageContainer.appendChild(timestamp);                
-                chatBox.appendChild(messageContainer);
-            }
-
-            if (entry.sender == 'User') {                
-                avatarContainer.classList.add('avatar-container');                
-                avatarImage.classList.add('avatar-image');
-                avatarImage.src = CurrentUser["Avatar"];
-
-                avatarName.classList.add('avatar-name');
-                avatarName.textContent = CurrentUser["FirstName"];
-
-                // Append avatar and name to the avatar container                
-                avatarContainer.appendChild(avatarName);
-                avatarContainer.appendChild(avatarImage);
-
-                const timestamp = document.createElement('div'); // Create a timestamp element
-
-                const messageTime = new Date(Date.parse(entry.timestamp + 'Z'));
-                const localTimeString = convertUTCToLocal(messageTime);
-                timestamp.classList.add('timestamp');
-                timestamp.textContent = localTimeString;
-
-                // Add the message text
-                message.classList.add('message-text');
-                message.innerHTML = md.render(entry.message);
-
-                // Append message text and avatar container
-                messageContainer.appendChild(timestamp);
-                messageContainer.appendChild(message);
-                messageContainer.appendChild(avatarContainer);
-                chatBox.appendChild(messageContainer);
-            }
-
-            if (entry.sender == 'System') {
-                const serverMessageContainer = document.createElement('div');
-                serverMessageContainer.classList.add('server-container');
-
-                message.classList.add('message-text');
-
-                const timestamp = document.createElement('div'); // Create a timestamp element
-
-                const messageTime = new Date(Date.parse(entry.timestamp + 'Z'));
-                const localTimeString = convertUTCToLocal(messageTime);
-                timestamp.classList.add('timestamp');
-                timestamp.textContent = localTimeString;
-
-                message.innerHTML = `${entry.message}`;
-
-                serverMessageContainer.appendChild(message);
-                serverMessageContainer.appendChild(timestamp);
-                chatBox.appendChild(serverMessageContainer);
-            }            
-        });
+        // Add the persona name above the avatar                
+        avatarName.classList.add('avatar-name');
+        avatarName.textContent = entry.sender_name;
+
+        avatarContainer.appendChild(avatarName); 
+        avatarContainer.appendChild(avatarImage);
+
+        // Add the message text
+        message.classList.add('message-text');
+        message.innerHTML = md.render(entry.message);
+
+        // Append message text and avatar container
+        messageContainer.appendChild(avatarContainer);
+        messageContainer.appendChild(message);
+        messageContainer.appendChild(timestamp);                
+        return messageContainer;
+    }
+
+    if (entry.sender == 'User') {                
+        avatarContainer.classList.add('avatar-container');                
+        avatarImage.classList.add('avatar-image');
+        avatarImage.src = CurrentUser["Avatar"];
+
+        avatarName.classList.add('avatar-name');
+        avatarName.textContent = CurrentUser["FirstName"];
+
+        // Append avatar and name to the avatar container                
+        avatarContainer.appendChild(avatarName);
+        avatarContainer.appendChild(avatarImage);
+
+        // Add the message text
+        message.classList.add('message-text');
+        message.innerHTML = md.render(entry.message);
+
+        // Append message text and avatar container
+        messageContainer.appendChild(timestamp);
+        messageContainer.appendChild(message);
+        messageContainer.appendChild(avatarContainer);
+        return messageContainer;
+    }
+
+    // System messages
+    const serverMessageContainer = document.createElement('div');
+    serverMessageContainer.classList.add('server-container');
+
+    message.classList.add('message-text');
+    message.innerHTML = `${entry.message}`;
+
+    serverMessageContainer.appendChild(message);
+    serverMessageContainer.appendChild(timestamp);
+    return serverMessageContainer;
+}
+
+// Function to render a page of history entries (oldest first) into a fragment with date dividers
+function renderHistoryPage(entries) {
+    const fragment = document.createDocumentFragment();
+    let firstDate = null;
+    let lastDate = null;
+
+    entries.forEach(entry => {
+        const entryDate = convertUTCToLocalDate(entry.timestamp);
+
+        // Add a divider whenever the date changes
+        if (lastDate !== entryDate) {
+            fragment.appendChild(createDateDivider(entryDate));
+            lastDate = entryDate;
+        }
+        if (firstDate === null) {
+            firstDate = entryDate;
+        }
+
+        fragment.appendChild(createHistoryEntry(entry));
     });
 
+    return { fragment, firstDate, lastDate };
+}
+
+// Function to remember where the next (older) page starts
+function updateHistoryCursor(page) {
+    oldestHistoryCursor = page.next_before;
+    hasMoreHistory = page.has_more;
+}
+
+// The most recent page of history is sent when joining the room
+socket.on('load_chat_history', function(page) {
+    const chatBox = document.getElementById('chat-box');
+
+    if (page.messages.length === 0) {
+        const currentDate = convertUTCToLocalDate(new Date().toISOString());
+        chatBox.appendChild(createDateDivider(currentDate));
+        previousDate = currentDate;
+    } else {
+        const rendered = renderHistoryPage(page.messages);
+        chatBox.appendChild(rendered.fragment);
+        previousDate = rendered.lastDate;
+    }
+
+    updateHistoryCursor(page);
+
     // Scroll to the bottom of the chat box to keep the latest message in view
     chatBox.scrollTop = chatBox.scrollHeight;
+    fillChatBoxWithHistory(chatBox);
+});
+
+// Function to keep loading older pages until the chat box can scroll (no scroll events fire otherwise)
+function fillChatBoxWithHistory(chatBox) {
+    if (chatBox.scrollHeight <= chatBox.clientHeight) {
+        loadOlderHistory();
+    }
+}
+
+// Function to fetch the page before the oldest loaded message and prepend it
+function loadOlderHistory() {
+    if (loadingHistory || !hasMoreHistory) {
+        return;
+    }
+    loadingHistory = true;
+
+    socket.emit('load_older_history', { before: oldestHistoryCursor, limit: historyPageSize }, function(page) {
+        loadingHistory = false;
+        if (!page || page.error) {
+            console.error('Error loading chat history:', page && page.error);
+            return;
+        }
+
+        const chatBox = document.getElementById('chat-box');
+        const rendered = renderHistoryPage(page.messages);
+
+        // Drop the top divider if the older page ends on the same date
+        const topDivider = chatBox.querySelector('.date-divider');
+        if (topDivider && topDivider.textContent === rendered.lastDate) {
+            topDivider.remove();
+        }
+
+        // Keep the messages the user is looking at in place while content is added above them
+        const previousHeight = chatBox.scrollHeight;
+        chatBox.insertBefore(rendered.fragment, chatBox.firstChild);
+        chatBox.scrollTop += chatBox.scrollHeight - previousHeight;
+
+        updateHistoryCursor(page);
+        fillChatBoxWithHistory(chatBox);
+    });
+}
+
+// Load older messages when the user scrolls near the top of the chat box
+document.getElementById('chat-box').addEventListener('scroll', function() {
+    if (this.scrollTop < 100) {
+        loadOlderHistory();
+    }
 });
 
 
@@ -334,14 +393,8 @@ function hideTypingIndicator() {
 let currentMessageElement = null;
 let accumulatedMessage = ""; // To accumulate the full message text
 
-socket.on('streamed_message', function(data) {
-    let { message, persona } = data;    
-
-    hideTypingIndicator(); // Hide the typing indicator when the agent sends a message
-
-    // Get the chat box container
-    const chatBox = document.getElementById('chat-box');
-
+// Function to open a new agent chat bubble, under a date divider when the day has changed
+function startAgentMessage(chatBox, persona) {
     const date = new Date().toISOString();
     const currentDate = convertUTCToLocalDate(date);
 
@@ -357,46 +410,62 @@ socket.on('streamed_message', function(data) {
         previousDate = currentDate; // Update the previous date
     }
 
-    // If we are starting a new message
-    if (currentMessageElement === null) {
-        // Create the message container for a new message
-        currentMessageElement = document.createElement('div');
-        currentMessageElement.classList.add('chat-message', 'incoming-message', 'incoming-container');
-        
-        // Add persona and avatar at the beginning of the message
-        const persona = data.persona.toLowerCase(); // Assuming persona is provided
-        const avatarContainer = document.createElement('div');
-        avatarContainer.classList.add('avatar-container');
+    // Create the message container for a new message
+    currentMessageElement = document.createElement('div');
+    currentMessageElement.classList.add('chat-message', 'incoming-message', 'incoming-container');
+    
+    // Add persona and avatar at the beginning of the message
+    const personaKey = persona.toLowerCase(); // Assuming persona is provided
+    const avatarContainer = document.createElement('div');
+    avatarContainer.classList.add('avatar-container');
+
+    // Add the avatar image
+    const avatarImage = document.createElement('img');
+    avatarImage.classList.add('avatar-image');
+    avatarImage.src = `/static/img/personas/${personaKey}.png`; // Assuming avatars are named by persona
+
+    // Add the persona name above the avatar
+    const avatarName = document.createElement('div');
+    avatarName.classList.add('avatar-name');
+    avatarName.textContent = persona;
+    
+    avatarContainer.appendChild(avatarName);
+    avatarContainer.appendChild(avatarImage);
 
-        // Add the avatar image
-        const avatarImage = document.createElement('img');
-        avatarImage.classList.add('avatar-image');
-        avatarImage.src = `/static/img/personas/${persona}.png`; // Assuming avatars are named by persona
+    const timestamp = document.createElement('div'); // Create a timestamp element
 
-        // Add the persona name above the avatar
-        const avatarName = document.createElement('div');
-        avatarName.classList.add('avatar-name');
-        avatarName.textContent = data.persona;
-        
-        avatarContainer.appendChild(avatarName);
-        avatarContainer.appendChild(avatarImage);
+    const currentTime = new Date().toISOString();
+    const localTimeString = convertUTCToLocal(currentTime);
+    timestamp.classList.add('timestamp');
+    timestamp.textContent = localTimeString;
 
-        const timestamp = document.createElement('div'); // Create a timestamp element
+    // Create a container that holds both avatar and message
+    const messageContainer = document.createElement('div');
+    messageContainer.classList.add('message-container');
+    messageContainer.appendChild(avatarContainer);
+    messageContainer.appendChild(currentMessageElement);
+    messageContainer.appendChild(timestamp);
 
-        const currentTime = new Date().toISOString();
-        const localTimeString = convertUTCToLocal(currentTime);
-        timestamp.classList.add('timestamp');
-        timestamp.textContent = localTimeString;
+    // Append the message container to the chat box
+    chatBox.appendChild(messageContainer);
+}
 
-        // Create a container that holds both avatar and message
-        const messageContainer = document.createElement('div');
-        messageContainer.classList.add('message-container');
-        messageContainer.appendChild(avatarContainer);
-        messageContainer.appendChild(currentMessageElement);
-        messageContainer.appendChild(timestamp);
+socket.on('streamed_message', function(data) {
+    let { message, persona } = data;    
 
-        // Append the message container to the chat box
-        chatBox.appendChild(messageContainer);
+    hideTypingIndicator(); // Hide the typing indicator when the agent sends a message
+
+    // The closing frame carries no text; final_message finishes the bubble
+    if (data.done && !message) {
+        return;
+    }
+
+    // Get the chat box container
+    const chatBox = document.getElementById('chat-box');
+
+    // If we are starting a new message
+    if (currentMessageElement === null) {
+        startAgentMessage(chatBox, data.persona);
     }    
 
     // Append the chunk to the accumulated message
@@ -411,15 +480,32 @@ socket.on('streamed_message', function(data) {
 
 // Listen for the final message to update it with the clean version
 socket.on('final_message', function(finalData) {
-    if (finalData && finalData.message && currentMessageElement) {
+    if (!finalData) {
+        return;
+    }
 
+    hideTypingIndicator();
+
+    if (finalData.error) {
+        // The reply failed part way; keep what arrived and say so, in the open bubble or a new one
+        if (currentMessageElement === null) {
+            startAgentMessage(document.getElementById('chat-box'), finalData.persona);
+        }
+        const errorNote = document.createElement('p');
+        errorNote.classList.add('stream-error');
+        const errorText = document.createElement('em');
+        errorText.textContent = finalData.error;
+        errorNote.appendChild(errorText);
+        currentMessageElement.innerHTML = md.render(finalData.message || accumulatedMessage);
+        currentMessageElement.appendChild(errorNote);
+    } else if (finalData.message && currentMessageElement) {
         // Parse the final message as Markdown and update the chat bubble
         currentMessageElement.innerHTML = md.render(finalData.message);
-        
-        // Finalize the message element
-        currentMessageElement = null;  // Nullify the reference for the next message
-        accumulatedMessage = "";       // Reset accumulated message for the next response
     }
+
+    // Finalize the message element, even when the reply ended without text
+    currentMessageElement = null;  // Nullify the reference for the next message
+    accumulatedMessage = "";       // Reset accumulated message for the next response
 });
 
 
@@ -428,7 +514,7 @@ function convertUTCToLocal(utcTimestamp) {
     const utcDate = new Date(utcTimestamp);    
 
     // Retrieve timezone information from CurrentUser
-    const timezone = CurrentUser["TimeZone"];
+    const timezone = CurrentUser["TimeZone"] || undefined; // Not set until signup location enrichment finishes
     const hasDST = CurrentUser["HasDST"];
     const dstStart = new Date(CurrentUser["DSTStart"]);
     const dstEnd = new Date(CurrentUser["DSTEnd"]);
@@ -460,7 +546,7 @@ function convertUTCToLocalDate(utcTimestamp) {
     }
 
     // Retrieve the user's timezone from CurrentUser
-    const timezone = CurrentUser["TimeZone"];
+    const timezone = CurrentUser["TimeZone"] || undefined; // Not set until signup location enrichment finishes
 
     // Set up formatting options for the full date with weekday
     const options = {